@@ -1,16 +1,196 @@
 import sqlite3
+import atexit
+import html
+import json
 import os
+import queue
+import re
+import threading
+import time
 import uuid
+from collections import OrderedDict
 from datetime import datetime
+from functools import wraps
+
+import metrics
+from metrics import timed_query
 
 # Use a database file named 'database.db'. You can override this with the environment variable SQLITE_DB.
 db_path = os.environ.get("SQLITE_DB", "database.db")
-# Set check_same_thread=False if you plan to use the connection in different threads (for example, in a web app)
-conn = sqlite3.connect(db_path, check_same_thread=False)
-cursor = conn.cursor()
+# How long a connection waits on a locked database before giving up (seconds).
+BUSY_TIMEOUT = float(os.environ.get("SQLITE_BUSY_TIMEOUT", "5"))
+
+# How many idle connections are kept open for reuse.
+POOL_SIZE = int(os.environ.get("SQLITE_POOL_SIZE", "8"))
+
+# A thread checks a connection out of the pool on its first query and keeps
+# it until release_connection() (called when a Flask request ends), so
+# sqlite3 connections and cursors are never shared between concurrent
+# threads, and threads started per request (werkzeug's dev server) reuse
+# open connections instead of connecting and running the PRAGMAs each time.
+_local = threading.local()
+_pool = queue.LifoQueue(maxsize=POOL_SIZE)
+
+
+def _reset_after_fork():
+    # A connection inherited from the parent process (e.g. gunicorn --preload)
+    # must never be used by the child; every worker opens its own.
+    global _local, _pool
+    _local = threading.local()
+    _pool = queue.LifoQueue(maxsize=POOL_SIZE)
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _connect():
+    # check_same_thread=False: pooled connections move between threads, one
+    # thread at a time.
+    conn = sqlite3.connect(db_path, timeout=BUSY_TIMEOUT, check_same_thread=False)
+    # WAL lets readers run while a write is in progress; NORMAL sync is
+    # safe with WAL and avoids an fsync on every commit.
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA busy_timeout={int(BUSY_TIMEOUT * 1000)}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-16000")  # 16 MB page cache
+    return conn
+
+
+def get_connection():
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        try:
+            conn = _pool.get_nowait()
+        except queue.Empty:
+            conn = _connect()
+        _local.conn = conn
+    return conn
+
+
+def release_connection():
+    """
+    Returns this thread's connection to the pool (closing it if the pool is
+    full). The next query on the thread checks one out again.
+    """
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        return
+    _local.conn = None
+    if conn.in_transaction:
+        conn.rollback()
+    try:
+        _pool.put_nowait(conn)
+    except queue.Full:
+        conn.close()
+
+
+def get_cursor():
+    conn = get_connection()
+    return conn, conn.cursor()
+
+
+def retry_on_busy(func, attempts=5):
+    """
+    Retries a write when SQLite still reports the database as locked after
+    the busy timeout, backing off a little more each time.
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        for attempt in range(attempts):
+            try:
+                return func(*args, **kwargs)
+            except sqlite3.OperationalError as e:
+                if "locked" not in str(e) and "busy" not in str(e):
+                    raise
+                get_connection().rollback()
+                if attempt == attempts - 1:
+                    raise
+                time.sleep(0.05 * 2**attempt)
+    return wrapper
+
+
+# Schema migrations, applied in order and tracked with PRAGMA user_version.
+MIGRATIONS = [
+    # 1: indexes for the history and collection lookups.
+    [
+        "CREATE INDEX IF NOT EXISTS idx_chat_history_collection_id ON chat_history(collection_id, id)",
+        "CREATE INDEX IF NOT EXISTS idx_collections_user_id ON collections(user_id)",
+    ],
+    # 2: assistant messages keep source references (chunk id + score) in
+    # their own column instead of the retrieved text appended to the answer.
+    [
+        "ALTER TABLE chat_history ADD COLUMN sources TEXT",
+        """
+        UPDATE chat_history
+        SET content = substr(content, 1, instr(content, char(10, 10, 10, 10, 10) || '=====') - 1)
+        WHERE role = 'assistant' AND instr(content, char(10, 10, 10, 10, 10) || '=====') > 0
+        """,
+    ],
+    # 3: full-text search over chat history. The FTS5 table only holds the
+    # index; the text is read from chat_history through the view. Besides the
+    # message it indexes its owner (hex of the user id, so one token per
+    # user): a search ANDs that in, and FTS5 intersects it with the query
+    # terms instead of filtering every other user's matches afterwards.
+    [
+        """
+        CREATE VIEW IF NOT EXISTS chat_history_search AS
+        SELECT h.id AS id, h.content AS content, hex(c.user_id) AS owner
+        FROM chat_history h JOIN collections c ON c.collection_id = h.collection_id
+        """,
+        """
+        CREATE VIRTUAL TABLE chat_history_fts USING fts5(
+            content, owner, content='chat_history_search', content_rowid='id', tokenize='porter unicode61'
+        )
+        """,
+        # Rank by the message text only.
+        "INSERT INTO chat_history_fts(chat_history_fts, rank) VALUES('rank', 'bm25(1.0, 0.0)')",
+        """
+        CREATE TRIGGER chat_history_fts_insert AFTER INSERT ON chat_history BEGIN
+            INSERT INTO chat_history_fts(rowid, content, owner)
+            SELECT new.id, new.content, hex(user_id) FROM collections WHERE collection_id = new.collection_id;
+        END
+        """,
+        """
+        CREATE TRIGGER chat_history_fts_delete AFTER DELETE ON chat_history BEGIN
+            INSERT INTO chat_history_fts(chat_history_fts, rowid, content, owner)
+            SELECT 'delete', old.id, old.content, hex(user_id) FROM collections WHERE collection_id = old.collection_id;
+        END
+        """,
+        """
+        CREATE TRIGGER chat_history_fts_update AFTER UPDATE OF content, collection_id ON chat_history BEGIN
+            INSERT INTO chat_history_fts(chat_history_fts, rowid, content, owner)
+            SELECT 'delete', old.id, old.content, hex(user_id) FROM collections WHERE collection_id = old.collection_id;
+            INSERT INTO chat_history_fts(rowid, content, owner)
+            SELECT new.id, new.content, hex(user_id) FROM collections WHERE collection_id = new.collection_id;
+        END
+        """,
+        # Index the messages written before this migration.
+        "INSERT INTO chat_history_fts(chat_history_fts) VALUES('rebuild')",
+    ],
+]
+
+
+def migrate_db():
+    conn, cursor = get_cursor()
+    # Several worker processes may start at once; the write lock makes sure
+    # only one of them applies each migration.
+    cursor.execute("BEGIN IMMEDIATE")
+    try:
+        version = cursor.execute("PRAGMA user_version").fetchone()[0]
+        for number, statements in enumerate(MIGRATIONS[version:], start=version + 1):
+            for statement in statements:
+                cursor.execute(statement)
+            cursor.execute(f"PRAGMA user_version = {number}")
+            print(f"Applied database migration {number}.")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
 
 
 def init_db():
+    conn, cursor = get_cursor()
     # Create the 'users' table if it doesn't exist
     cursor.execute(
         """
@@ -58,13 +238,98 @@ def init_db():
     """
     )
     conn.commit()
+    migrate_db()
 
 
 # Initialize the database tables.
 init_db()
 
 
+class OwnershipCache:
+    """
+    Bounded LRU of (user_id, collection_id) pairs known to be owned, so the
+    chat and history paths don't re-run the same ownership query on every
+    call. Only positive answers are cached. Entries expire after
+    `ttl_seconds` because a collection deleted in another worker process
+    only invalidates that process's cache.
+    """
+
+    def __init__(self, max_entries=4096, ttl_seconds=60.0):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.entries = OrderedDict()  # (user_id, collection_id) -> time added
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def contains(self, user_id, collection_id):
+        key = (user_id, collection_id)
+        with self._lock:
+            added = self.entries.get(key)
+            if added is not None and time.monotonic() - added <= self.ttl_seconds:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                metrics.ownership_cache_lookups.inc(result="hit")
+                return True
+            if added is not None:
+                del self.entries[key]
+            self.misses += 1
+        metrics.ownership_cache_lookups.inc(result="miss")
+        return False
+
+    def add(self, user_id, collection_id):
+        with self._lock:
+            self.entries[(user_id, collection_id)] = time.monotonic()
+            self.entries.move_to_end((user_id, collection_id))
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def discard(self, user_id, collection_id):
+        with self._lock:
+            self.entries.pop((user_id, collection_id), None)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+ownership_cache = OwnershipCache(
+    max_entries=int(os.environ.get("OWNERSHIP_CACHE_SIZE", "4096")),
+    ttl_seconds=float(os.environ.get("OWNERSHIP_CACHE_TTL", "60")),
+)
+
+
+def owns_collection(user_id, collection_id):
+    """
+    True if the collection belongs to the user. Cached, see OwnershipCache.
+    """
+    if ownership_cache.contains(user_id, collection_id):
+        return True
+    conn, cursor = get_cursor()
+    cursor.execute(
+        "SELECT collection_id FROM collections WHERE collection_id = ? AND user_id = ?",
+        (collection_id, user_id),
+    )
+    if not cursor.fetchone():
+        return False
+    ownership_cache.add(user_id, collection_id)
+    return True
+
+
+def get_ownership_cache_stats():
+    return ownership_cache.stats()
+
+
+@timed_query("makeUser")
+@retry_on_busy
 def makeUser(user_id, email=None, password=None):
+    conn, cursor = get_cursor()
     # Check if the user exists.
     cursor.execute("SELECT id FROM users WHERE id = ?", (user_id,))
     user = cursor.fetchone()
@@ -79,7 +344,10 @@ def makeUser(user_id, email=None, password=None):
         print(f"User {user_id} found in database.")
 
 
+@timed_query("create_user")
+@retry_on_busy
 def create_user(email, password):
+    conn, cursor = get_cursor()
     # Generate a unique user ID
     user_id = str(uuid.uuid4())
 
@@ -95,7 +363,9 @@ def create_user(email, password):
         return None
 
 
+@timed_query("get_user_by_email")
 def get_user_by_email(email):
+    conn, cursor = get_cursor()
     cursor.execute(
         "SELECT id, email, password FROM users WHERE email = ?",
         (email,),
@@ -110,7 +380,10 @@ def get_user_by_email(email):
     return None
 
 
+@timed_query("add_collection")
+@retry_on_busy
 def add_collection(user_id, collection_name):
+    conn, cursor = get_cursor()
     # Generate a unique collection ID.
     collection_id = str(uuid.uuid4())
     cursor.execute(
@@ -118,36 +391,52 @@ def add_collection(user_id, collection_name):
         (collection_id, user_id, collection_name),
     )
     conn.commit()
+    ownership_cache.add(user_id, collection_id)
     return collection_id
 
 
+@timed_query("delete_collection")
+@retry_on_busy
 def delete_collection(user_id, collection_id):
-    # Delete the collection only if it belongs to the specified user.
+    conn, cursor = get_cursor()
+    # Only the history of a collection that belongs to the user, and before
+    # the collection row: the search index trigger looks up the owner there.
+    cursor.execute(
+        """
+        DELETE FROM chat_history WHERE collection_id IN (
+            SELECT collection_id FROM collections WHERE collection_id = ? AND user_id = ?
+        )
+        """,
+        (collection_id, user_id),
+    )
     cursor.execute(
         "DELETE FROM collections WHERE collection_id = ? AND user_id = ?",
         (collection_id, user_id),
     )
-    # Also remove any associated chat history.
-    cursor.execute("DELETE FROM chat_history WHERE collection_id = ?", (collection_id,))
     conn.commit()
+    # After the commit, so a concurrent check can't re-add it from the old row.
+    ownership_cache.discard(user_id, collection_id)
 
 
+@timed_query("get_collections")
 def get_collections(user_id):
+    conn, cursor = get_cursor()
     cursor.execute(
         "SELECT collection_id, name FROM collections WHERE user_id = ?", (user_id,)
     )
     results = cursor.fetchall()
+    for row in results:
+        ownership_cache.add(user_id, row[0])
     # Format the rows as a list of dictionaries.
     return [{"collectionId": row[0], "name": row[1]} for row in results]
 
 
+@timed_query("add_message")
+@retry_on_busy
 def add_message(user_id, collection_id, role, content):
+    conn, cursor = get_cursor()
     # Verify that the collection belongs to the user.
-    cursor.execute(
-        "SELECT collection_id FROM collections WHERE collection_id = ? AND user_id = ?",
-        (collection_id, user_id),
-    )
-    if not cursor.fetchone():
+    if not owns_collection(user_id, collection_id):
         print("Collection not found for user.")
         return
     # Create a new message with an ISO-formatted UTC timestamp.
@@ -159,22 +448,293 @@ def add_message(user_id, collection_id, role, content):
     conn.commit()
 
 
+# Inserts a chat_history row only if the collection still belongs to the
+# user: the ownership cache can be stale when another worker process deleted
+# the collection. Parameters are the row followed by (collection_id, user_id).
+INSERT_OWNED_CHAT_ROW = """
+    INSERT INTO chat_history (collection_id, role, content, timestamp, sources)
+    SELECT ?, ?, ?, ?, ? WHERE EXISTS (
+        SELECT 1 FROM collections WHERE collection_id = ? AND user_id = ?
+    )
+"""
+
+
+def owned_chat_rows(user_id, rows):
+    return [row + (row[0], user_id) for row in rows]
+
+
+class ChatWriteBehind:
+    """
+    Background writer that group-commits chat_history inserts.
+
+    Request threads hand their rows over and return immediately; the writer
+    thread waits up to `flush_interval` seconds for more rows to arrive and
+    writes everything it collected in one transaction, so concurrent chats
+    share a single commit. A batch that still fails after retry_on_busy is
+    retried `write_attempts` times, then appended to `failed_path` (one JSON
+    row per line) so it can be replayed instead of being lost. At exit the
+    writer is stopped with a sentinel and joined, so rows it already
+    collected are written too. A history read right after an enqueue may
+    not see the rows yet. Rows of a collection that was deleted in the
+    meantime are dropped, and its ownership cache entry with them.
+    """
+
+    _STOP = object()
+
+    def __init__(self, flush_interval=0.05, max_batch=256, write_attempts=3, failed_path="chat_history_failed.jsonl"):
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self.write_attempts = write_attempts
+        self.failed_path = failed_path
+        self.commits = 0
+        self.rows_written = 0
+        self.rows_failed = 0
+        self._start()
+        atexit.register(self.close)
+        # Threads don't survive fork: give each worker process its own writer.
+        os.register_at_fork(after_in_child=self._start)
+
+    def _start(self):
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="chat-write-behind", daemon=True)
+        self._thread.start()
+
+    def enqueue(self, rows):
+        self._queue.put(rows)
+
+    def _collect(self):
+        """
+        Returns (rows, stop): the rows that arrived within flush_interval of
+        the first one, and whether the stop sentinel was among them.
+        """
+        item = self._queue.get()
+        if item is self._STOP:
+            return [], True
+        rows = list(item)
+        deadline = time.monotonic() + self.flush_interval
+        while len(rows) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is self._STOP:
+                return rows, True
+            rows.extend(item)
+        return rows, False
+
+    @retry_on_busy
+    def _write(self, rows):
+        conn, cursor = get_cursor()
+        cursor.executemany(INSERT_OWNED_CHAT_ROW, rows)
+        conn.commit()
+        self.commits += 1
+        self.rows_written += cursor.rowcount
+        if cursor.rowcount < len(rows):
+            # Some collection is gone; the owned ones are simply re-checked.
+            for row in rows:
+                ownership_cache.discard(row[-1], row[-2])
+
+    def _write_or_save(self, rows):
+        for attempt in range(self.write_attempts):
+            try:
+                self._write(rows)
+                return
+            except sqlite3.Error as e:
+                get_connection().rollback()
+                print(f"Error writing chat history (attempt {attempt + 1}): {e}", flush=True)
+                time.sleep(0.5 * 2**attempt)
+        self.rows_failed += len(rows)
+        try:
+            with open(self.failed_path, "a", encoding="utf-8") as f:
+                for row in rows:
+                    f.write(json.dumps(row) + "\n")
+            print(f"Saved {len(rows)} unwritten chat history rows to {self.failed_path}.", flush=True)
+        except OSError as e:
+            print(f"Lost {len(rows)} chat history rows, could not save them: {e}", flush=True)
+
+    def _run(self):
+        while True:
+            rows, stop = self._collect()
+            if rows:
+                self._write_or_save(rows)
+            if stop:
+                return
+
+    def close(self, timeout=30):
+        """
+        Stops the writer after everything queued before the call is written.
+        """
+        if not self._thread.is_alive():
+            return
+        self._queue.put(self._STOP)
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            print("Chat history writer did not finish in time, some rows may be lost.", flush=True)
+
+
+# Set CHAT_WRITE_BEHIND=1 to group-commit chat inserts in the background.
+write_behind = (
+    ChatWriteBehind(failed_path=os.environ.get("CHAT_WRITE_BEHIND_FAILED_PATH", "chat_history_failed.jsonl"))
+    if os.environ.get("CHAT_WRITE_BEHIND") == "1"
+    else None
+)
+
+
+@timed_query("append_exchange")
+@retry_on_busy
+def append_exchange(user_id, collection_id, user_msg, assistant_msg, sources=None):
+    """
+    Saves a user message and the assistant's answer together: one ownership
+    check and one transaction instead of two add_message calls. `sources` is
+    the list of chunk references the answer was based on. Returns False if
+    the collection does not belong to the user.
+    """
+    conn, cursor = get_cursor()
+    if not owns_collection(user_id, collection_id):
+        print("Collection not found for user.")
+        return False
+    timestamp = datetime.utcnow().isoformat()
+    rows = [
+        (collection_id, "user", user_msg, timestamp, None),
+        (collection_id, "assistant", assistant_msg, timestamp, json.dumps(sources) if sources else None),
+    ]
+    rows = owned_chat_rows(user_id, rows)
+    if write_behind is not None:
+        write_behind.enqueue(rows)
+        return True
+    cursor.executemany(INSERT_OWNED_CHAT_ROW, rows)
+    conn.commit()
+    if cursor.rowcount == 0:
+        # Deleted by another worker since it was cached.
+        ownership_cache.discard(user_id, collection_id)
+        print("Collection not found for user.")
+        return False
+    return True
+
+
+def _load_sources(value):
+    return json.loads(value) if value else []
+
+
+@timed_query("get_chat_history")
 def get_chat_history(user_id, collection_id):
+    conn, cursor = get_cursor()
     # Confirm that the given collection belongs to the user.
-    cursor.execute(
-        "SELECT collection_id FROM collections WHERE collection_id = ? AND user_id = ?",
-        (collection_id, user_id),
-    )
-    if not cursor.fetchone():
+    if not owns_collection(user_id, collection_id):
         return []
     # Retrieve the chat history ordered by insertion.
     cursor.execute(
-        "SELECT role, content, timestamp FROM chat_history WHERE collection_id = ? ORDER BY id",
+        "SELECT role, content, timestamp, sources FROM chat_history WHERE collection_id = ? ORDER BY id",
         (collection_id,),
     )
     rows = cursor.fetchall()
-    print("The chat history retrieved is: " + str(rows))
-    return [{"role": row[0], "content": row[1], "timestamp": row[2]} for row in rows]
+    print(f"Retrieved {len(rows)} chat history messages.")
+    return [
+        {"role": row[0], "content": row[1], "timestamp": row[2], "sources": _load_sources(row[3])}
+        for row in rows
+    ]
+
+
+@timed_query("get_chat_history_page")
+def get_chat_history_page(user_id, collection_id, cursor_id=None, limit=50, newest_first=False):
+    """
+    One page of a collection's chat history using keyset pagination on
+    chat_history.id. Pass the returned nextCursor back as cursor_id to get
+    the following page; it is None once there is nothing left.
+    """
+    conn, cursor = get_cursor()
+    if not owns_collection(user_id, collection_id):
+        return {"messages": [], "nextCursor": None}
+
+    if newest_first:
+        query = "SELECT id, role, content, timestamp, sources FROM chat_history WHERE collection_id = ? AND id < ? ORDER BY id DESC LIMIT ?"
+        start = cursor_id if cursor_id is not None else 2**63 - 1
+    else:
+        query = "SELECT id, role, content, timestamp, sources FROM chat_history WHERE collection_id = ? AND id > ? ORDER BY id LIMIT ?"
+        start = cursor_id if cursor_id is not None else 0
+    # Fetch one extra row to know whether another page exists.
+    cursor.execute(query, (collection_id, start, limit + 1))
+    rows = cursor.fetchall()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    return {
+        "messages": [
+            {"id": row[0], "role": row[1], "content": row[2], "timestamp": row[3], "sources": _load_sources(row[4])}
+            for row in rows
+        ],
+        "nextCursor": rows[-1][0] if has_more else None,
+    }
+
+
+# Highlight markers snippet() puts around matches; control characters so they
+# can't clash with the message text, swapped for <mark> after escaping.
+_MATCH_START, _MATCH_END = "\x02", "\x03"
+MAX_SEARCH_TERMS = 16
+
+
+def search_query(text):
+    """
+    FTS5 query for what the user typed: every word as a quoted term, all of
+    them required, so FTS5 syntax in the input is matched literally.
+    """
+    terms = re.findall(r"\w+", text)[:MAX_SEARCH_TERMS]
+    return " ".join('"' + term + '"' for term in terms)
+
+
+def _highlight(snippet):
+    return html.escape(snippet).replace(_MATCH_START, "<mark>").replace(_MATCH_END, "</mark>")
+
+
+@timed_query("search_chat_history")
+def search_chat_history(user_id, text, offset=0, limit=20):
+    """
+    Messages in any of the user's collections that contain every word of
+    `text`, best match (bm25) first. Each hit has an HTML-escaped snippet
+    with the matches in <mark>. Pass the returned nextCursor back as
+    `offset` for the following page; it is None once there is nothing left.
+    """
+    terms = search_query(text)
+    if not terms:
+        return {"results": [], "nextCursor": None}
+    match = f'owner : "{user_id.encode("utf-8").hex()}" AND content : ({terms})'
+    conn, cursor = get_cursor()
+    # Rank and page inside the FTS table, then join the page's rows only.
+    cursor.execute(
+        f"""
+        SELECT hit.id, hit.snippet, hit.score, h.collection_id, c.name, h.role, h.timestamp
+        FROM (
+            SELECT rowid AS id, rank AS score,
+                   snippet(chat_history_fts, 0, '{_MATCH_START}', '{_MATCH_END}', '…', 16) AS snippet
+            FROM chat_history_fts WHERE chat_history_fts MATCH ? ORDER BY rank LIMIT ? OFFSET ?
+        ) hit
+        JOIN chat_history h ON h.id = hit.id
+        JOIN collections c ON c.collection_id = h.collection_id
+        ORDER BY hit.score
+        """,
+        (match, limit + 1, offset),
+    )
+    # One extra row tells whether another page exists.
+    rows = cursor.fetchall()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    return {
+        "results": [
+            {
+                "id": row[0],
+                "snippet": _highlight(row[1]),
+                "score": -row[2],
+                "collectionId": row[3],
+                "collectionName": row[4],
+                "role": row[5],
+                "timestamp": row[6],
+            }
+            for row in rows
+        ],
+        "nextCursor": offset + limit if has_more else None,
+    }
 
 
 # Example usage:
@@ -187,10 +747,13 @@ if __name__ == "__main__":
     history = get_chat_history(user_id, collection_id)
     print("Final chat history:", history)
 
+@timed_query("rename_collection")
+@retry_on_busy
 def rename_collection(user_id: str, collection_id: str, new_name: str):
     """
     Update the name of a collection owned by user_id.
     """
+    conn, cursor = get_cursor()
     cursor.execute(
         """
         UPDATE collections
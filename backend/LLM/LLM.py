@@ -1,147 +1,657 @@
 import os
+import signal
+import threading
+import time
+from bisect import bisect_right
+from functools import lru_cache
+from itertools import accumulate
 from operator import itemgetter
 from typing import Any, Dict, List
 from termcolor import colored
 import sys
-from LLM.chapterSplitting import getManualChunks
-
-# Download the local model from Hugging Face Hub
-from huggingface_hub import hf_hub_download
-model_path = hf_hub_download(
-    repo_id="TheBloke/TinyLlama-1.1B-Chat-v1.0-GGUF",
-    filename="tinyllama-1.1b-chat-v1.0.Q4_K_M.gguf",
-    cache_dir="."
+from LLM.chapterSplitting import fill_page_cache, getManualChunks, iter_chapter_pages, manual_chapters, MANUALS
+from LLM.indexSnapshots import IndexSnapshot, SnapshotStore
+from LLM.answerCache import SemanticAnswerCache
+from LLM.inferenceScheduler import (
+    InferenceScheduler,
+    QueueFullError,
+    DeadlineExceededError,
+    GenerationCancelled,
+    PRIORITY_INTERACTIVE,
 )
+from LLM.lazyComponents import LazyComponent, NotReadyError
+from LLM.historyBudget import format_history
+import metrics
 
-# Document loaders and text splitting
-from langchain_community.document_loaders import Docx2txtLoader, PyPDFLoader
-from langchain.text_splitter import RecursiveCharacterTextSplitter
+# Nothing heavy happens at import time: the model download, embeddings,
+# vector store and LLM are LazyComponents, loaded by start_warm_up() in the
+# background (or on first use from scripts like RunLLM.py).
 
 # Dynamically determine the current script directory and set the manuals directory.
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 manuals_dir = os.path.join(BASE_DIR, "./") 
 
+# The vector store lives in versioned snapshots (one Chroma shard per manual
+# each), built offline by buildIndex.py. The server serves the published one
+# and switches to a newer one on reload_index() without a restart.
+snapshot_store = SnapshotStore(
+    os.environ.get("INDEX_SNAPSHOT_DIR", "./index_snapshots"),
+    keep=int(os.environ.get("INDEX_SNAPSHOTS_KEPT", "2")),
+)
+RETRIEVER_BACKEND = os.environ.get("RETRIEVER_BACKEND", "chroma")
+# Questions not pinned to a manual search every shard (-1). Opt-in routing:
+# with a margin >= 0 only shards whose centroid is within that similarity of
+# the closest one are searched, which can miss the manual with the answer.
+SHARD_ROUTING_MARGIN = float(os.environ.get("SHARD_ROUTING_MARGIN", "-1"))
+# Storage precision of the mmap index: float32, float16 or int8. With
+# VECTOR_INDEX_RESCORE=1 a full-precision copy is kept to re-rank candidates.
+VECTOR_INDEX_DTYPE = os.environ.get("VECTOR_INDEX_DTYPE", "float32")
+VECTOR_INDEX_RESCORE = os.environ.get("VECTOR_INDEX_RESCORE", "0") == "1"
+
+N_CTX = 2048
+MAX_TOKENS = 256
+# Room kept for the retrieved chunks (k=3 chunks of ~500 characters).
+RETRIEVAL_TOKEN_RESERVE = 512
+# Chunks fetched per question. The context assembler keeps as many of them
+# as fit in the context window (CONTEXT_ASSEMBLER=0 pastes the first 3 whole).
+CONTEXT_ASSEMBLER = os.environ.get("CONTEXT_ASSEMBLER", "1") == "1"
+RETRIEVAL_K = int(os.environ.get("RETRIEVAL_K", "8" if CONTEXT_ASSEMBLER else "3"))
+# Opt-in decoding with drafts looked up in the prompt, see
+# LLM/speculativeDecoding.py. It samples with the model's own settings, so
+# answers follow the same distribution but are drawn differently. Needs
+# logits for every position (logits_all), which costs n_ctx * n_vocab floats
+# of memory.
+SPECULATIVE_DECODING = os.environ.get("SPECULATIVE_DECODING", "0") == "1"
+
+PROMPT_TEMPLATE = """
+    You are to act like a traffic simulation assistant. 
+    You will be given a question, previous chat history with the user, and information from a traffic simulation manual.
+    You need to analyze this information from the manual and answer the question asked.
 
-def getTextSplitted():
-    from langchain.docstore.document import Document
+    If the information provided isn't enough to answer the question asked then respond with "I don't know"
+
+    Answer consicely. 
+
+    Chat history:
+    {history}
+    Context:
+    {context}
+
+    Question: {question}
+
+    Answer:"""
+
+
+def make_splitter():
     from langchain.text_splitter import RecursiveCharacterTextSplitter
 
-    manual_chapters = getManualChunks()
-    splitter = RecursiveCharacterTextSplitter(
+    return RecursiveCharacterTextSplitter(
         separators=['\n\n', '\n'],
         chunk_size=500,
-        chunk_overlap=30
+        chunk_overlap=30,
+        add_start_index=True, # lets the context assembler merge neighbouring chunks
     )
 
+
+def split_chapter(chapter, metadata=None):
+    """
+    Splits a chapter into chunks. `chapter` is the chapter text or the list
+    of its page texts; given pages and the chapter's first page in
+    metadata["page_start"], every chunk gets the page span it covers.
+    """
+    from langchain.docstore.document import Document
+
+    metadata = metadata or {}
+    pages = [chapter] if isinstance(chapter, str) else chapter
+    doc = Document(page_content="".join(pages), metadata=metadata)
+    chunks = make_splitter().split_documents([doc])
+    if isinstance(chapter, str) or "page_start" not in metadata:
+        return chunks
+
+    page_ends = list(accumulate(len(page) for page in pages))
+    for chunk in chunks:
+        start = chunk.metadata["start_index"]
+        end = start + max(0, len(chunk.page_content) - 1)
+        chunk.metadata["page_start"] = metadata["page_start"] + bisect_right(page_ends, start)
+        chunk.metadata["page_end"] = metadata["page_start"] + bisect_right(page_ends, end)
+    return chunks
+
+
+def getTextSplitted():
+    manual_chapters = getManualChunks()
+
     final_chunks = []
     for chapter in manual_chapters:
-        doc = Document(page_content=chapter)
-        chunks = splitter.split_documents([doc])
-        final_chunks.extend(chunks)
+        final_chunks.extend(split_chapter(chapter))
 
     return final_chunks
 
 
+def _load_model_path():
+    # Download the local model from Hugging Face Hub
+    from huggingface_hub import hf_hub_download
+    return hf_hub_download(
+        repo_id="TheBloke/TinyLlama-1.1B-Chat-v1.0-GGUF",
+        filename="tinyllama-1.1b-chat-v1.0.Q4_K_M.gguf",
+        cache_dir="."
+    )
+
+
+def _load_embeddings():
+    from langchain_huggingface import HuggingFaceEmbeddings
+    return HuggingFaceEmbeddings()
+
+
+def _load_query_embeddings():
+    from LLM.queryEmbeddings import QueryEmbeddings
 
-from langchain_huggingface import HuggingFaceEmbeddings
-from langchain_community.vectorstores import Chroma
+    # Cached and micro-batched query embeddings; documents go straight through.
+    return QueryEmbeddings(
+        embeddings.get(),
+        max_entries=int(os.environ.get("QUERY_EMBEDDING_CACHE_SIZE", "1024")),
+        batch_window=float(os.environ.get("QUERY_EMBEDDING_BATCH_MS", "5")) / 1000,
+    )
 
-embeddings = HuggingFaceEmbeddings()
 
+def build_index_snapshot(publish=True):
+    """
+    Builds a new index snapshot from the manuals on disk, starting from a
+    copy of the published one so only new or changed chunks are embedded.
+    Publishing makes it the snapshot servers load on start and on
+    reload_index(). Returns the snapshot name.
+    """
+    def build(directory):
+        built = IndexSnapshot(os.path.basename(directory), directory, MANUALS, query_embeddings.get())
+        # Extract the pages of every manual in one pooled pass; the shards
+        # then read their chapters from the page cache.
+        fill_page_cache([manual["path"] for manual in MANUALS])
+        sync_stats = {}
+        for shard in built.shards.values():
+            sync_stats[shard.name] = shard.sync(
+                manual_chapters,
+                iter_chapter_pages,
+                split_chapter,
+                batch_size=int(os.environ.get("INGEST_BATCH_SIZE", "64")),
+            )
+            print(f"Chroma shard {shard.name} synced: {sync_stats[shard.name]}")
+        if RETRIEVER_BACKEND == "mmap":
+            built.vector_indexes(VECTOR_INDEX_DTYPE, VECTOR_INDEX_RESCORE)
+        info = {"version": built.version(), "sync": sync_stats}
+        built.close()
+        return info
+
+    name = snapshot_store.build(build, base=snapshot_store.current())
+    print(f"Built index snapshot {name}.")
+    if publish:
+        snapshot_store.publish(name)
+        print(f"Published index snapshot {name}.")
+    return name
+
+
+# Snapshots this process has opened and still holds a lease on, oldest first.
+_leased_snapshots = []
+
+
+def open_snapshot(name):
+    snapshot_store.acquire(name)
+    snapshot = IndexSnapshot(name, snapshot_store.path(name), MANUALS, query_embeddings.get())
+    _leased_snapshots.append(snapshot)
+    if RETRIEVER_BACKEND == "mmap":
+        snapshot.vector_indexes(VECTOR_INDEX_DTYPE, VECTOR_INDEX_RESCORE)
+    return snapshot
+
+
+def release_snapshot(snapshot):
+    """
+    Closes a snapshot that is no longer served and gives up the lease, so
+    garbage collection may delete it.
+    """
+    _leased_snapshots.remove(snapshot)
+    snapshot.close()
+    snapshot_store.release(snapshot.name)
+
+
+def _load_index():
+    if os.path.exists("./chroma_db"):
+        print("The store in ./chroma_db is no longer used (see ./index_snapshots) and can be deleted.")
+    name = snapshot_store.current()
+    if name is None:
+        # Nothing built with buildIndex.py yet: build the first one here.
+        name = build_index_snapshot()
+    print(f"Serving index snapshot {name}.")
+    return open_snapshot(name)
+
+
+def _load_llm():
+    from LLM.safeLlamaCpp import SafeLlamaCpp
+
+    return SafeLlamaCpp( #for tinyllama
+        model_path=model_path.get(),
+        n_ctx=N_CTX,
+        temperature=0.1,
+        max_tokens=MAX_TOKENS,
+        logits_all=SPECULATIVE_DECODING,
+        verbose=False
+    )
 
-persist_directory = "./chroma_db"  # Specify a directory to persist the database.
-if os.path.exists(persist_directory):
-    db = Chroma(persist_directory=persist_directory, embedding_function=embeddings)
-    print("Loaded existing Chroma database.")
-else:
-    text_splitted = getTextSplitted()
-    db = Chroma.from_documents(text_splitted, embeddings, persist_directory=persist_directory)
-    print("Created new Chroma database.")
-    db.persist() # persist to disk
 
+def make_retriever(snapshot):
+    """
+    Retriever for the answer pipeline: one retriever per manual shard behind
+    a ShardedRetriever that routes each question. RETRIEVER_BACKEND=mmap
+    swaps Chroma for the in-process memory-mapped exact-search index. Either
+    way the documents carry their chunk id and score in the metadata.
+    """
+    from LLM.vectorRetriever import ShardedRetriever
+
+    if RETRIEVER_BACKEND == "mmap":
+        from LLM.vectorRetriever import MmapRetriever
+        per_shard = {
+            name: MmapRetriever(index=index, embeddings=query_embeddings.get(), k=RETRIEVAL_K)
+            for name, index in snapshot.vector_indexes(VECTOR_INDEX_DTYPE, VECTOR_INDEX_RESCORE).items()
+        }
+    else:
+        from LLM.vectorRetriever import ChromaRetriever
+        per_shard = {
+            name: ChromaRetriever(collection=shard.collection, embeddings=query_embeddings.get(), k=RETRIEVAL_K) #higher k is the more info chroma will retrieve
+            for name, shard in snapshot.shards.items()
+        }
+    return ShardedRetriever(
+        shards=per_shard,
+        centroids={name: shard.centroid for name, shard in snapshot.shards.items() if shard.centroid is not None},
+        embeddings=query_embeddings.get(),
+        k=RETRIEVAL_K,
+        routing_margin=SHARD_ROUTING_MARGIN,
+    )
 
 
+def _load_pipeline():
+    from LLM.answerPipeline import AnswerPipeline
+
+    # Create a retriever from the vector store.
+    retriever = make_retriever(index.get())
+    # Built once: prompt, RetrievalQA chain and the cached preamble state.
+    decoder = None
+    if SPECULATIVE_DECODING:
+        from LLM.speculativeDecoding import PromptLookupDecoder
+        model = llm.get()
+        decoder = PromptLookupDecoder(
+            model.client,
+            MAX_TOKENS,
+            max_ngram=int(os.environ.get("SPECULATIVE_MAX_NGRAM", "3")),
+            max_draft=int(os.environ.get("SPECULATIVE_MAX_DRAFT", "8")),
+            # The same sampling llm.stream() does.
+            temperature=model.temperature,
+            top_k=model.top_k,
+            top_p=model.top_p,
+            repeat_penalty=model.repeat_penalty,
+            repeat_last_n=model.last_n_tokens_size,
+        )
+    assembler = None
+    if CONTEXT_ASSEMBLER:
+        from LLM.contextAssembler import ContextAssembler
+        assembler = ContextAssembler(
+            count_tokens,
+            duplicate_threshold=float(os.environ.get("CONTEXT_DUPLICATE_THRESHOLD", "0.85")),
+        )
+    pipeline = AnswerPipeline(
+        llm.get(), retriever, PROMPT_TEMPLATE, decoder, assembler, token_limit=N_CTX - MAX_TOKENS
+    )
+    pipeline.warm_up()
+    return pipeline
+
+
+def _load_answer_cache():
+    # Semantic answer cache in front of the pipeline. Set ANSWER_CACHE=0 to disable.
+    if os.environ.get("ANSWER_CACHE", "1") == "0":
+        return None
+    return SemanticAnswerCache(
+        query_embeddings.get(),
+        path=os.environ.get("ANSWER_CACHE_PATH", "./answer_cache.npz"),
+        index_fingerprint=index.get().version(),
+        threshold=float(os.environ.get("ANSWER_CACHE_THRESHOLD", "0.95")),
+        max_entries=int(os.environ.get("ANSWER_CACHE_MAX_ENTRIES", "512")),
+        ttl_seconds=float(os.environ.get("ANSWER_CACHE_TTL", str(7 * 24 * 3600))),
+        max_bytes=int(float(os.environ.get("ANSWER_CACHE_MAX_MB", "16")) * 1024 * 1024),
+        save_interval=float(os.environ.get("ANSWER_CACHE_SAVE_INTERVAL", "5")),
+    )
 
-# Create a retriever from the vector store.
-retriever = db.as_retriever(search_kwargs={"k": 3}) #higher this number is the more info chroma will retrieve
 
-# Define a custom prompt template to constrain the output.
+model_path = LazyComponent("model download", _load_model_path)
+embeddings = LazyComponent("embedding model", _load_embeddings)
+query_embeddings = LazyComponent("query embeddings", _load_query_embeddings)
+index = LazyComponent("vector store", _load_index)
+llm = LazyComponent("llm", _load_llm)
+pipeline = LazyComponent("answer pipeline", _load_pipeline)
+answer_cache = LazyComponent("answer cache", _load_answer_cache)
+COMPONENTS = [model_path, embeddings, query_embeddings, index, llm, pipeline, answer_cache]
 
-# Patch the LlamaCpp class to avoid the destructor error.
-from langchain_community.llms import LlamaCpp as BaseLlamaCpp
 
-class SafeLlamaCpp(BaseLlamaCpp):
-    def __del__(self):
+def warm_up():
+    """
+    Loads every component, the model and the vector store side by side.
+    Blocks until everything is ready.
+    """
+    llm_thread = threading.Thread(target=llm.get, name="warm-up-llm", daemon=True)
+    llm_thread.start()
+    answer_cache.get()  # embeddings -> vector store -> cache
+    llm_thread.join()
+    pipeline.get()
+
+
+def start_warm_up():
+    def run():
+        start = time.perf_counter()
         try:
-            # Attempt to call the underlying client's destructor if available.
-            if hasattr(self, "client") and hasattr(self.client, "__del__"):
-                self.client.__del__()
-        except Exception:
-            pass
-
-# Integrate the local LLM into a RetrievalQA chain using the patched class.
-from langchain.chains import RetrievalQA
-
-llm = SafeLlamaCpp( #for tinyllama
-    model_path=model_path,
-    n_ctx=2048,
-    temperature=0.1,
-    max_tokens=256,
-    verbose=False
+            warm_up()
+            print(f"Backend ready after {time.perf_counter() - start:.1f}s.", flush=True)
+        except Exception as e:
+            print("Warm-up failed:", str(e), flush=True)
+
+    thread = threading.Thread(target=run, name="warm-up", daemon=True)
+    thread.start()
+    return thread
+
+
+def is_ready():
+    return pipeline.loaded and answer_cache.loaded
+
+
+def ensure_ready():
+    """
+    Raises NotReadyError until warm-up has finished, so chat endpoints can
+    answer right away instead of blocking on model loading.
+    """
+    if not is_ready():
+        raise NotReadyError("The assistant is still warming up")
+
+
+def readiness():
+    return {
+        "ready": is_ready(),
+        "components": {component.name: component.status() for component in COMPONENTS},
+        "indexSnapshot": index.get().name if index.loaded else None,
+    }
+
+
+_reload_lock = threading.Lock()
+
+
+def reload_index():
+    """
+    Switches to the published index snapshot if it is not the one being
+    served, without a restart. The new snapshot is opened and its retriever
+    built first, then swapped in; requests that already retrieved (or are
+    retrieving) finish on the old one, which garbage collection leaves
+    alone until the next reload. Returns what was done.
+    """
+    with _reload_lock:
+        ensure_ready()
+        serving = index.get()
+        name = snapshot_store.current()
+        if name is None or name == serving.name:
+            return {"snapshot": serving.name, "previous": None, "changed": False}
+
+        start = time.perf_counter()
+        snapshot = open_snapshot(name)
+        retriever = make_retriever(snapshot)
+        index.replace(snapshot)
+        pipeline.get().retriever = retriever
+        _lookup_chunk.cache_clear()
+        cache = answer_cache.get()
+        if cache is not None:
+            cache.invalidate(snapshot.version())
+        # Keep the lease on the previous snapshot until the next reload, by
+        # then nothing is still answering from it.
+        while len(_leased_snapshots) > 2:
+            release_snapshot(_leased_snapshots[0])
+        deleted = snapshot_store.collect_garbage(in_use=(snapshot.name, serving.name))
+        seconds = round(time.perf_counter() - start, 3)
+        print(f"Switched from index snapshot {serving.name} to {name} in {seconds}s.", flush=True)
+        return {"snapshot": name, "previous": serving.name, "changed": True, "seconds": seconds, "deleted": deleted}
+
+
+def install_reload_signal():
+    """
+    Reloads the index on SIGHUP (kill -HUP <pid>). Must be called from the
+    main thread; the reload itself runs on a thread of its own.
+    """
+    def run():
+        try:
+            reload_index()
+        except Exception as e:
+            print("Index reload failed:", str(e), flush=True)
+
+    def handle(signum, frame):
+        threading.Thread(target=run, name="index-reload", daemon=True).start()
+
+    signal.signal(signal.SIGHUP, handle)
+
+
+# All generation goes through this scheduler instead of hitting llm from
+# every Flask thread at once.
+scheduler = InferenceScheduler(
+    workers=int(os.environ.get("INFERENCE_WORKERS", "1")),
+    max_queue=int(os.environ.get("INFERENCE_QUEUE_SIZE", "8")),
+    default_timeout=float(os.environ.get("INFERENCE_TIMEOUT", "120")),
 )
 
-#response quality went down by using context somehow
-def get_llm_response(query: str, context = "") -> str:
+
+def count_tokens(text: str) -> int:
     """
-    Takes a user query string and returns the LLM's best answer 
-    using the already-initialized qa_chain.
+    Number of llama tokens in text (no BOS). Only uses the vocabulary, so it
+    is safe to call while a generation is running.
     """
-    from langchain.prompts import PromptTemplate
-    prompt_template = """
-    You are to act like a traffic simulation assistant. 
-    You will be given a question, previous chat history with the user, and information from a traffic simulation manual.
-    You need to analyze this information from the manual and answer the question asked.
+    return len(llm.get_if_loaded().client.tokenize(text.encode("utf-8"), add_bos=False))
 
-    If the information provided isn't enough to answer the question asked then respond with "I don't know"
 
-    Answer consicely. 
+def count_tokens_batch(texts):
+    """
+    count_tokens for a list of texts, in one call (one round trip to the
+    model host in multi-worker mode).
+    """
+    return [count_tokens(text) for text in texts]
 
-    Context:
-    {context}
 
-    Question: {question}
+def history_token_budget(query: str) -> int:
+    """
+    Tokens left for chat history once the prompt template, the question,
+    the retrieved context and the generated answer are accounted for.
+    """
+    used = count_tokens(PROMPT_TEMPLATE) + count_tokens(query) + RETRIEVAL_TOKEN_RESERVE + MAX_TOKENS
+    return max(0, N_CTX - used)
 
-    Answer:"""
 
-    custom_prompt = PromptTemplate(
-        input_variables=["context", "query"],
-        template=prompt_template,
-    )
+def get_scheduler_stats():
+    stats = scheduler.stats()
+    if pipeline.loaded and pipeline.get().decoder is not None:
+        stats["speculative_decoding"] = pipeline.get().decoder.stats()
+    return stats
 
 
-    qa_chain = RetrievalQA.from_chain_type(
-    llm=llm,
-    chain_type="stuff",  # "stuff" works well for short answers.
-    retriever=retriever,
-    return_source_documents=True,
-    chain_type_kwargs={"prompt": custom_prompt}
-    )
-    try:
-        result = qa_chain.invoke({"query": query})
+def get_cache_stats():
+    if not answer_cache.loaded or answer_cache.get() is None:
+        return {"enabled": False}
+    return {"enabled": True, **answer_cache.get().stats()}
+
 
-        output = "=" * 55
-        output += " Chroma DB Retrieved Documents: \n"
-        for doc in result["source_documents"]:
-            output += "Page Content:\n"
-            output += f"{doc.page_content}\n"
-            output += "Metadata:\n"
-            output += f"{doc.metadata}\n"
-            output += "-" * 20 + "\n"
+def get_embedding_stats():
+    if not query_embeddings.loaded:
+        return {"loaded": False}
+    return {"loaded": True, **query_embeddings.get().stats()}
 
-        output += ("=" * 55)
 
-        retVal = result["result"] + "\n\n\n\n\n" + output
-        return retVal
+def source_refs(source_documents):
+    """
+    Compact references to the retrieved chunks: id, similarity score and
+    where the chunk comes from. The text itself is served by get_chunk().
+    """
+    refs = []
+    for doc in source_documents:
+        metadata = doc.metadata
+        refs.append(
+            {
+                "id": metadata.get("id"),
+                "score": round(metadata["score"], 4) if "score" in metadata else None,
+                "source": metadata.get("source"),
+                "manual": metadata.get("manual"),
+                "chapter": metadata.get("chapter"),
+                "pages": [metadata["page_start"], metadata["page_end"]] if "page_start" in metadata else None,
+            }
+        )
+    return refs
+
+
+@lru_cache(maxsize=1024)
+def _lookup_chunk(chunk_id):
+    # Chunk ids are content hashes, so a cached lookup never goes stale.
+    snapshot = index.get()
+    if RETRIEVER_BACKEND == "mmap":
+        for vectors in snapshot.vector_indexes(VECTOR_INDEX_DTYPE, VECTOR_INDEX_RESCORE).values():
+            if chunk_id in vectors.row_by_id:
+                row = vectors.row_by_id[chunk_id]
+                return {"id": chunk_id, "text": vectors.texts[row], "metadata": vectors.metadatas[row]}
+        return None
+    for shard in snapshot.shards.values():
+        found = shard.db.get(ids=[chunk_id], include=["documents", "metadatas"])
+        if found["ids"]:
+            return {"id": chunk_id, "text": found["documents"][0], "metadata": found["metadatas"][0]}
+    return None
+
+
+def get_chunk(chunk_id):
+    """
+    Text and metadata of one indexed chunk, or None if there is no such chunk.
+    """
+    ensure_ready()
+    return _lookup_chunk(chunk_id)
+
+
+def get_manuals():
+    """
+    The indexed manuals with their chapters, i.e. what a question can be
+    restricted to with the "manual" and "chapter" filters.
+    """
+    ensure_ready()
+    return [
+        {"id": shard.name, "title": shard.manual.get("title", shard.name), "chapters": shard.chapters()}
+        for shard in index.get().shards.values()
+    ]
+
+
+#response quality went down by using context somehow
+def get_llm_response(query: str, history=(), priority=PRIORITY_INTERACTIVE, timeout=None, filters=None) -> Dict[str, Any]:
+    """
+    Takes a user query string and returns the LLM's best answer 
+    using the already-initialized answer pipeline, as
+    {"answer": text, "sources": source_refs(...)}. `history` is the list of
+    earlier chat turns to put in the prompt (see select_recent_history).
+    Optional filters ({"manual": id, "chapter": number}) restrict retrieval
+    to one manual or one of its chapters.
+
+    Generation goes through the inference scheduler, so this raises
+    QueueFullError when the queue is full and DeadlineExceededError when the
+    answer is not ready within timeout seconds.
+    """
+    try:
+        ensure_ready()
+        # Cached answers are keyed on the question alone, so questions asked
+        # with history or filters neither use nor fill the cache.
+        cache = answer_cache.get() if not filters and not history else None
+        embedding = None
+        if cache is not None:
+            with metrics.timed_stage("cache"):
+                entry, embedding = cache.get(query)
+            if entry is not None:
+                print(f"Answer cache hit for: {query}")
+                return {"answer": entry["answer"], "sources": entry["sources"]}
+
+        start = time.perf_counter()
+        answer_pipeline = pipeline.get()
+        source_documents = answer_pipeline.retrieve(query, filters)
+        prompt, source_documents = answer_pipeline.build_prompt(query, source_documents, format_history(history))
+        # Streamed even though the caller waits for the whole answer: the
+        # deadline is checked on every token, so a request that times out
+        # stops generating instead of holding the model to the end.
+        tokens = scheduler.stream(answer_pipeline.stream, prompt, priority=priority, timeout=timeout)
+        try:
+            answer = "".join(tokens)
+        finally:
+            tokens.close()
+        sources = source_refs(source_documents)
+        if cache is not None:
+            cache.put(query, answer, sources, time.perf_counter() - start, embedding)
+
+        return {"answer": answer, "sources": sources}
+    except (QueueFullError, DeadlineExceededError, NotReadyError):
+        raise
     except Exception as e:
         print("Error in get_llm_response:", str(e))
-        return f"Error: {str(e)}"
+        return {"answer": f"Error: {str(e)}", "sources": []}
+
+
+def stream_llm_response(query: str, history=(), priority=PRIORITY_INTERACTIVE, timeout=None, cancel=None, filters=None):
+    """
+    Same as get_llm_response but the answer comes back as it is generated.
+
+    Returns a generator of events: ("token", text) while generating, then a
+    single ("sources", source_refs(...)) event and finally ("done", result)
+    where result is the same dict get_llm_response would have returned.
+
+    Admission to the scheduler happens before this returns, so a full queue
+    raises QueueFullError here rather than in the middle of the stream.
+    Setting the optional `cancel` event stops generation after the current
+    token and ends the stream without a "done" event.
+    """
+    ensure_ready()
+    cache = answer_cache.get() if not filters and not history else None
+    embedding = None
+    if cache is not None:
+        with metrics.timed_stage("cache"):
+            entry, embedding = cache.get(query)
+        if entry is not None:
+            print(f"Answer cache hit for: {query}")
+            return _cached_events(entry)
+
+    start = time.perf_counter()
+    answer_pipeline = pipeline.get()
+    try:
+        source_documents = answer_pipeline.retrieve(query, filters)
+    except ValueError as e:  # unknown manual or chapter filter
+        return _error_events(f"Error: {str(e)}")
+    prompt, source_documents = answer_pipeline.build_prompt(query, source_documents, format_history(history))
+    tokens = scheduler.stream(answer_pipeline.stream, prompt, priority=priority, timeout=timeout, cancel=cancel)
+    return _generated_events(query, tokens, source_documents, start, cache, embedding)
+
+
+def _error_events(message):
+    yield "error", message
+
+
+def _cached_events(entry):
+    yield "token", entry["answer"]
+    yield "sources", entry["sources"]
+    yield "done", {"answer": entry["answer"], "sources": entry["sources"]}
+
+
+def _generated_events(query, tokens, source_documents, start, cache, embedding):
+    try:
+        answer_parts = []
+        for token in tokens:
+            answer_parts.append(token)
+            yield "token", token
+
+        answer = "".join(answer_parts)
+        sources = source_refs(source_documents)
+        if cache is not None:
+            cache.put(query, answer, sources, time.perf_counter() - start, embedding)
+
+        yield "sources", sources
+        yield "done", {"answer": answer, "sources": sources}
+    except GenerationCancelled:
+        print("Generation cancelled, the client went away.")
+    except Exception as e:
+        print("Error in stream_llm_response:", str(e))
+        yield "error", f"Error: {str(e)}"
+    finally:
+        tokens.close()  # frees the model if the client went away mid-stream
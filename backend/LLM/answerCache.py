@@ -0,0 +1,264 @@
+import atexit
+import json
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+# Bumped when the entry layout changes; files in an older format are discarded.
+CACHE_FORMAT = 3
+
+
+def normalize_query(query):
+    """
+    Lowercases, collapses whitespace and drops trailing punctuation so that
+    "What is X?" and "what is  x" share a cache key.
+    """
+    query = re.sub(r"\s+", " ", query.strip().lower())
+    return query.rstrip("?!. ")
+
+
+class SemanticAnswerCache:
+    """
+    Answer cache keyed on the normalized query and its embedding.
+
+    A lookup first tries the exact normalized text, then falls back to the
+    most similar cached query (cosine similarity of the embeddings) and counts
+    as a hit when it is above `threshold`. Entries expire after `ttl_seconds`,
+    the least recently used ones are evicted past `max_entries` or
+    `max_bytes`. The embeddings live, normalized, in rows of a float32 matrix
+    allocated once for `max_entries`, so a lookup is a single matrix-vector
+    product. The cache is persisted (an .npz with the matrix and the entries as
+    JSON) by a background thread every `save_interval` seconds when it changed,
+    and at exit, never on the request path. The cache is tied to an index
+    fingerprint: if the index gets rebuilt the fingerprint changes and every
+    stored answer is dropped.
+    """
+
+    def __init__(
+        self,
+        embeddings,
+        path,
+        index_fingerprint,
+        threshold=0.95,
+        max_entries=512,
+        ttl_seconds=7 * 24 * 3600,
+        max_bytes=16 * 1024 * 1024,
+        save_interval=5.0,
+    ):
+        self.embeddings = embeddings
+        self.path = path
+        self.index_fingerprint = index_fingerprint
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.save_interval = save_interval
+
+        self.entries = OrderedDict()  # normalized query -> entry dict
+        self.total_bytes = 0
+        self.hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self.saved_seconds = 0.0
+        self._lock = threading.Lock()
+        # Allocated on the first insert, once the embedding size is known.
+        self._matrix = None
+        self._used = np.zeros(max_entries, dtype=bool)
+        self._row_keys = [None] * max_entries
+        self._free_rows = list(range(max_entries - 1, -1, -1))
+        self._dirty = False
+        self._save_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._load()
+        self._thread = threading.Thread(target=self._run, name="answer-cache-writer", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    # ---- persistence ----
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with np.load(self.path, allow_pickle=False) as f:
+                data = json.loads(str(f["meta"]))
+                embeddings = f["embeddings"]
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Could not read answer cache, starting empty: {e}")
+            return
+        if data.get("format") != CACHE_FORMAT:
+            print("Answer cache was written in an older format, discarding it.")
+            return
+        if data.get("index_fingerprint") != self.index_fingerprint:
+            print("Vector index changed since the answer cache was written, discarding it.")
+            return
+        now = time.time()
+        for entry, embedding in zip(data.get("entries", []), embeddings):
+            if now - entry["created"] <= self.ttl_seconds:
+                self._insert(entry, embedding)
+        print(f"Loaded {len(self.entries)} cached answers.")
+
+    def save(self):
+        """
+        Writes the cache to `path` if it changed since the last save.
+        """
+        with self._save_lock:
+            with self._lock:
+                if not self._dirty:
+                    return
+                entries = list(self.entries.values())
+                rows = [entry["row"] for entry in entries]
+                embeddings = self._matrix[rows] if self._matrix is not None else np.zeros((0, 0), np.float32)
+                meta = {
+                    "format": CACHE_FORMAT,
+                    "index_fingerprint": self.index_fingerprint,
+                    "entries": [
+                        {k: v for k, v in entry.items() if k not in ("row", "size")} for entry in entries
+                    ],
+                }
+                self._dirty = False
+            # Written outside the cache lock so lookups don't wait on the disk.
+            tmp_path = self.path + ".tmp"
+            try:
+                with open(tmp_path, "wb") as f:
+                    np.savez(f, embeddings=embeddings, meta=np.array(json.dumps(meta)))
+                os.replace(tmp_path, self.path)
+            except OSError as e:
+                print(f"Could not write answer cache: {e}")
+                with self._lock:
+                    self._dirty = True
+
+    def _run(self):
+        while not self._stop.wait(self.save_interval):
+            self.save()
+
+    def close(self):
+        self._stop.set()
+        self.save()
+
+    # ---- bookkeeping ----
+
+    @staticmethod
+    def _entry_size(entry, dimensions):
+        # Rough in-memory footprint: the text plus the float32 embedding row.
+        return len(entry["answer"]) + len(json.dumps(entry["sources"])) + 4 * dimensions
+
+    def _insert(self, entry, embedding):
+        embedding = np.asarray(embedding, dtype=np.float32)
+        if self._matrix is None:
+            self._matrix = np.zeros((self.max_entries, embedding.shape[0]), dtype=np.float32)
+        key = entry["key"]
+        if key in self.entries:
+            self._remove(key)
+        entry["size"] = self._entry_size(entry, embedding.shape[0])
+        # Make room for the row first, then trim to the byte budget.
+        while len(self.entries) >= self.max_entries:
+            self._remove(next(iter(self.entries)))
+        row = self._free_rows.pop()
+        self._matrix[row] = embedding / max(float(np.linalg.norm(embedding)), 1e-12)
+        self._used[row] = True
+        self._row_keys[row] = key
+        entry["row"] = row
+        self.entries[key] = entry
+        self.total_bytes += entry["size"]
+        self._dirty = True
+        while self.entries and self.total_bytes > self.max_bytes:
+            self._remove(next(iter(self.entries)))
+
+    def _remove(self, key):
+        entry = self.entries.pop(key)
+        self.total_bytes -= entry["size"]
+        self._used[entry["row"]] = False
+        self._row_keys[entry["row"]] = None
+        self._free_rows.append(entry["row"])
+        self._dirty = True
+
+    def _expired(self, entry, now):
+        return now - entry["created"] > self.ttl_seconds
+
+    def _most_similar(self, embedding):
+        if not self.entries:
+            return None, 0.0
+        query = np.asarray(embedding, dtype=np.float32)
+        scores = self._matrix @ query / max(float(np.linalg.norm(query)), 1e-12)
+        scores[~self._used] = -np.inf
+        best = int(np.argmax(scores))
+        return self._row_keys[best], float(scores[best])
+
+    # ---- public API ----
+
+    def get(self, query):
+        """
+        Returns (entry, embedding). entry is None on a miss; embedding is the
+        query embedding computed for the lookup (None for exact-text hits) so
+        that put() does not need to embed the query a second time.
+        """
+        key = normalize_query(query)
+        now = time.time()
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is not None and not self._expired(entry, now):
+                self.entries.move_to_end(key)
+                self._record_hit(entry)
+                return entry, None
+
+        embedding = self.embeddings.embed_query(key)
+
+        with self._lock:
+            best_key, score = self._most_similar(embedding)
+            if best_key is not None and score >= self.threshold:
+                entry = self.entries[best_key]
+                if self._expired(entry, now):
+                    self._remove(best_key)
+                else:
+                    self.entries.move_to_end(best_key)
+                    self.semantic_hits += 1
+                    self._record_hit(entry)
+                    return entry, embedding
+            self.misses += 1
+        return None, embedding
+
+    def _record_hit(self, entry):
+        self.hits += 1
+        self.saved_seconds += entry["generation_seconds"]
+
+    def put(self, query, answer, sources, generation_seconds, embedding=None):
+        key = normalize_query(query)
+        if embedding is None:
+            embedding = self.embeddings.embed_query(key)
+        entry = {
+            "key": key,
+            "answer": answer,
+            "sources": sources,
+            "generation_seconds": generation_seconds,
+            "created": time.time(),
+        }
+        with self._lock:
+            self._insert(entry, embedding)
+
+    def invalidate(self, index_fingerprint=None):
+        """
+        Drops every cached answer, e.g. after the vector index was rebuilt.
+        """
+        with self._lock:
+            for key in list(self.entries):
+                self._remove(key)
+            if index_fingerprint is not None:
+                self.index_fingerprint = index_fingerprint
+            self._dirty = True
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "bytes": self.total_bytes,
+            "hits": self.hits,
+            "semantic_hits": self.semantic_hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "saved_generation_seconds": round(self.saved_seconds, 3),
+        }
@@ -0,0 +1,129 @@
+import threading
+import time
+
+from langchain.prompts import PromptTemplate
+
+import metrics
+from LLM.promptCache import PrefixStateCache
+
+
+class AnswerPipeline:
+    """
+    Long-lived retrieval + generation pipeline.
+
+    The prompt is built once at startup instead of on every request and the
+    "stuff" retrieval step (retrieve, paste the chunks into the prompt,
+    generate) is done here directly so every stage can be timed. A
+    PrefixStateCache keeps the instruction preamble of the
+    prompt evaluated in the llama.cpp context so only the retrieved context and
+    the question need prefill. With a `decoder` (PromptLookupDecoder) the
+    answer is decoded with prompt-lookup drafts instead of through
+    llm.stream(). With an `assembler` (ContextAssembler) the retrieved chunks
+    are packed into whatever the prompt (chat history included) leaves of
+    `token_limit` (the context window minus the answer) instead of being
+    pasted in whole.
+    """
+
+    def __init__(self, llm, retriever, prompt_template, decoder=None, assembler=None, token_limit=None):
+        self.llm = llm
+        self.decoder = decoder
+        self.assembler = assembler
+        self.token_limit = token_limit
+        self.retriever = retriever
+        self.prompt_template = prompt_template
+        self.prompt = PromptTemplate(
+            input_variables=["history", "context", "question"],
+            template=prompt_template,
+        )
+        # Everything before the first placeholder is identical for every request.
+        preamble = prompt_template.split("{", 1)[0]
+        # Cut on a line break so the tokenization of the snapshot matches the
+        # start of the full prompt.
+        preamble = preamble[: preamble.rfind("\n") + 1]
+        self.prefix_cache = PrefixStateCache(llm.client, preamble)
+        # One generation at a time on the shared llama.cpp context.
+        self.lock = threading.Lock()
+
+    def warm_up(self):
+        with self.lock:
+            self.prefix_cache.warm_up()
+
+    def invoke(self, query, filters=None, history=""):
+        """
+        Answers one query, returns a RetrievalQA-style result dict
+        ("result" and "source_documents").
+        """
+        source_documents = self.retrieve(query, filters)
+        prompt, source_documents = self.build_prompt(query, source_documents, history)
+        answer = "".join(self.stream(prompt))
+        return {"result": answer, "source_documents": source_documents}
+
+    def retrieve(self, query, filters=None):
+        """
+        Retrieves the chunks for a query; `filters` ({"manual", "chapter"})
+        pins it to a manual or chapter, see ShardedRetriever.retrieve.
+        """
+        with metrics.timed_stage("retrieval"):
+            if filters:
+                source_documents = self.retriever.retrieve(query, **filters)
+            else:
+                source_documents = self.retriever.invoke(query)
+        metrics.retrieved_documents.observe(len(source_documents))
+        return source_documents
+
+    def count_tokens(self, text, add_bos=False):
+        return len(self.llm.client.tokenize(text.encode("utf-8"), add_bos=add_bos))
+
+    def build_prompt(self, query, source_documents, history=""):
+        """
+        Returns the prompt and the documents that actually made it into it.
+        `history` is the chat history text (see historyBudget.format_history).
+        """
+        if self.assembler is None:
+            doc_context = "\n\n".join(doc.page_content for doc in source_documents)
+            return self.prompt.format(history=history, context=doc_context, question=query), source_documents
+
+        empty = self.prompt.format(history=history, context="", question=query)
+        budget = self.token_limit - self.count_tokens(empty, True)
+        while True:
+            context, used_documents = self.assembler.assemble(source_documents, budget)
+            prompt = self.prompt.format(history=history, context=context, question=query)
+            # Pieces tokenize slightly differently once joined: re-check the whole.
+            overflow = self.count_tokens(prompt, True) - self.token_limit
+            if overflow <= 0 or not context:
+                break
+            budget -= overflow
+        metrics.annotate(context_chunks=len(used_documents))
+        return prompt, used_documents
+
+    def stream(self, prompt):
+        """
+        Yields generated text pieces for an already built prompt. The model
+        lock is held until the generator is exhausted or closed.
+        """
+        with self.lock:
+            self.prefix_cache.restore()
+            prompt_tokens = len(self.llm.client.tokenize(prompt.encode("utf-8")))
+            metrics.tokens_in_total.inc(prompt_tokens)
+            metrics.annotate(prompt_tokens=prompt_tokens)
+
+            start = time.perf_counter()
+            first_token_at = None
+            generated = 0
+            try:
+                tokens = self.decoder.generate(prompt) if self.decoder is not None else self.llm.stream(prompt)
+                for token in tokens:
+                    if first_token_at is None:
+                        # Time to first token is (almost all) prompt prefill.
+                        first_token_at = time.perf_counter()
+                        metrics.record_stage("prefill", first_token_at - start)
+                    generated += 1
+                    yield token
+            finally:
+                if first_token_at is not None:
+                    elapsed = time.perf_counter() - first_token_at
+                    metrics.record_stage("generation", elapsed)
+                    metrics.tokens_out_total.inc(generated)
+                    metrics.annotate(generated_tokens=generated)
+                    if elapsed > 0:
+                        metrics.tokens_per_second.observe(generated / elapsed)
@@ -1,5 +1,306 @@
+import json
+import multiprocessing
+import os
+import re
+import statistics
+from concurrent.futures import ProcessPoolExecutor
+
 import fitz  # PyMuPDF
 
+from LLM.indexManifest import file_sha256
+
+# Extracted page text is cached here, one directory per PDF content hash.
+PAGE_CACHE_DIR = os.environ.get("PAGE_CACHE_DIR", "./page_cache")
+# Below this many uncached pages it is faster to stay in-process.
+MIN_PAGES_PER_POOL = 16
+# Without an outline, a page starts a chapter when it has text set at least
+# this many times the document's body font size (chapter titles are 20pt on
+# 10pt body text in the INTEGRATION manuals, the cover 18pt, sections 14pt).
+HEADING_SIZE_RATIO = float(os.environ.get("CHAPTER_HEADING_SIZE_RATIO", "1.9"))
+MAX_TITLE_CHARS = 120
+
+
+def _write_page(page_dir, page_num, text):
+    tmp_path = os.path.join(page_dir, f"{page_num}.txt.tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp_path, os.path.join(page_dir, f"{page_num}.txt"))
+
+
+def _cache_page_range(pdf_path, page_dir, start, end):
+    """
+    Worker for _extract_missing: extracts pages [start, end) into the page
+    cache and returns how many it wrote. Every worker opens its own handle
+    since fitz documents can't be shared across processes, and writes the
+    text itself so it never travels back to the parent.
+    """
+    os.makedirs(page_dir, exist_ok=True)
+    doc = fitz.open(pdf_path)
+    try:
+        for page_num in range(start, end):
+            _write_page(page_dir, page_num, doc[page_num].get_text())
+    finally:
+        doc.close()
+    return end - start
+
+
+def _split_ranges(page_nums, parts):
+    # Groups sorted page numbers into at most `parts` contiguous [start, end) runs.
+    size = max(1, -(-len(page_nums) // parts))
+    ranges = []
+    for i in range(0, len(page_nums), size):
+        group = page_nums[i:i + size]
+        # Split further wherever the group is not contiguous.
+        start = prev = group[0]
+        for page_num in group[1:]:
+            if page_num != prev + 1:
+                ranges.append((start, prev + 1))
+                start = page_num
+            prev = page_num
+        ranges.append((start, prev + 1))
+    return ranges
+
+
+def _page_count(pdf_path):
+    doc = fitz.open(pdf_path)
+    try:
+        return doc.page_count
+    finally:
+        doc.close()
+
+
+def _missing_pages(page_dir, page_range):
+    return [
+        page_num for page_num in range(*page_range)
+        if not os.path.exists(os.path.join(page_dir, f"{page_num}.txt"))
+    ]
+
+
+def _extract_missing(jobs, workers=None, pool=None):
+    """
+    Extracts the pages of jobs ([(pdf path, page dir, missing page numbers)])
+    into the page cache, over a process pool when there are enough of them
+    to be worth it.
+    """
+    workers = workers or int(os.environ.get("PDF_EXTRACT_WORKERS", os.cpu_count() or 1))
+    total = sum(len(missing) for _, _, missing in jobs)
+    if workers > 1 and total >= MIN_PAGES_PER_POOL:
+        own_pool = pool is None
+        if own_pool:
+            # Spawned, not forked: the first snapshot can be built inside the
+            # running server, and a fork would copy locks its other threads hold.
+            pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+        try:
+            futures = [
+                pool.submit(_cache_page_range, pdf_path, page_dir, start, end)
+                for pdf_path, page_dir, missing in jobs
+                # Each PDF gets its share of the workers.
+                for start, end in _split_ranges(missing, max(1, round(workers * len(missing) / total)))
+            ]
+            for future in futures:
+                future.result()
+        finally:
+            if own_pool:
+                pool.shutdown()
+    else:
+        for pdf_path, page_dir, missing in jobs:
+            for start, end in _split_ranges(missing, 1):
+                _cache_page_range(pdf_path, page_dir, start, end)
+
+
+def fill_page_cache(pdf_paths, workers=None, cache_dir=PAGE_CACHE_DIR, pool=None):
+    """
+    Makes sure every page of the given PDFs is in the page cache, extracting
+    the missing pages of all of them in one pass. Returns {path: file sha256}.
+    """
+    hashes = {}
+    jobs = []
+    for pdf_path in pdf_paths:
+        hashes[pdf_path] = file_sha256(pdf_path)
+        page_dir = os.path.join(cache_dir, hashes[pdf_path])
+        missing = _missing_pages(page_dir, (0, _page_count(pdf_path)))
+        if missing:
+            jobs.append((pdf_path, page_dir, missing))
+    _extract_missing(jobs, workers, pool)
+    for pdf_path, _, missing in jobs:
+        print(f"Extracted {len(missing)} pages from {pdf_path}.")
+    return hashes
+
+
+def extract_page_texts(pdf_path, page_range=None, workers=None, cache_dir=PAGE_CACHE_DIR,
+                       file_hash=None, pool=None):
+    """
+    Returns the text of the pages in page_range ([start, end), default: the
+    whole PDF).
+
+    Pages are cached on disk under cache_dir/<file sha256>/<page>.txt so an
+    unchanged PDF is never parsed twice. Uncached pages are fanned out over a
+    process pool when there are enough of them to be worth it; pass `pool` to
+    reuse one executor across calls.
+    """
+    page_dir = os.path.join(cache_dir, file_hash or file_sha256(pdf_path))
+    if page_range is None:
+        page_range = (0, _page_count(pdf_path))
+
+    missing = _missing_pages(page_dir, page_range)
+    if missing:
+        _extract_missing([(pdf_path, page_dir, missing)], workers, pool)
+        print(f"Extracted {len(missing)} pages from {pdf_path} ({page_range[1] - page_range[0] - len(missing)} cached).")
+
+    texts = []
+    for page_num in range(*page_range):
+        with open(os.path.join(page_dir, f"{page_num}.txt"), "r", encoding="utf-8") as f:
+            texts.append(f.read())
+    return texts
+
+
+def chapter_page_ranges(page_count, page_numbers):
+    """
+    Turns chapter end pages into [start, end) page ranges, clamped to the
+    document. Pages past the last chapter end become one extra chapter.
+    """
+    ranges = []
+    start_page = 0
+    for end_page in page_numbers:
+        for page_num in range(max(start_page, page_count), end_page):
+            print(f"Warning: Page {page_num} out of bounds.")
+        ranges.append((min(start_page, page_count), min(end_page, page_count)))
+        start_page = end_page
+
+    if start_page < page_count: #add any remaining pages.
+        ranges.append((start_page, page_count))
+    return ranges
+
+
+def _outline_starts(doc):
+    # Top-level bookmarks as (first page, title).
+    return [
+        (page - 1, title.strip())
+        for level, title, page in doc.get_toc(simple=True)
+        if level == 1 and page >= 1
+    ]
+
+
+def _heading_starts(doc, size_ratio):
+    # Pages with heading-sized text as (page, heading text).
+    pages = [
+        [
+            span
+            for block in doc[page_num].get_text("dict")["blocks"]
+            for line in block.get("lines", [])
+            for span in line["spans"]
+            if span["text"].strip()
+        ]
+        for page_num in range(doc.page_count)
+    ]
+    # Most common size by amount of text, so tables and footers don't count.
+    sizes = [round(span["size"]) for spans in pages for span in spans for _ in span["text"]]
+    if not sizes:
+        return []
+    body_size = statistics.mode(sizes)
+    starts = []
+    for page_num, spans in enumerate(pages):
+        heading = [
+            span["text"].strip()
+            for span in spans
+            # Skip symbol glyphs (large sigmas in formulas and the like).
+            if span["size"] >= body_size * size_ratio and re.search(r"[A-Za-z]{2}", span["text"])
+        ]
+        if heading:
+            starts.append((page_num, " ".join(heading)))
+    return starts
+
+
+def _chapters_from_starts(starts, page_count):
+    chapters = []
+    for start, title in sorted(starts):
+        if start >= page_count or (chapters and chapters[-1]["start_page"] == start):
+            continue
+        chapters.append({"title": title[:MAX_TITLE_CHARS], "start_page": start})
+    if not chapters or chapters[0]["start_page"] > 0:
+        chapters.insert(0, {"title": "Front matter", "start_page": 0})
+    for chapter, following in zip(chapters, chapters[1:] + [{"start_page": page_count}]):
+        chapter["end_page"] = following["start_page"]
+    return chapters
+
+
+def detect_chapters(pdf_path, cache_dir=PAGE_CACHE_DIR, file_hash=None, size_ratio=HEADING_SIZE_RATIO):
+    """
+    Chapters of a PDF as a list of {"title", "start_page", "end_page"} dicts
+    ([start_page, end_page), 0-based), covering every page.
+
+    Chapter boundaries come from the top-level entries of the PDF outline.
+    PDFs without one (like the INTEGRATION manuals) fall back to heading
+    detection by font size, see HEADING_SIZE_RATIO. The result is cached next
+    to the extracted pages.
+    """
+    page_dir = os.path.join(cache_dir, file_hash or file_sha256(pdf_path))
+    cache_path = os.path.join(page_dir, "outline.json")
+    if os.path.exists(cache_path):
+        with open(cache_path, "r", encoding="utf-8") as f:
+            cached = json.load(f)
+        if cached.get("size_ratio") == size_ratio:
+            return cached["chapters"]
+
+    doc = fitz.open(pdf_path)
+    try:
+        starts = _outline_starts(doc)
+        method = "outline"
+        if not starts:
+            starts = _heading_starts(doc, size_ratio)
+            method = "headings"
+        chapters = _chapters_from_starts(starts, doc.page_count)
+    finally:
+        doc.close()
+    print(f"Found {len(chapters)} chapters in {pdf_path} (from {method}).")
+
+    os.makedirs(page_dir, exist_ok=True)
+    tmp_path = cache_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"size_ratio": size_ratio, "chapters": chapters}, f)
+    os.replace(tmp_path, cache_path)
+    return chapters
+
+
+def manual_chapters(manual):
+    """
+    Chapter list of an entry in MANUALS: detected from the PDF, unless the
+    entry pins chapter end pages with "page_numbers".
+    """
+    if manual.get("page_numbers"):
+        page_count = _page_count(manual["path"])
+        return [
+            {"title": f"Pages {start + 1}-{end}", "start_page": start, "end_page": end}
+            for start, end in chapter_page_ranges(page_count, manual["page_numbers"])
+        ]
+    return detect_chapters(manual["path"])
+
+
+def iter_chapter_pages(pdf_path, chapters):
+    """
+    Yields the page texts of each chapter (a list per chapter) one chapter
+    at a time so only a single chapter's text is held in memory. The whole
+    PDF is extracted into the page cache first, in one pooled pass (chapters
+    are often only a few pages, too few to be worth a pool each), and the
+    chapters are then read back from the cache.
+    """
+    file_hash = fill_page_cache([pdf_path])[pdf_path]
+    for chapter in chapters:
+        yield extract_page_texts(pdf_path, (chapter["start_page"], chapter["end_page"]), file_hash=file_hash)
+
+
+def iter_chapters(pdf_path, page_numbers):
+    """
+    Yields the text of the chapters ending on page_numbers, one at a time.
+    """
+    page_count = _page_count(pdf_path)
+    chapters = [
+        {"start_page": start, "end_page": end} for start, end in chapter_page_ranges(page_count, page_numbers)
+    ]
+    for pages in iter_chapter_pages(pdf_path, chapters):
+        yield "".join(pages)
+
+
 def extract_chapters_by_page_numbers(pdf_path, page_numbers):
     """
     Extracts chapters from a PDF based on provided page numbers.
@@ -12,49 +313,40 @@ def extract_chapters_by_page_numbers(pdf_path, page_numbers):
         list: A list of strings, where each string represents a chapter.
     """
     try:
-        doc = fitz.open(pdf_path)
-        chapters = []
-        start_page = 0
-
-        for end_page in page_numbers:
-            chapter_text = ""
-            for page_num in range(start_page, end_page):
-                if 0 <= page_num < doc.page_count: #prevent out of bounds errors.
-                    page = doc[page_num]
-                    chapter_text += page.get_text()
-                else:
-                    print(f"Warning: Page {page_num} out of bounds.")
-            chapters.append(chapter_text)
-            start_page = end_page
-
-        if start_page < doc.page_count: #add any remaining pages.
-            chapter_text = ""
-            for page_num in range(start_page, doc.page_count):
-                page = doc[page_num]
-                chapter_text += page.get_text()
-            chapters.append(chapter_text)
-
-        doc.close()
-        return chapters
+        return list(iter_chapters(pdf_path, page_numbers))
 
     except Exception as e:
         print(f"An error occurred: {e}")
         return []
 
 
-def getFirstManual():
-    # Example usage:
-    pdf_file = "./INTEGRATION_Manual_1.pdf"
-    page_numbers = [1, 2, 4, 5, 8, 12, 30, 51, 59, 61]  # Example page numbers (chapter ends)
-    chapter_strings = extract_chapters_by_page_numbers(pdf_file, page_numbers)
-    return chapter_strings
+# Manuals that get indexed. Every manual is its own shard of the vector
+# store, named by "id". Chapters are detected from the PDF (see
+# detect_chapters); add "page_numbers" (chapter end pages) to pin them.
+MANUALS = [
+    {
+        "id": "volume-1",
+        "path": "./INTEGRATION_Manual_1.pdf",
+        "title": "INTEGRATION User's Guide Volume I: Fundamental Model Features",
+    },
+    {
+        "id": "volume-2",
+        "path": "./INTEGRATION_Manual_2.pdf",
+        "title": "INTEGRATION User's Guide Volume II: Advanced Model Features",
+    },
+]
+
+
+def get_manual_chapters(manual):
+    """
+    Returns the chapter strings of one manual.
+    """
+    chapters = manual_chapters(manual)
+    return ["".join(pages) for pages in iter_chapter_pages(manual["path"], chapters)]
 
-def getSecondManual():
-    # Example usage:
-    pdf_file = "./INTEGRATION_Manual_2.pdf"
-    page_numbers = [1, 2, 4, 5, 8, 12, 30, 51, 59, 61]  # NEED TO ACTUALLY FIX THESE VALUES!!
-    chapter_strings = extract_chapters_by_page_numbers(pdf_file, page_numbers)
-    return chapter_strings
 
 def getManualChunks():
-    return getFirstManual() + getSecondManual()
\ No newline at end of file
+    chapter_strings = []
+    for manual in MANUALS:
+        chapter_strings.extend(get_manual_chapters(manual))
+    return chapter_strings
@@ -0,0 +1,169 @@
+import re
+
+# Shortest run of characters treated as the splitter's chunk overlap.
+MIN_OVERLAP_CHARS = 15
+MAX_OVERLAP_CHARS = 300
+# Chunks whose offsets are at most this far apart are adjacent (the splitter
+# drops the line breaks it splits on).
+ADJACENT_GAP_CHARS = 2
+
+
+def _words(text):
+    return set(re.findall(r"\w+", text.lower()))
+
+
+def _overlap(left, right):
+    """
+    Length of the longest suffix of `left` that is also a prefix of `right`.
+    """
+    for size in range(min(len(left), len(right), MAX_OVERLAP_CHARS), MIN_OVERLAP_CHARS - 1, -1):
+        if left.endswith(right[:size]):
+            return size
+    return 0
+
+
+class _Span:
+    """
+    A piece of context: one chunk, or several chunks of the same chapter
+    merged where they overlap.
+    """
+
+    def __init__(self, doc):
+        self.text = doc.page_content
+        self.documents = [doc]
+        self.score = doc.metadata.get("score") or 0.0
+        self.key = (doc.metadata.get("source"), doc.metadata.get("chapter"))
+        # Character offset in the chapter, for chunks split with add_start_index.
+        self.start = doc.metadata.get("start_index")
+        self.end = self.start + len(self.text) if self.start is not None else None
+
+    def _merge_by_offsets(self, other):
+        first, second = sorted((self, other), key=lambda s: s.start)
+        if second.start > first.end + ADJACENT_GAP_CHARS:
+            return None
+        if second.end <= first.end:
+            return first.text
+        if second.start >= first.end:
+            return first.text + "\n" + second.text
+        return first.text + second.text[first.end - second.start:]
+
+    def absorb(self, other):
+        """
+        Merges `other` into this span if they belong together. Returns True
+        if it did.
+        """
+        if self.key != other.key:
+            return False
+        if self.start is not None and other.start is not None:
+            merged = self._merge_by_offsets(other)
+            if merged is None:
+                return False
+            self.start, self.end = min(self.start, other.start), max(self.end, other.end)
+        elif other.text in self.text:
+            merged = self.text
+        elif self.text in other.text:
+            merged = other.text
+        elif _overlap(self.text, other.text):
+            merged = self.text + other.text[_overlap(self.text, other.text):]
+        elif _overlap(other.text, self.text):
+            merged = other.text + self.text[_overlap(other.text, self.text):]
+        else:
+            return False
+        if self.start is None or other.start is None:
+            self.start = self.end = None
+        self.text = merged
+        self.documents += other.documents
+        self.score = max(self.score, other.score)
+        return True
+
+
+class ContextAssembler:
+    """
+    Packs retrieved chunks into the token budget left in the context window.
+
+    Candidates arrive best first (more than will fit, the retriever fetches
+    extra). Chunks of the same chapter that overlap or contain each other
+    are merged into one span, spans that are near-duplicates of a better one
+    (word Jaccard similarity above `duplicate_threshold`) are dropped, and
+    the rest are added by score for as long as they fit in the budget, so the
+    number of chunks adapts to how long they are. Every piece is measured
+    with the model's tokenizer through `count_tokens`.
+    """
+
+    def __init__(self, count_tokens, duplicate_threshold=0.85, separator="\n\n"):
+        self.count_tokens = count_tokens
+        self.duplicate_threshold = duplicate_threshold
+        self.separator = separator
+
+    def merge(self, documents):
+        spans = []
+        for doc in documents:
+            span = _Span(doc)
+            for existing in spans:
+                if existing.absorb(span):
+                    break
+            else:
+                spans.append(span)
+        # A merge can make a span overlap another one: repeat until stable.
+        merged = True
+        while merged:
+            merged = False
+            for i, span in enumerate(spans):
+                for other in spans[i + 1:]:
+                    if span.absorb(other):
+                        spans.remove(other)
+                        merged = True
+                        break
+                if merged:
+                    break
+        return sorted(spans, key=lambda s: s.score, reverse=True)
+
+    def deduplicate(self, spans):
+        kept = []
+        kept_words = []
+        for span in spans:
+            words = _words(span.text)
+            duplicate = any(
+                len(words & other) / max(1, len(words | other)) >= self.duplicate_threshold
+                for other in kept_words
+            )
+            if not duplicate:
+                kept.append(span)
+                kept_words.append(words)
+        return kept
+
+    def _truncate(self, text, budget):
+        # Longest prefix, cut at a word boundary, that fits in the budget.
+        words = text.split(" ")
+        low, high = 0, len(words)
+        while low < high:
+            middle = (low + high + 1) // 2
+            if self.count_tokens(" ".join(words[:middle])) <= budget:
+                low = middle
+            else:
+                high = middle - 1
+        return " ".join(words[:low])
+
+    def assemble(self, documents, budget):
+        """
+        Returns (context text, documents it was built from) using at most
+        `budget` tokens.
+        """
+        separator_tokens = self.count_tokens(self.separator)
+        pieces = []
+        used_documents = []
+        remaining = budget
+        for span in self.deduplicate(self.merge(documents)):
+            cost = self.count_tokens(span.text) + (separator_tokens if pieces else 0)
+            if cost <= remaining:
+                pieces.append(span.text)
+                used_documents += span.documents
+                remaining -= cost
+            elif not pieces and remaining > 0:
+                # Not even the best span fits: use as much of it as we can.
+                text = self._truncate(span.text, remaining)
+                if text:
+                    pieces.append(text)
+                    used_documents += span.documents
+                    remaining -= self.count_tokens(text)
+        return self.separator.join(pieces), used_documents
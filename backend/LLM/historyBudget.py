@@ -0,0 +1,38 @@
+def message_text(message):
+    return f"{message['role']}: {message['content']}\n"
+
+
+def format_history(messages):
+    """
+    Chat turns as they appear in the prompt, one message_text per turn.
+    """
+    return "".join(message_text(message) for message in messages or ())
+
+
+def select_recent_history(fetch_page, count_tokens_batch, budget, page_size=20):
+    """
+    Picks the most recent chat turns that fit in `budget` tokens.
+
+    fetch_page(cursor_id, limit) must return a newest-first page in the
+    get_chat_history_page format. Pages are only loaded until the budget is
+    used up, so long-lived collections don't get read in full, and each
+    page is measured with a single count_tokens_batch(texts) call. The
+    result is in chronological order, ready to be put in a prompt.
+    """
+    selected = []
+    used = 0
+    cursor_id = None
+    while budget > used:
+        page = fetch_page(cursor_id, page_size)
+        if not page["messages"]:
+            break
+        costs = count_tokens_batch([message_text(message) for message in page["messages"]])
+        for message, cost in zip(page["messages"], costs):
+            if used + cost > budget:
+                return selected[::-1]
+            selected.append(message)
+            used += cost
+        cursor_id = page["nextCursor"]
+        if cursor_id is None:
+            break
+    return selected[::-1]
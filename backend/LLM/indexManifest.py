@@ -0,0 +1,209 @@
+import hashlib
+import json
+import os
+import time
+
+
+def file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def text_sha256(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class IndexManifest:
+    """
+    Records what is currently embedded in the vector store.
+
+    For every source PDF we keep its content hash and the chapter outline it
+    was split on, and for every chapter the hash of its text and metadata
+    and the ids of the chunks it produced. Chunk ids are content hashes themselves, so the same
+    text always maps to the same id and sync_index only needs to embed chunks
+    whose id is not in the store yet.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.sources = {}
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                self.sources = json.load(f).get("sources", {})
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"sources": self.sources}, f, indent=1)
+        os.replace(tmp_path, self.path)
+
+    def chunk_ids(self):
+        ids = set()
+        for source in self.sources.values():
+            for chapter in source["chapters"]:
+                ids.update(chapter["chunk_ids"])
+        return ids
+
+    def version(self):
+        """
+        Hash over every chunk id in the store; changes whenever the indexed
+        content does.
+        """
+        return text_sha256("\n".join(sorted(self.chunk_ids())))
+
+
+def make_chunk_ids(source, chunks):
+    """
+    Content-hashed ids for the chunks of one chapter, over the text and the
+    metadata, so a chunk whose chapter or pages changed is stored again.
+    Identical chunks in the same source get an occurrence suffix so ids stay
+    unique.
+    """
+    ids = []
+    seen = {}
+    for chunk in chunks:
+        metadata = json.dumps(chunk.metadata, sort_keys=True)
+        base = text_sha256(source + "\0" + metadata + "\0" + chunk.page_content)
+        seen[base] = seen.get(base, 0) + 1
+        ids.append(base if seen[base] == 1 else f"{base}-{seen[base]}")
+    return ids
+
+
+class _Checkpoint:
+    """
+    Append-only log of chunk ids committed to the store by a sync that has
+    not finished yet. The manifest is only rewritten at the end of a sync,
+    so after a crash this is what tells the next run which batches made it.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.ids = set()
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                self.ids = {line.strip() for line in f if line.strip()}
+            print(f"Resuming index sync, {len(self.ids)} chunks already committed.")
+
+    def commit(self, ids):
+        with open(self.path, "a") as f:
+            f.write("".join(i + "\n" for i in ids))
+            f.flush()
+            os.fsync(f.fileno())
+        self.ids.update(ids)
+
+    def clear(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.ids = set()
+
+
+def sync_index(db, manifest, manuals, manual_chapters, iter_chapter_pages, split_chapter, batch_size=64,
+               checkpoint_path=None):
+    """
+    Brings the vector store in line with the manuals on disk.
+
+    manuals is a list of MANUALS entries ({"id": ..., "path": ...}),
+    manual_chapters(manual) returns the chapter outline of one
+    ({"title", "start_page", "end_page"} dicts), iter_chapter_pages(path,
+    chapters) yields the page texts of each chapter and
+    split_chapter(pages, metadata) returns its Document chunks. Chunks carry
+    the manual id, chapter number and title and their page span.
+
+    Runs as a streaming pipeline (chapter -> split -> embed + upsert in
+    batches of batch_size) so memory stays flat regardless of corpus size.
+    PDFs whose hash and outline did not change are skipped without their
+    text being read, chapters whose text did not change keep their chunks,
+    and only chunks that are not already stored get embedded. Each
+    committed batch is logged to checkpoint_path, so an interrupted sync
+    resumes where it stopped. Chunks that no longer belong to any manual are
+    deleted at the end. Returns a dict of counts and throughput.
+    """
+    checkpoint = _Checkpoint(checkpoint_path or manifest.path + ".checkpoint")
+    stored_ids = manifest.chunk_ids() | checkpoint.ids
+    stats = {"skipped_sources": 0, "chapters": 0, "added": 0, "deleted": 0, "batches": 0}
+    started = time.perf_counter()
+    new_sources = {}
+    batch_docs, batch_ids = [], []
+
+    def flush():
+        if not batch_ids:
+            return
+        db.add_documents(batch_docs, ids=batch_ids)
+        checkpoint.commit(batch_ids)
+        stored_ids.update(batch_ids)
+        stats["added"] += len(batch_ids)
+        stats["batches"] += 1
+        elapsed = time.perf_counter() - started
+        print(
+            f"Index sync: batch {stats['batches']} committed, {stats['added']} chunks "
+            f"embedded from {stats['chapters']} chapters ({stats['added'] / elapsed:.1f} chunks/s)."
+        )
+        batch_docs.clear()
+        batch_ids.clear()
+
+    for manual in manuals:
+        path = manual["path"]
+        outline = manual_chapters(manual)
+        sha = file_sha256(path)
+        previous = manifest.sources.get(path)
+        if previous and previous["sha256"] == sha and previous.get("outline") == outline:
+            new_sources[path] = previous
+            stats["skipped_sources"] += 1
+            continue
+
+        # Chapters that did not change keep their chunks even if other parts
+        # of the PDF were edited.
+        previous_chapters = {}
+        if previous:
+            for chapter in previous["chapters"]:
+                previous_chapters[chapter["sha256"]] = chapter
+
+        chapters = []
+        for index, (chapter, pages) in enumerate(zip(outline, iter_chapter_pages(path, outline))):
+            stats["chapters"] += 1
+            metadata = {
+                "source": path,
+                "manual": manual["id"],
+                "chapter": index,
+                "chapter_title": chapter["title"],
+                "page_start": chapter["start_page"] + 1,
+                "page_end": chapter["end_page"],
+            }
+            chapter_sha = text_sha256(json.dumps(metadata, sort_keys=True) + "\0" + "".join(pages))
+            if chapter_sha in previous_chapters:
+                chapters.append(previous_chapters[chapter_sha])
+                continue
+            chunks = split_chapter(pages, metadata)
+            ids = make_chunk_ids(path, chunks)
+            for chunk_id, chunk in zip(ids, chunks):
+                if chunk_id not in stored_ids and chunk_id not in batch_ids:
+                    batch_docs.append(chunk)
+                    batch_ids.append(chunk_id)
+                    if len(batch_ids) >= batch_size:
+                        flush()
+            chapters.append({"sha256": chapter_sha, "chunk_ids": ids})
+
+        new_sources[path] = {"sha256": sha, "outline": outline, "chapters": chapters}
+    flush()
+
+    new_ids = set()
+    for source in new_sources.values():
+        for chapter in source["chapters"]:
+            new_ids.update(chapter["chunk_ids"])
+
+    stale_ids = list(stored_ids - new_ids)
+    if stale_ids:
+        db.delete(ids=stale_ids)
+        stats["deleted"] = len(stale_ids)
+
+    manifest.sources = new_sources
+    manifest.save()
+    checkpoint.clear()
+    stats["seconds"] = round(time.perf_counter() - started, 2)
+    return stats
@@ -0,0 +1,99 @@
+import os
+
+import numpy as np
+
+from LLM.indexManifest import IndexManifest, sync_index, text_sha256
+
+# LangChain's default name, which the existing stores were created with.
+COLLECTION_NAME = "langchain"
+
+
+class IndexShard:
+    """
+    One manual's part of the vector store: a Chroma store and manifest of
+    its own in <root>/<manual id>, so every manual is synced, searched and
+    rebuilt on its own and adding a manual does not make the others slower
+    to search.
+
+    The centroid (normalized mean of the chunk embeddings) is what
+    ShardedRetriever routes queries on.
+    """
+
+    def __init__(self, manual, root, embedding_function):
+        import chromadb
+        from langchain_community.vectorstores import Chroma
+
+        self.manual = manual
+        self.name = manual["id"]
+        self.directory = os.path.join(root, self.name)
+        os.makedirs(self.directory, exist_ok=True)
+        self.manifest = IndexManifest(os.path.join(self.directory, "manifest.json"))
+        # The client is created here so the shard can close it (see close).
+        self.client = chromadb.PersistentClient(path=self.directory)
+        self.db = Chroma(
+            client=self.client,
+            collection_name=COLLECTION_NAME,
+            persist_directory=self.directory,
+            embedding_function=embedding_function,
+        )
+        self.collection = self.client.get_collection(COLLECTION_NAME)
+        self.centroid = self._centroid()
+
+    def sync(self, manual_chapters, iter_chapter_pages, split_chapter, batch_size=64):
+        # Only embeds chunks that are new or changed since the last run.
+        stats = sync_index(
+            self.db, self.manifest, [self.manual], manual_chapters, iter_chapter_pages, split_chapter,
+            batch_size=batch_size,
+        )
+        if stats["added"] or stats["deleted"]:
+            self.db.persist() # persist to disk
+        self.centroid = self._centroid()
+        return stats
+
+    def _centroid(self):
+        vectors = self.db.get(include=["embeddings"])["embeddings"]
+        if vectors is None or len(vectors) == 0:
+            return None
+        vectors = np.asarray(vectors, dtype=np.float32)
+        vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        centroid = vectors.mean(axis=0)
+        return centroid / max(float(np.linalg.norm(centroid)), 1e-12)
+
+    def version(self):
+        return self.manifest.version()
+
+    def export(self):
+        data = self.db.get(include=["embeddings", "documents", "metadatas"])
+        return data["ids"], data["documents"], data["metadatas"], data["embeddings"]
+
+    def close(self):
+        """
+        Stops the shard's Chroma client. chromadb keeps one system per
+        persist directory in a class-level cache for the life of the
+        process, so a shard that is no longer served has to be closed or its
+        memory and open files stay around.
+        """
+        self.client.close()  # drops the cached system with its last reference
+
+    def chapters(self):
+        """
+        The chapter outline the shard was built from.
+        """
+        source = self.manifest.sources.get(self.manual["path"], {})
+        return [
+            {
+                "chapter": index,
+                "title": chapter["title"],
+                "page_start": chapter["start_page"] + 1,
+                "page_end": chapter["end_page"],
+            }
+            for index, chapter in enumerate(source.get("outline", []))
+        ]
+
+
+def index_version(shards):
+    """
+    Hash over the versions of every shard; changes whenever any manual's
+    indexed content does.
+    """
+    return text_sha256("\n".join(f"{name}:{shard.version()}" for name, shard in sorted(shards.items())))
@@ -0,0 +1,276 @@
+import fcntl
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+
+from LLM.indexShards import IndexShard, index_version
+
+# A build that has not finished after this long was interrupted.
+STALE_BUILD_SECONDS = 24 * 3600
+
+
+class SnapshotStore:
+    """
+    Versioned, immutable copies of the vector index.
+
+    Every build writes a new directory under `root` (named by build time)
+    and writes snapshot.json into it last, so a directory without one is a
+    build in progress or an interrupted one. An interrupted build is picked
+    up again by the next build from the same base, so the shards' sync
+    checkpoints let it resume where it stopped. Publishing replaces the CURRENT
+    file atomically; servers read it on start and when told to reload, and
+    never change the shards of a published snapshot. Old snapshots are deleted by
+    collect_garbage, which keeps the newest `keep` of them and any snapshot
+    a live process on this host holds a lease on (see acquire).
+    """
+
+    SNAPSHOT_FILE = "snapshot.json"
+    BUILD_FILE = "build.json"
+    CURRENT_FILE = "CURRENT"
+    LEASE_PREFIX = ".lease-"
+
+    def __init__(self, root, keep=2):
+        self.root = root
+        self.keep = keep
+        self._leases = {}  # name -> [open lease file, acquire count]
+        self._leases_lock = threading.Lock()
+        # A forked worker takes its own leases on what its parent had open.
+        os.register_at_fork(after_in_child=self._renew_leases)
+
+    def path(self, name):
+        return os.path.join(self.root, name)
+
+    def current(self):
+        """
+        Name of the published snapshot, or None before the first build.
+        """
+        try:
+            with open(os.path.join(self.root, self.CURRENT_FILE), "r") as f:
+                name = f.read().strip()
+        except FileNotFoundError:
+            return None
+        return name if name and self.is_complete(name) else None
+
+    def is_complete(self, name):
+        return os.path.exists(os.path.join(self.path(name), self.SNAPSHOT_FILE))
+
+    def info(self, name):
+        with open(os.path.join(self.path(name), self.SNAPSHOT_FILE), "r") as f:
+            return json.load(f)
+
+    def snapshots(self):
+        """
+        Names of the complete snapshots, oldest first.
+        """
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(name for name in os.listdir(self.root) if self.is_complete(name))
+
+    def _lock_lease(self, name):
+        f = open(os.path.join(self.path(name), f"{self.LEASE_PREFIX}{os.getpid()}"), "a")
+        fcntl.flock(f, fcntl.LOCK_SH)
+        return f
+
+    def acquire(self, name):
+        """
+        Marks a snapshot as in use by this process so no build deletes it:
+        a shared flock on a lease file, which the OS drops when the process
+        ends, however it ends. Calls nest; each needs a release.
+        """
+        with self._leases_lock:
+            lease = self._leases.get(name)
+            if lease is None:
+                lease = self._leases[name] = [self._lock_lease(name), 0]
+            lease[1] += 1
+
+    def release(self, name):
+        with self._leases_lock:
+            lease = self._leases.get(name)
+            if lease is None:
+                return
+            lease[1] -= 1
+            if lease[1] > 0:
+                return
+            del self._leases[name]
+            try:
+                os.remove(lease[0].name)
+            except FileNotFoundError:
+                pass
+            lease[0].close()
+
+    def _renew_leases(self):
+        self._leases_lock = threading.Lock()
+        inherited, self._leases = self._leases, {}
+        for name, (f, count) in inherited.items():
+            f.close()  # the parent's lock stays, it still has the file open
+            try:
+                self._leases[name] = [self._lock_lease(name), count]
+            except OSError as e:
+                print(f"Could not lease index snapshot {name}: {e}", flush=True)
+
+    def _leased(self, name):
+        for entry in os.listdir(self.path(name)):
+            if not entry.startswith(self.LEASE_PREFIX):
+                continue
+            try:
+                with open(os.path.join(self.path(name), entry), "r") as f:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except FileNotFoundError:
+                pass  # released meanwhile
+            except BlockingIOError:
+                return True
+            # Otherwise it was left behind by a process that is gone.
+        return False
+
+    def _interrupted_build(self, base):
+        """
+        Newest unfinished build started from `base` that no live process is
+        working on, or None.
+        """
+        if not os.path.isdir(self.root):
+            return None
+        for name in sorted(os.listdir(self.root), reverse=True):
+            if not os.path.isdir(self.path(name)) or self.is_complete(name):
+                continue
+            try:
+                with open(os.path.join(self.path(name), self.BUILD_FILE), "r") as f:
+                    started_from = json.load(f)["base"]
+            except (OSError, ValueError, KeyError):
+                continue  # interrupted while copying the base
+            if started_from == base and not self._leased(name):
+                return name
+        return None
+
+    def build(self, build_fn, base=None):
+        """
+        Creates a snapshot: build_fn(directory) fills the directory and
+        returns a dict stored in snapshot.json. With `base` the directory
+        starts as a copy of that snapshot, so only what changed since has to
+        be embedded. A build from the same base that was interrupted is
+        continued instead of starting over. Returns the new snapshot's name.
+        """
+        os.makedirs(self.root, exist_ok=True)
+        name = self._interrupted_build(base)
+        if name is not None:
+            directory = self.path(name)
+            for entry in os.listdir(directory):
+                if entry.startswith(self.LEASE_PREFIX):
+                    os.remove(os.path.join(directory, entry))  # left by the process that died
+            print(f"Resuming interrupted index build {name}.")
+        else:
+            name = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:6]}"
+            directory = self.path(name)
+            if base is not None:
+                # Derived files are rebuilt on load, no need to copy them.
+                shutil.copytree(
+                    self.path(base), directory,
+                    ignore=shutil.ignore_patterns(
+                        self.SNAPSHOT_FILE, self.BUILD_FILE, self.LEASE_PREFIX + "*", "vector_index"
+                    ),
+                )
+            else:
+                os.makedirs(directory)
+            # Written once the copy is complete: marks the build as resumable.
+            with open(os.path.join(directory, self.BUILD_FILE), "w") as f:
+                json.dump({"base": base}, f)
+        # Keeps other builds and garbage collection away while this one runs.
+        self.acquire(name)
+        try:
+            started = time.perf_counter()
+            info = build_fn(directory)
+            info.update({
+                "name": name,
+                "base": base,
+                "created": time.time(),
+                "build_seconds": round(time.perf_counter() - started, 2),
+            })
+            tmp_path = os.path.join(directory, self.SNAPSHOT_FILE + ".tmp")
+            with open(tmp_path, "w") as f:
+                json.dump(info, f, indent=1)
+            os.replace(tmp_path, os.path.join(directory, self.SNAPSHOT_FILE))
+        finally:
+            self.release(name)
+        return name
+
+    def publish(self, name):
+        if not self.is_complete(name):
+            raise ValueError(f"Snapshot {name} is not complete")
+        tmp_path = os.path.join(self.root, self.CURRENT_FILE + ".tmp")
+        with open(tmp_path, "w") as f:
+            f.write(name + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, os.path.join(self.root, self.CURRENT_FILE))
+
+    def collect_garbage(self, in_use=()):
+        """
+        Deletes every snapshot except the current one, the ones in `in_use`,
+        leased ones and the newest `keep`, plus builds that were abandoned.
+        Returns the deleted names.
+        """
+        keep = set(self.snapshots()[-self.keep:]) if self.keep > 0 else set()
+        keep.update(name for name in in_use if name)
+        keep.add(self.current())
+        deleted = []
+        if not os.path.isdir(self.root):
+            return deleted
+        for name in sorted(os.listdir(self.root)):
+            directory = self.path(name)
+            if name in keep or not os.path.isdir(directory) or self._leased(name):
+                continue
+            if not self.is_complete(name) and time.time() - os.path.getmtime(directory) < STALE_BUILD_SECONDS:
+                continue  # probably still being built
+            shutil.rmtree(directory, ignore_errors=True)
+            deleted.append(name)
+        if deleted:
+            print(f"Deleted old index snapshots: {', '.join(deleted)}")
+        return deleted
+
+
+class IndexSnapshot:
+    """
+    An opened snapshot: one IndexShard per manual, and on request their
+    mmap indexes (built next to the shards the first time).
+    """
+
+    def __init__(self, name, directory, manuals, embedding_function):
+        self.name = name
+        self.directory = directory
+        self.shards = {}
+        for manual in manuals:
+            shard = IndexShard(manual, os.path.join(directory, "chroma"), embedding_function)
+            self.shards[shard.name] = shard
+        self._vector_indexes = None
+        self._lock = threading.Lock()
+
+    def version(self):
+        return index_version(self.shards)
+
+    def close(self):
+        """
+        Closes every shard; call once nothing is searching the snapshot any
+        more.
+        """
+        with self._lock:
+            self._vector_indexes = None
+        for shard in self.shards.values():
+            shard.close()
+
+    def vector_indexes(self, dtype="float32", rescore=False):
+        from LLM.vectorIndex import MmapVectorIndex
+
+        with self._lock:
+            if self._vector_indexes is None:
+                # Derived from each shard's Chroma store; rebuilt whenever
+                # the shard's manifest changes.
+                self._vector_indexes = {
+                    name: MmapVectorIndex.load_or_build(
+                        os.path.join(self.directory, "vector_index", name), shard.version(), shard.export,
+                        dtype=dtype, rescore=rescore,
+                    )
+                    for name, shard in self.shards.items()
+                }
+            return self._vector_indexes
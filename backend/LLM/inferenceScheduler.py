@@ -0,0 +1,239 @@
+import contextvars
+import itertools
+import math
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+
+import metrics
+
+# Lower number = served first.
+PRIORITY_INTERACTIVE = 0
+PRIORITY_ANONYMOUS = 10
+
+
+class QueueFullError(Exception):
+    """
+    Raised by submit when the inference queue is at capacity.
+    retry_after is a rough estimate in seconds of when a slot frees up.
+    """
+
+    def __init__(self, retry_after):
+        super().__init__("Inference queue is full")
+        self.retry_after = retry_after
+
+
+class DeadlineExceededError(Exception):
+    """
+    Raised when a request could not be served before its deadline.
+    """
+
+
+class GenerationCancelled(Exception):
+    """
+    Raised from a stream whose caller set its cancel event, e.g. because the
+    client disconnected.
+    """
+
+
+class _Job:
+    def __init__(self, fn, args, kwargs, priority, deadline):
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.priority = priority
+        self.deadline = deadline
+        self.enqueued_at = time.monotonic()
+        self.future = Future()
+        # Run in the submitter's context so the request trace follows the job.
+        self.context = contextvars.copy_context()
+
+
+class InferenceScheduler:
+    """
+    Owns the model on a small pool of worker threads (one by default).
+
+    Request threads submit work into a bounded priority queue instead of
+    calling the model themselves. When the queue is full, submit raises
+    QueueFullError straight away so the caller can answer 503 instead of
+    piling up threads. Jobs still queued when their deadline passes are
+    dropped without running.
+    """
+
+    def __init__(self, workers=1, max_queue=8, default_timeout=120.0):
+        self.max_queue = max_queue
+        self.default_timeout = default_timeout
+        self._queue = queue.PriorityQueue()
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        self._depth = 0
+
+        # stats
+        self.submitted = 0
+        self.rejected = 0
+        self.expired = 0
+        self.completed = 0
+        self.failed = 0
+        self.cancelled = 0
+        self._waits = deque(maxlen=1000)
+        self._avg_service = 5.0  # seconds, moving average
+
+        self._workers = []
+        for i in range(workers):
+            t = threading.Thread(target=self._worker, name=f"inference-{i}", daemon=True)
+            t.start()
+            self._workers.append(t)
+
+    def _worker(self):
+        while True:
+            _, _, job = self._queue.get()
+            with self._lock:
+                self._depth -= 1
+            if not job.future.set_running_or_notify_cancel():
+                continue  # caller gave up while it was queued
+            started = time.monotonic()
+            if started > job.deadline:
+                with self._lock:
+                    self.expired += 1
+                job.future.set_exception(DeadlineExceededError("Request expired while queued"))
+                continue
+            with self._lock:
+                self._waits.append(started - job.enqueued_at)
+            try:
+                result = job.context.run(self._run_job, job, started)
+            except GenerationCancelled as e:
+                with self._lock:
+                    self.cancelled += 1
+                job.future.set_exception(e)
+            except BaseException as e:
+                with self._lock:
+                    self.failed += 1
+                job.future.set_exception(e)
+            else:
+                with self._lock:
+                    self.completed += 1
+                job.future.set_result(result)
+            with self._lock:
+                elapsed = time.monotonic() - started
+                self._avg_service = 0.8 * self._avg_service + 0.2 * elapsed
+
+    @staticmethod
+    def _run_job(job, started):
+        metrics.record_stage("queue_wait", started - job.enqueued_at)
+        return job.fn(*job.args, **job.kwargs)
+
+    def _retry_after(self):
+        # Caller holds self._lock.
+        return max(1, math.ceil(self._avg_service * (self._depth + 1) / len(self._workers)))
+
+    def submit(self, fn, *args, priority=PRIORITY_INTERACTIVE, timeout=None, **kwargs):
+        """
+        Queues fn(*args, **kwargs) and returns its job. Raises QueueFullError
+        if the queue is at capacity.
+        """
+        if timeout is None:
+            timeout = self.default_timeout
+        job = _Job(fn, args, kwargs, priority, time.monotonic() + timeout)
+        with self._lock:
+            if self._depth >= self.max_queue:
+                self.rejected += 1
+                raise QueueFullError(self._retry_after())
+            self._depth += 1
+            self.submitted += 1
+        self._queue.put((priority, next(self._seq), job))
+        return job
+
+    def run(self, fn, *args, priority=PRIORITY_INTERACTIVE, timeout=None, **kwargs):
+        """
+        Submits fn and blocks until it returns. Raises DeadlineExceededError
+        if the result is not available within timeout seconds. A job that
+        already started keeps running to the end regardless, so generation
+        goes through stream(), which stops at the deadline.
+        """
+        job = self.submit(fn, *args, priority=priority, timeout=timeout, **kwargs)
+        try:
+            return job.future.result(timeout=max(0.0, job.deadline - time.monotonic()))
+        except FutureTimeoutError:
+            job.future.cancel()
+            raise DeadlineExceededError("Request timed out")
+
+    def stream(self, gen_fn, *args, priority=PRIORITY_INTERACTIVE, timeout=None, cancel=None, **kwargs):
+        """
+        Runs the generator gen_fn(*args, **kwargs) on a worker and returns an
+        iterator over its items. Admission happens right away (QueueFullError
+        is raised here, not on first iteration). Closing the returned iterator
+        stops the generator on the worker, freeing the model for the next job.
+
+        `cancel` is an optional threading.Event another thread can set to do
+        the same while the iterator is blocked: the worker stops after the
+        current item and the iterator raises GenerationCancelled.
+        """
+        items = queue.Queue()
+        cancelled = threading.Event()
+        end = object()
+
+        def cancel_requested():
+            if cancel is not None and cancel.is_set():
+                raise GenerationCancelled("Generation cancelled by the caller")
+
+        def produce(deadline):
+            cancel_requested()  # gave up while queued: skip the prefill too
+            gen = gen_fn(*args, **kwargs)
+            try:
+                for item in gen:
+                    if cancelled.is_set():
+                        return
+                    cancel_requested()
+                    if time.monotonic() > deadline:
+                        raise DeadlineExceededError("Generation ran past its deadline")
+                    items.put(item)
+            finally:
+                gen.close()
+
+        if timeout is None:
+            timeout = self.default_timeout
+        job = self.submit(produce, time.monotonic() + timeout, priority=priority, timeout=timeout)
+        job.future.add_done_callback(lambda f: items.put(end))
+
+        def consume():
+            try:
+                while True:
+                    # The caller gives up at the deadline even if the job is
+                    # still queued or stuck behind another request's prefill.
+                    try:
+                        item = items.get(timeout=max(0.0, job.deadline - time.monotonic()))
+                    except queue.Empty:
+                        with self._lock:
+                            self.expired += 1
+                        raise DeadlineExceededError("Request timed out")
+                    if item is end:
+                        if not job.future.cancelled() and job.future.exception() is not None:
+                            raise job.future.exception()
+                        return
+                    yield item
+            finally:
+                cancelled.set()
+                job.future.cancel()
+
+        return consume()
+
+    def stats(self):
+        with self._lock:
+            waits = sorted(self._waits)
+            depth = self._depth
+        return {
+            "workers": len(self._workers),
+            "queue_depth": depth,
+            "max_queue": self.max_queue,
+            "submitted": self.submitted,
+            "rejected": self.rejected,
+            "expired": self.expired,
+            "completed": self.completed,
+            "failed": self.failed,
+            "cancelled": self.cancelled,
+            "wait_avg_seconds": sum(waits) / len(waits) if waits else 0.0,
+            "wait_p95_seconds": waits[int(0.95 * (len(waits) - 1))] if waits else 0.0,
+            "service_avg_seconds": round(self._avg_service, 3),
+        }
@@ -0,0 +1,78 @@
+import threading
+import time
+
+
+class NotReadyError(Exception):
+    """
+    Raised when something needs a component that is still loading.
+    """
+
+
+class LazyComponent:
+    """
+    Loads a heavy object (model, vector store, ...) the first time it is
+    needed, or ahead of time from a warm-up thread, and remembers how long
+    that took. Concurrent callers wait on the same load instead of starting
+    a second one.
+    """
+
+    def __init__(self, name, loader):
+        self.name = name
+        self._loader = loader
+        self._value = None
+        self._loaded = False
+        self._lock = threading.Lock()
+        self.load_seconds = None
+        self.error = None
+
+    def set_loader(self, loader):
+        """
+        Swaps the loader before first use, e.g. to load a stub model in the
+        benchmark. Has no effect once the component is loaded.
+        """
+        if self._loaded:
+            raise RuntimeError(f"{self.name} is already loaded")
+        self._loader = loader
+
+    @property
+    def loaded(self):
+        return self._loaded
+
+    def get(self):
+        if self._loaded:
+            return self._value
+        with self._lock:
+            if not self._loaded:
+                start = time.perf_counter()
+                try:
+                    self._value = self._loader()
+                except Exception as e:
+                    self.error = str(e)
+                    raise
+                self.load_seconds = round(time.perf_counter() - start, 3)
+                self.error = None
+                self._loaded = True
+                print(f"Loaded {self.name} in {self.load_seconds}s.", flush=True)
+        return self._value
+
+    def replace(self, value):
+        """
+        Swaps in a new value for a loaded component, e.g. a new index
+        snapshot. Callers that already got the old value keep using it.
+        """
+        with self._lock:
+            if not self._loaded:
+                raise NotReadyError(f"{self.name} is still loading")
+            self._value = value
+
+    def get_if_loaded(self):
+        """
+        Returns the value without triggering a load; raises NotReadyError if
+        it is not there yet.
+        """
+        if not self._loaded:
+            raise NotReadyError(f"{self.name} is still loading")
+        return self._value
+
+    def status(self):
+        return {"loaded": self._loaded, "loadSeconds": self.load_seconds, "error": self.error}
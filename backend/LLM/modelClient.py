@@ -0,0 +1,157 @@
+import os
+import threading
+from multiprocessing.connection import Client
+
+from LLM.inferenceScheduler import QueueFullError, DeadlineExceededError, PRIORITY_INTERACTIVE
+from LLM.lazyComponents import NotReadyError
+
+# Same interface as LLM.LLM, but every call is forwarded to the model host
+# process (modelHost.py) over a local socket. Web workers using this module
+# never load the model or the embeddings themselves.
+
+MODEL_HOST_ADDRESS = os.environ.get("MODEL_HOST_ADDRESS", "./model_host.sock")
+MODEL_HOST_AUTHKEY = os.environ.get("MODEL_HOST_AUTHKEY", "capstone-model-host").encode()
+
+_local = threading.local()
+
+
+def _connect():
+    try:
+        return Client(MODEL_HOST_ADDRESS, family="AF_UNIX", authkey=MODEL_HOST_AUTHKEY)
+    except (OSError, EOFError) as e:
+        raise NotReadyError(f"Model host is not reachable: {e}")
+
+
+def _raise_remote(reply):
+    # reply = ("error", exception name, message, retry_after)
+    _, name, message, retry_after = reply
+    if name == "QueueFullError":
+        raise QueueFullError(retry_after)
+    if name == "DeadlineExceededError":
+        raise DeadlineExceededError(message)
+    if name == "NotReadyError":
+        raise NotReadyError(message)
+    raise RuntimeError(f"{name}: {message}")
+
+
+def _call(method, *args):
+    """
+    Sends one request on this thread's connection and returns the result.
+    Reconnects once if the host was restarted in between.
+    """
+    for attempt in range(2):
+        conn = getattr(_local, "conn", None)
+        if conn is None:
+            conn = _local.conn = _connect()
+        try:
+            conn.send((method, args))
+            reply = conn.recv()
+            break
+        except (OSError, EOFError):
+            conn.close()
+            _local.conn = None
+            if attempt == 1:
+                raise NotReadyError("Lost connection to the model host")
+    if reply[0] == "error":
+        _raise_remote(reply)
+    return reply[1]
+
+
+def start_warm_up():
+    # The model host warms itself up.
+    return None
+
+
+def readiness():
+    try:
+        return _call("readiness")
+    except NotReadyError as e:
+        return {"ready": False, "components": {}, "error": str(e)}
+
+
+def ensure_ready():
+    if not readiness()["ready"]:
+        raise NotReadyError("The assistant is still warming up")
+
+
+def count_tokens(text):
+    return _call("count_tokens", text)
+
+
+def count_tokens_batch(texts):
+    return _call("count_tokens_batch", texts)
+
+
+def history_token_budget(query):
+    return _call("history_token_budget", query)
+
+
+def get_cache_stats():
+    return _call("get_cache_stats")
+
+
+def get_embedding_stats():
+    return _call("get_embedding_stats")
+
+
+def get_chunk(chunk_id):
+    return _call("get_chunk", chunk_id)
+
+
+def get_manuals():
+    return _call("get_manuals")
+
+
+def reload_index():
+    return _call("reload_index")
+
+
+def get_scheduler_stats():
+    return _call("get_scheduler_stats")
+
+
+def render_metrics():
+    return _call("render_metrics")
+
+
+def get_llm_response(query, history=(), priority=PRIORITY_INTERACTIVE, timeout=None, filters=None):
+    return _call("get_llm_response", query, history, priority, timeout, filters)
+
+
+def stream_llm_response(query, history=(), priority=PRIORITY_INTERACTIVE, timeout=None, cancel=None, filters=None):
+    """
+    Streams over a dedicated connection. Closing the returned generator (or
+    setting the optional `cancel` event) closes the connection, which makes
+    the host stop generating.
+    """
+    conn = _connect()
+    try:
+        conn.send(("stream_llm_response", (query, history, priority, timeout, None, filters)))
+        reply = conn.recv()  # admission result, so a full queue raises here
+    except (OSError, EOFError):
+        conn.close()
+        raise NotReadyError("Lost connection to the model host")
+    if reply[0] == "error":
+        conn.close()
+        _raise_remote(reply)
+    return _remote_events(conn, cancel)
+
+
+def _remote_events(conn, cancel=None):
+    try:
+        while True:
+            if cancel is not None:
+                # Wake up now and then to notice a cancellation between tokens.
+                while not conn.poll(0.1):
+                    if cancel.is_set():
+                        return
+                if cancel.is_set():
+                    return
+            message = conn.recv()
+            if message[0] == "end":
+                return
+            yield message[1], message[2]
+    except (OSError, EOFError):
+        yield "error", "Error: lost connection to the model host"
+    finally:
+        conn.close()
@@ -0,0 +1,67 @@
+import threading
+
+
+class PrefixStateCache:
+    """
+    Keeps a snapshot of the llama.cpp context right after the fixed prompt
+    preamble has been evaluated.
+
+    llama-cpp-python already skips prefill for the part of a new prompt that
+    matches the tokens currently in the context, so as long as the preamble is
+    resident only the retrieved context and the question need to be evaluated.
+    Anything else that ran on the model in between (another prompt, a
+    tokenizer-only call that reset it, ...) can evict it though, so before each
+    query we check and load the saved state back if needed instead of paying
+    for the preamble again.
+    """
+
+    def __init__(self, llama, prefix_text):
+        # llama is the underlying llama_cpp.Llama (LlamaCpp.client), not the
+        # langchain wrapper.
+        self.llama = llama
+        self.prefix_text = prefix_text
+        self.prefix_tokens = []
+        self.state = None
+        self.hits = 0
+        self.restores = 0
+        self._lock = threading.Lock()
+
+    def warm_up(self):
+        """
+        Evaluates the preamble once and saves the resulting context state.
+        """
+        with self._lock:
+            self.prefix_tokens = self.llama.tokenize(
+                self.prefix_text.encode("utf-8"), add_bos=True
+            )
+            self.llama.reset()
+            self.llama.eval(self.prefix_tokens)
+            self.state = self.llama.save_state()
+        print(f"Cached prompt preamble state ({len(self.prefix_tokens)} tokens).")
+
+    def _prefix_resident(self):
+        n = len(self.prefix_tokens)
+        if self.llama.n_tokens < n:
+            return False
+        return list(self.llama.input_ids[:n]) == list(self.prefix_tokens)
+
+    def restore(self):
+        """
+        Makes sure the preamble is in the context before a generation.
+        Must be called while holding whatever lock guards the model.
+        """
+        if self.state is None:
+            return
+        with self._lock:
+            if self._prefix_resident():
+                self.hits += 1
+                return
+            self.llama.load_state(self.state)
+            self.restores += 1
+
+    def stats(self):
+        return {
+            "prefix_tokens": len(self.prefix_tokens),
+            "hits": self.hits,
+            "restores": self.restores,
+        }
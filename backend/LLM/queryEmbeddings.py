@@ -0,0 +1,124 @@
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import List
+
+from langchain_core.embeddings import Embeddings
+
+from LLM.answerCache import normalize_query
+
+
+class QueryEmbeddings(Embeddings):
+    """
+    Wraps the embedding model for query-time use.
+
+    embed_query() results are kept in an LRU cache keyed by the normalized
+    query, so the answer cache lookup and the retriever share one embedding
+    and repeated questions skip the model entirely. The model is always
+    given the query as it was asked; the normalized form is only the key.
+    Cache misses are handed to a batcher thread that waits up to
+    `batch_window` seconds for more queries from other request threads and
+    embeds them in one forward pass; identical queries already in flight
+    share a single result. embed_queries() does the same for a list.
+    embed_documents() (ingestion) goes straight to the model.
+    """
+
+    def __init__(self, model, max_entries=1024, batch_window=0.005, max_batch=32):
+        self.model = model
+        self.max_entries = max_entries
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+
+        self.entries = OrderedDict()  # normalized query -> embedding
+        self.hits = 0
+        self.misses = 0
+        self.batches = 0
+        self.batched_queries = 0
+        self._lock = threading.Lock()
+        self._pending = {}  # normalized query -> Future, while being embedded
+        self._start()
+        # Threads don't survive fork: give each worker process its own batcher.
+        os.register_at_fork(after_in_child=self._start)
+
+    def _start(self):
+        self._queue = queue.Queue()
+        self._pending = {}
+        self._thread = threading.Thread(target=self._run, name="query-embedding-batcher", daemon=True)
+        self._thread.start()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.model.embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_queries([text])[0]
+
+    def embed_queries(self, texts: List[str]) -> List[List[float]]:
+        results = []
+        with self._lock:
+            for text in texts:
+                key = normalize_query(text)
+                if key in self.entries:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    results.append(self.entries[key])
+                    continue
+                self.misses += 1
+                future = self._pending.get(key)
+                if future is None:
+                    future = self._pending[key] = Future()
+                    self._queue.put((key, text))
+                results.append(future)
+        return [r.result() if isinstance(r, Future) else r for r in results]
+
+    def _collect(self):
+        items = [self._queue.get()]
+        deadline = time.monotonic() + self.batch_window
+        while len(items) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                items.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return items
+
+    def _run(self):
+        while True:
+            items = self._collect()
+            keys = [key for key, _ in items]
+            try:
+                vectors = self.model.embed_documents([text for _, text in items])
+            except Exception as e:
+                with self._lock:
+                    futures = [self._pending.pop(key) for key in keys]
+                for future in futures:
+                    future.set_exception(e)
+                continue
+            with self._lock:
+                self.batches += 1
+                self.batched_queries += len(keys)
+                futures = []
+                for key, vector in zip(keys, vectors):
+                    self.entries[key] = vector
+                    self.entries.move_to_end(key)
+                    futures.append(self._pending.pop(key))
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+            for future, vector in zip(futures, vectors):
+                future.set_result(vector)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "batches": self.batches,
+                "mean_batch_size": round(self.batched_queries / self.batches, 2) if self.batches else 0.0,
+            }
@@ -0,0 +1,11 @@
+# Patch the LlamaCpp class to avoid the destructor error.
+from langchain_community.llms import LlamaCpp as BaseLlamaCpp
+
+class SafeLlamaCpp(BaseLlamaCpp):
+    def __del__(self):
+        try:
+            # Attempt to call the underlying client's destructor if available.
+            if hasattr(self, "client") and hasattr(self.client, "__del__"):
+                self.client.__del__()
+        except Exception:
+            pass
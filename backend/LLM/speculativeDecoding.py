@@ -0,0 +1,235 @@
+import codecs
+import threading
+import time
+
+import numpy as np
+
+import metrics
+
+
+class PromptLookupDecoder:
+    """
+    Decoding with prompt-lookup speculation.
+
+    Answers tend to copy phrases from the retrieved manual text and from
+    earlier answers, so after every token the last few generated tokens are
+    looked up in the whole prompt (the "Chat history" and "Context" sections
+    filled by AnswerPipeline.build_prompt) and in the answer so far. The
+    tokens that followed the most recent match become a draft; the current
+    token and the draft are evaluated in a single forward pass.
+
+    Tokens are chosen like llama.cpp's sampler chain does: repeat penalty
+    over the last `repeat_last_n` tokens, then top-k, top-p, min-p and
+    temperature. A drafted token is kept with the probability the model
+    gives it; on the first rejection the next token is sampled from the
+    rest of the distribution. That keeps the output distribution of plain
+    sampling (max_draft=0 gives that baseline), only with fewer forward
+    passes when drafts are accepted. With temperature <= 0 (the default)
+    this is greedy decoding and the output is identical to the baseline.
+
+    Works on the underlying llama_cpp.Llama, which has to be created with
+    logits_all=True so the evaluated batch returns logits for every position.
+    """
+
+    def __init__(
+        self,
+        llama,
+        max_tokens,
+        max_ngram=3,
+        max_draft=8,
+        temperature=0.0,
+        top_k=40,
+        top_p=0.95,
+        min_p=0.05,
+        repeat_penalty=1.0,
+        repeat_last_n=64,
+        seed=None,
+    ):
+        self.llama = llama
+        self.max_tokens = max_tokens
+        self.max_ngram = max_ngram
+        self.max_draft = max_draft
+        self.temperature = temperature
+        self.top_k = top_k
+        self.top_p = top_p
+        self.min_p = min_p
+        self.repeat_penalty = repeat_penalty
+        self.repeat_last_n = repeat_last_n
+        self.rng = np.random.default_rng(seed)
+
+        self.generations = 0
+        self.generated_tokens = 0
+        self.forward_passes = 0
+        self.drafted_tokens = 0
+        self.accepted_tokens = 0
+        self.generation_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def find_draft(self, tokens, limit):
+        """
+        Tokens that followed the most recent earlier occurrence of the
+        longest suffix n-gram (max_ngram down to 1) of `tokens`.
+        """
+        limit = min(limit, self.max_draft)
+        if limit <= 0:
+            return []
+        for n in range(min(self.max_ngram, len(tokens) - 1), 0, -1):
+            suffix = tokens[-n:]
+            # Search backwards, skipping the suffix itself.
+            for start in range(len(tokens) - n - 1, -1, -1):
+                if tokens[start:start + n] == suffix:
+                    draft = tokens[start + n:start + n + limit]
+                    if draft:
+                        return draft
+        return []
+
+    def _probabilities(self, logits, context):
+        """
+        Next-token distribution for one row of logits, `context` being the
+        tokens before it. One-hot on the argmax when temperature <= 0.
+        """
+        logits = np.array(logits, dtype=np.float64)
+        if self.repeat_penalty != 1.0 and self.repeat_last_n > 0:
+            recent = np.unique(context[-self.repeat_last_n:])
+            values = logits[recent]
+            logits[recent] = np.where(values > 0, values / self.repeat_penalty, values * self.repeat_penalty)
+        probs = np.zeros_like(logits)
+        if self.temperature <= 0:
+            probs[int(np.argmax(logits))] = 1.0
+            return probs
+        candidates = np.arange(len(logits))
+        if 0 < self.top_k < len(logits):
+            candidates = np.argpartition(-logits, self.top_k - 1)[:self.top_k]
+        candidates = candidates[np.argsort(-logits[candidates], kind="stable")]
+        p = np.exp(logits[candidates] - logits[candidates[0]])
+        p /= p.sum()
+        if self.top_p < 1.0:
+            keep = int(np.searchsorted(np.cumsum(p), self.top_p)) + 1
+            candidates, p = candidates[:keep], p[:keep]
+        if self.min_p > 0:
+            candidates = candidates[p >= self.min_p * p[0]]
+        scaled = logits[candidates] / self.temperature
+        q = np.exp(scaled - scaled.max())
+        probs[candidates] = q / q.sum()
+        return probs
+
+    def _sample(self, probs):
+        candidates = np.flatnonzero(probs)
+        if len(candidates) == 1:
+            return int(candidates[0])
+        return int(self.rng.choice(candidates, p=probs[candidates] / probs[candidates].sum()))
+
+    def _verify(self, rows, history, draft, eos):
+        """
+        Returns (kept, next token): how many draft tokens are accepted and
+        the token chosen after them. Row i holds the logits after
+        history + draft[:i].
+        """
+        context = history[-self.repeat_last_n:] if self.repeat_last_n > 0 else []
+        for kept, token in enumerate(draft):
+            probs = self._probabilities(rows[kept], context + draft[:kept])
+            if token == eos:
+                # Never accepted as a draft; the model may still choose it.
+                return kept, self._sample(probs)
+            if self.rng.random() >= probs[token]:
+                probs[token] = 0.0
+                return kept, self._sample(probs)
+        return len(draft), self._sample(self._probabilities(rows[len(draft)], context + draft))
+
+    def _prefill(self, prompt_tokens):
+        # Like llama.cpp itself: only evaluate what differs from the tokens
+        # already in the context (e.g. the cached preamble). At least the
+        # last prompt token is evaluated to get fresh logits.
+        llama = self.llama
+        common = 0
+        for cached, token in zip(llama.input_ids[:llama.n_tokens], prompt_tokens[:-1]):
+            if cached != token:
+                break
+            common += 1
+        llama.n_tokens = common
+        llama.eval(prompt_tokens[common:])
+        return self._sample(self._probabilities(llama.scores[llama.n_tokens - 1], prompt_tokens))
+
+    def generate(self, prompt):
+        """
+        Yields the answer as text pieces. Must be called while holding
+        whatever lock guards the model.
+        """
+        llama = self.llama
+        eos = llama.token_eos()
+        n_ctx = llama.n_ctx()
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        prompt_tokens = llama.tokenize(prompt.encode("utf-8"))
+        # Drafts come from the prompt and everything generated after it.
+        history = list(prompt_tokens)
+        generated = []
+        emitted_bytes = 0
+        drafted = accepted = passes = 0
+        start = time.perf_counter()
+        try:
+            next_token = self._prefill(prompt_tokens)
+            passes += 1
+            while len(generated) < self.max_tokens and next_token != eos:
+                generated.append(next_token)
+                history.append(next_token)
+
+                text = llama.detokenize(generated)
+                piece = decoder.decode(text[emitted_bytes:])
+                emitted_bytes = len(text)
+                if piece:
+                    yield piece
+
+                remaining = self.max_tokens - len(generated)
+                if remaining <= 0 or llama.n_tokens + 1 >= n_ctx:
+                    break
+                draft = self.find_draft(history, min(remaining, n_ctx - llama.n_tokens - 1))
+                base = llama.n_tokens
+                llama.eval([next_token] + draft)
+                passes += 1
+                drafted += len(draft)
+
+                # Row base + i holds the prediction after [next_token] + draft[:i].
+                kept, next_token = self._verify(llama.scores[base:base + len(draft) + 1], history, draft, eos)
+                accepted += kept
+                # Drop the rejected draft tokens from the context again.
+                llama.n_tokens = base + 1 + kept
+                for token in draft[:kept]:
+                    if len(generated) >= self.max_tokens:
+                        break
+                    generated.append(token)
+                    history.append(token)
+                if kept:
+                    text = llama.detokenize(generated)
+                    piece = decoder.decode(text[emitted_bytes:])
+                    emitted_bytes = len(text)
+                    if piece:
+                        yield piece
+            tail = decoder.decode(b"", final=True)
+            if tail:
+                yield tail
+        finally:
+            elapsed = time.perf_counter() - start
+            metrics.draft_tokens_total.inc(accepted, result="accepted")
+            metrics.draft_tokens_total.inc(drafted - accepted, result="rejected")
+            with self._lock:
+                self.generations += 1
+                self.generated_tokens += len(generated)
+                self.forward_passes += passes
+                self.drafted_tokens += drafted
+                self.accepted_tokens += accepted
+                self.generation_seconds += elapsed
+
+    def stats(self):
+        with self._lock:
+            return {
+                "generations": self.generations,
+                "generated_tokens": self.generated_tokens,
+                "forward_passes": self.forward_passes,
+                "drafted_tokens": self.drafted_tokens,
+                "accepted_tokens": self.accepted_tokens,
+                "acceptance_rate": self.accepted_tokens / self.drafted_tokens if self.drafted_tokens else 0.0,
+                "tokens_per_pass": self.generated_tokens / self.forward_passes if self.forward_passes else 0.0,
+                "tokens_per_second": (
+                    self.generated_tokens / self.generation_seconds if self.generation_seconds else 0.0
+                ),
+            }
@@ -0,0 +1,263 @@
+import json
+import os
+import shutil
+
+import numpy as np
+
+DTYPES = ("float32", "float16", "int8")
+# Rows scored per block, bounds the float32 temporary when the matrix is
+# stored at reduced precision.
+SCORE_BLOCK_ROWS = 4096
+
+
+class MmapVectorIndex:
+    """
+    Exact cosine-similarity index over a memory-mapped NumPy matrix.
+
+    A directory holds embeddings.npy (one L2-normalized row per chunk) and
+    chunks.json (ids, text and metadata in the same order, plus the manifest
+    version the index was exported from). Loading only maps the matrix, so
+    startup is close to free and worker processes on the same node share its
+    pages through the OS page cache. For a corpus of a few thousand chunks a
+    brute-force matrix product is faster than any ANN structure.
+
+    The matrix can be stored at reduced precision: float16 halves it, int8
+    (with one float32 scale per row in scales.npy) quarters it. With
+    rescore=True a full-precision copy is also written (embeddings_f32.npy);
+    searches then rank with the small matrix and re-score only the top
+    candidates against the full one, which touches just those rows.
+    """
+
+    MATRIX_FILE = "embeddings.npy"
+    SCALES_FILE = "scales.npy"
+    FULL_MATRIX_FILE = "embeddings_f32.npy"
+    CHUNKS_FILE = "chunks.json"
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, self.CHUNKS_FILE), "r") as f:
+            sidecar = json.load(f)
+        self.version = sidecar["version"]
+        self.dtype = sidecar.get("dtype", "float32")
+        self.rescore = sidecar.get("rescore", False)
+        self.ids = sidecar["ids"]
+        self.row_by_id = {chunk_id: row for row, chunk_id in enumerate(self.ids)}
+        self.texts = sidecar["texts"]
+        self.metadatas = sidecar["metadatas"]
+        self.matrix = np.load(os.path.join(directory, self.MATRIX_FILE), mmap_mode="r")
+        self.scales = None
+        if self.dtype == "int8":
+            self.scales = np.load(os.path.join(directory, self.SCALES_FILE), mmap_mode="r")
+        self.full_matrix = None
+        if self.rescore:
+            self.full_matrix = np.load(os.path.join(directory, self.FULL_MATRIX_FILE), mmap_mode="r")
+        self._rows_by_filter = {}
+
+    def __len__(self):
+        return len(self.ids)
+
+    @staticmethod
+    def _normalize(vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+    @staticmethod
+    def quantize_int8(matrix):
+        """
+        Symmetric per-row int8 quantization: row ~= int8_row * scale.
+        """
+        scales = np.abs(matrix).max(axis=1) / 127.0
+        scales = np.maximum(scales, 1e-12).astype(np.float32)
+        quantized = np.round(matrix / scales[:, None]).astype(np.int8)
+        return quantized, scales
+
+    @classmethod
+    def build(cls, directory, ids, texts, metadatas, embeddings, version, dtype="float32", rescore=False):
+        """
+        Writes a new index to `directory` (replacing any previous one) and
+        returns it loaded. Files are written to a temporary directory first
+        and swapped in, so readers never see a half-written index.
+        """
+        if dtype not in DTYPES:
+            raise ValueError(f"Unsupported vector index dtype {dtype}")
+        rescore = rescore and dtype != "float32"
+        tmp_dir = directory + ".tmp"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        matrix = cls._normalize(embeddings) if len(ids) else np.zeros((0, 0), dtype=np.float32)
+        if dtype == "int8":
+            quantized, scales = cls.quantize_int8(matrix)
+            np.save(os.path.join(tmp_dir, cls.MATRIX_FILE), quantized)
+            np.save(os.path.join(tmp_dir, cls.SCALES_FILE), scales)
+        else:
+            np.save(os.path.join(tmp_dir, cls.MATRIX_FILE), matrix.astype(dtype))
+        if rescore:
+            np.save(os.path.join(tmp_dir, cls.FULL_MATRIX_FILE), matrix)
+        with open(os.path.join(tmp_dir, cls.CHUNKS_FILE), "w") as f:
+            json.dump(
+                {
+                    "version": version,
+                    "dtype": dtype,
+                    "rescore": rescore,
+                    "ids": list(ids),
+                    "texts": list(texts),
+                    "metadatas": list(metadatas),
+                },
+                f,
+            )
+        old_dir = directory + ".old"
+        shutil.rmtree(old_dir, ignore_errors=True)
+        if os.path.exists(directory):
+            os.rename(directory, old_dir)
+        os.rename(tmp_dir, directory)
+        shutil.rmtree(old_dir, ignore_errors=True)
+        return cls(directory)
+
+    @classmethod
+    def load_or_build(cls, directory, version, export, dtype="float32", rescore=False):
+        """
+        Loads the index in `directory` if it was built from `version` with
+        the same storage options, otherwise calls
+        export() -> (ids, texts, metadatas, embeddings) and rebuilds it.
+        """
+        try:
+            index = cls(directory)
+            if (
+                index.version == version
+                and index.dtype == dtype
+                and index.rescore == (rescore and dtype != "float32")
+            ):
+                return index
+        except (OSError, ValueError, KeyError):
+            pass
+        print("Vector index is missing or stale, rebuilding it.")
+        ids, texts, metadatas, embeddings = export()
+        return cls.build(directory, ids, texts, metadatas, embeddings, version, dtype, rescore)
+
+    def resident_bytes(self):
+        """
+        Bytes that have to stay in memory for scoring (the full-precision
+        rescoring copy is only read for a handful of rows per query).
+        """
+        size = self.matrix.nbytes
+        if self.scales is not None:
+            size += self.scales.nbytes
+        return int(size)
+
+    def _scores(self, queries):
+        if self.dtype == "float32":
+            return queries @ self.matrix.T
+        scores = np.empty((len(queries), len(self)), dtype=np.float32)
+        for start in range(0, len(self), SCORE_BLOCK_ROWS):
+            block = np.asarray(self.matrix[start:start + SCORE_BLOCK_ROWS], dtype=np.float32)
+            block_scores = queries @ block.T
+            if self.scales is not None:
+                block_scores *= self.scales[start:start + SCORE_BLOCK_ROWS]
+            scores[:, start:start + SCORE_BLOCK_ROWS] = block_scores
+        return scores
+
+    def rows_matching(self, where):
+        """
+        Rows whose metadata has every key/value pair in `where`, for
+        search_batch(rows=...).
+        """
+        key = tuple(sorted(where.items()))
+        if key not in self._rows_by_filter:
+            self._rows_by_filter[key] = np.array(
+                [
+                    row
+                    for row, metadata in enumerate(self.metadatas)
+                    if all(metadata.get(name) == value for name, value in where.items())
+                ],
+                dtype=np.int64,
+            )
+        return self._rows_by_filter[key]
+
+    @staticmethod
+    def _top_k(scores, k):
+        k = min(k, scores.shape[-1])
+        top = np.argpartition(-scores, k - 1, axis=-1)[..., :k]
+        return top
+
+    def search_batch(self, query_embeddings, k, rescore_factor=4, rows=None):
+        """
+        Top-k rows for each query in one matrix product. Returns a list (one
+        per query) of (row, score) lists, best first. With a rescoring copy,
+        the best k * rescore_factor candidates are re-ranked at full precision.
+        Passing `rows` (sorted, see rows_matching) restricts the search to
+        those rows.
+        """
+        if len(self) == 0 or (rows is not None and len(rows) == 0):
+            return [[] for _ in query_embeddings]
+        queries = self._normalize(query_embeddings)
+        scores = self._scores(queries)
+        if rows is not None:
+            scores = scores[:, rows]
+        candidates_k = k * rescore_factor if self.full_matrix is not None else k
+        top = self._top_k(scores, candidates_k)
+        results = []
+        for query, row_scores, candidates in zip(queries, scores, top):
+            if self.full_matrix is not None:
+                candidates = np.sort(candidates)  # sequential reads from the memmap
+                found = candidates if rows is None else rows[candidates]
+                exact = np.asarray(self.full_matrix[found], dtype=np.float32) @ query
+                order = np.argsort(-exact)[:k]
+                results.append([(int(found[i]), float(exact[i])) for i in order])
+            else:
+                ordered = candidates[np.argsort(-row_scores[candidates])]
+                found = ordered if rows is None else rows[ordered]
+                results.append([(int(row), float(row_scores[i])) for row, i in zip(found, ordered)])
+        return results
+
+    def search(self, query_embedding, k, rows=None):
+        return self.search_batch([query_embedding], k, rows=rows)[0]
+
+
+def recall_report(ids, embeddings, k=3, sample=200, seed=0, configs=None, work_dir="./vector_index_report"):
+    """
+    Compares the storage options against exact float32 search: recall@k and
+    resident bytes for each. Queries are a sample of the stored vectors
+    themselves, each one's own row excluded from its results.
+    """
+    configs = configs or [
+        ("float32", False),
+        ("float16", False),
+        ("float16", True),
+        ("int8", False),
+        ("int8", True),
+    ]
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    rng = np.random.default_rng(seed)
+    query_rows = rng.choice(len(ids), size=min(sample, len(ids)), replace=False)
+    queries = embeddings[query_rows]
+    placeholders = [""] * len(ids)
+    metadatas = [{}] * len(ids)
+
+    def neighbours(index):
+        hits = index.search_batch(queries, k + 1)
+        return [[row for row, _ in row_hits if row != own][:k] for own, row_hits in zip(query_rows, hits)]
+
+    report = []
+    truth = None
+    try:
+        for dtype, rescore in configs:
+            index = MmapVectorIndex.build(
+                os.path.join(work_dir, f"{dtype}-{int(rescore)}"), ids, placeholders, metadatas,
+                embeddings, "report", dtype, rescore,
+            )
+            found = neighbours(index)
+            if truth is None:
+                truth = found  # first config is the float32 reference
+            hits = sum(len(set(a) & set(b)) for a, b in zip(found, truth))
+            report.append(
+                {
+                    "dtype": dtype,
+                    "rescore": rescore,
+                    "recall_at_k": round(hits / max(1, sum(len(t) for t in truth)), 4),
+                    "resident_bytes": index.resident_bytes(),
+                }
+            )
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return report
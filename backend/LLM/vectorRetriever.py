@@ -0,0 +1,140 @@
+from typing import Any, List
+
+import numpy as np
+
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+import metrics
+
+
+class MmapRetriever(BaseRetriever):
+    """
+    Drop-in replacement for db.as_retriever() backed by MmapVectorIndex.
+    The chunk id and similarity score are added to each document's metadata.
+    """
+
+    index: Any
+    embeddings: Any
+    k: int = 3
+
+    def _to_documents(self, hits):
+        return [
+            Document(
+                page_content=self.index.texts[row],
+                metadata={**self.index.metadatas[row], "id": self.index.ids[row], "score": score},
+            )
+            for row, score in hits
+        ]
+
+    def search(self, query_embedding, k, where=None):
+        """
+        Documents for an already embedded query; `where` restricts the search
+        to chunks with matching metadata values.
+        """
+        rows = self.index.rows_matching(where) if where else None
+        return self._to_documents(self.index.search(query_embedding, k, rows=rows))
+
+    def _get_relevant_documents(self, query: str, *, run_manager=None) -> List[Document]:
+        return self.search(self.embeddings.embed_query(query), self.k)
+
+    def batch_retrieve(self, queries: List[str]) -> List[List[Document]]:
+        """
+        Embeds and searches several queries at once.
+        """
+        vectors = self.embeddings.embed_queries(queries)
+        return [self._to_documents(hits) for hits in self.index.search_batch(vectors, self.k)]
+
+
+class ChromaRetriever(BaseRetriever):
+    """
+    Chroma retriever that keeps what db.as_retriever() throws away: the
+    chunk id and the cosine similarity to the query, added to each
+    document's metadata the same way MmapRetriever does. Queries the
+    shard's chromadb collection directly.
+    """
+
+    collection: Any
+    embeddings: Any
+    k: int = 3
+
+    def search(self, query_embedding, k, where=None):
+        """
+        Documents for an already embedded query; `where` restricts the search
+        to chunks with matching metadata values.
+        """
+        query_embedding = np.asarray(query_embedding, dtype=np.float32)
+        if where and len(where) > 1:
+            where = {"$and": [{name: value} for name, value in where.items()]}
+        results = self.collection.query(
+            query_embeddings=[query_embedding.tolist()],
+            n_results=k,
+            where=where or None,
+            include=["documents", "metadatas", "embeddings"],
+        )
+        if not results["ids"][0]:
+            return []
+        vectors = np.asarray(results["embeddings"][0], dtype=np.float32).reshape(-1, len(query_embedding))
+        norms = np.linalg.norm(vectors, axis=1) * np.linalg.norm(query_embedding)
+        scores = vectors @ query_embedding / np.maximum(norms, 1e-12)
+        return [
+            Document(page_content=text, metadata={**(metadata or {}), "id": chunk_id, "score": float(score)})
+            for chunk_id, text, metadata, score in zip(
+                results["ids"][0], results["documents"][0], results["metadatas"][0], scores
+            )
+        ]
+
+    def _get_relevant_documents(self, query: str, *, run_manager=None) -> List[Document]:
+        return self.search(self.embeddings.embed_query(query), self.k)
+
+
+class ShardedRetriever(BaseRetriever):
+    """
+    Searches one retriever per manual (shard) and merges the hits by score.
+
+    A query can be pinned to a manual, and within it to a chapter, with
+    retrieve(query, manual, chapter). Otherwise every shard is searched,
+    unless routing is turned on with a routing_margin >= 0: then only shards
+    whose centroid (mean chunk embedding) is within routing_margin of the
+    centroid most similar to the query are searched. Routing saves the
+    searches of the other manuals but can skip the one holding the answer.
+    """
+
+    shards: Any  # {manual id: MmapRetriever or ChromaRetriever}
+    centroids: Any  # {manual id: unit-length mean embedding}
+    embeddings: Any
+    k: int = 3
+    routing_margin: float = -1.0
+
+    def route(self, query_embedding):
+        if self.routing_margin < 0 or len(self.shards) < 2:
+            return list(self.shards)
+        query = np.asarray(query_embedding, dtype=np.float32)
+        query = query / max(float(np.linalg.norm(query)), 1e-12)
+        similarity = {
+            name: float(self.centroids[name] @ query) for name in self.shards if name in self.centroids
+        }
+        if not similarity:
+            return list(self.shards)
+        best = max(similarity.values())
+        # Shards without a centroid (empty) are never routed to.
+        return [name for name in self.shards if similarity.get(name, -1.0) >= best - self.routing_margin]
+
+    def retrieve(self, query, manual=None, chapter=None):
+        if chapter is not None and manual is None:
+            raise ValueError("A chapter filter needs a manual")
+        if manual is not None and manual not in self.shards:
+            raise ValueError(f"Unknown manual: {manual}")
+        query_embedding = self.embeddings.embed_query(query)
+        names = [manual] if manual is not None else self.route(query_embedding)
+        where = {"chapter": chapter} if chapter is not None else None
+        documents = []
+        for name in names:
+            metrics.shard_searches_total.inc(manual=name)
+            documents += self.shards[name].search(query_embedding, self.k, where)
+        metrics.annotate(shards=len(names))
+        documents.sort(key=lambda doc: doc.metadata["score"], reverse=True)
+        return documents[: self.k]
+
+    def _get_relevant_documents(self, query: str, *, run_manager=None) -> List[Document]:
+        return self.retrieve(query)
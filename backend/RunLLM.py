@@ -1,5 +1,10 @@
-from LLM.LLM import get_llm_response
+from LLM.LLM import get_llm_response, warm_up
+
+warm_up()
 
 print("=======================")
-print(get_llm_response("Who is Michel Van Aerde?"))
+result = get_llm_response("Who is Michel Van Aerde?")
+print(result["answer"])
+for source in result["sources"]:
+    print(source)
 print("-----------------------")
\ No newline at end of file
@@ -0,0 +1,351 @@
+import asyncio
+import contextvars
+import gzip
+import json
+import os
+import re
+import threading
+
+from a2wsgi import WSGIMiddleware
+from itsdangerous import BadSignature
+from werkzeug.http import parse_cookie
+
+import metrics
+from main import (
+    app as flask_app,
+    GZIP_MIN_BYTES,
+    InvalidFilters,
+    load_prompt_history,
+    retrieval_filters,
+    sse_event,
+    stream_llm_response,
+)
+from CollectionManager import append_exchange, release_connection
+from LLM.inferenceScheduler import (
+    QueueFullError,
+    DeadlineExceededError,
+    PRIORITY_INTERACTIVE,
+    PRIORITY_ANONYMOUS,
+)
+from LLM.lazyComponents import NotReadyError
+
+# ASGI entry point: uvicorn asgi:app
+#
+# The chat endpoints are served here on the event loop so a generation can be
+# stopped the moment its client disconnects or its deadline passes: the
+# scheduler worker is told to stop after the current token and the model is
+# free for the next request. Every other route is the Flask app, run on a
+# thread pool.
+
+CHAT_TIMEOUT = float(os.environ.get("CHAT_TIMEOUT", "120"))
+WSGI_THREADS = int(os.environ.get("WSGI_THREADS", "16"))
+
+# (method, path pattern, route label, needs login, streaming, priority)
+CHAT_ROUTES = [
+    ("POST", re.compile(r"^/api/chat$"), "/api/chat", True, False, PRIORITY_INTERACTIVE),
+    ("POST", re.compile(r"^/api/chat/stream$"), "/api/chat/stream", True, True, PRIORITY_INTERACTIVE),
+    ("POST", re.compile(r"^/chatNoAuth$"), "/chatNoAuth", False, False, PRIORITY_ANONYMOUS),
+    (
+        "POST",
+        re.compile(r"^/api/collections/(?P<collection_id>[^/]+)/chat$"),
+        "/api/collections/<collection_id>/chat",
+        True,
+        False,
+        PRIORITY_INTERACTIVE,
+    ),
+    (
+        "POST",
+        re.compile(r"^/api/collections/(?P<collection_id>[^/]+)/chat/stream$"),
+        "/api/collections/<collection_id>/chat/stream",
+        True,
+        True,
+        PRIORITY_INTERACTIVE,
+    ),
+]
+
+wsgi_app = WSGIMiddleware(flask_app, workers=WSGI_THREADS)
+
+
+class ClientDisconnected(Exception):
+    pass
+
+
+def match_chat_route(method, path):
+    for route_method, pattern, rule, needs_login, streaming, priority in CHAT_ROUTES:
+        found = pattern.match(path)
+        if found and method == route_method:
+            return rule, needs_login, streaming, priority, found.groupdict().get("collection_id")
+    return None
+
+
+def request_headers(scope):
+    return {name.decode("latin-1").lower(): value.decode("latin-1") for name, value in scope["headers"]}
+
+
+def load_session(headers):
+    """
+    Reads the Flask session cookie with the Flask app's own serializer, so a
+    login made through the Flask routes is valid here too.
+    """
+    value = parse_cookie(headers.get("cookie", "")).get(flask_app.config["SESSION_COOKIE_NAME"])
+    if not value:
+        return {}
+    serializer = flask_app.session_interface.get_signing_serializer(flask_app)
+    try:
+        return serializer.loads(value, max_age=int(flask_app.permanent_session_lifetime.total_seconds()))
+    except BadSignature:
+        return {}
+
+
+async def read_body(receive):
+    body = b""
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            raise ClientDisconnected()
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            return body
+
+
+async def wait_for_disconnect(receive):
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return
+
+
+def cors_headers(path, headers):
+    # Same policy as flask_cors for /api/*: any origin, with credentials.
+    origin = headers.get("origin")
+    if not origin or not path.startswith("/api/"):
+        return []
+    return [
+        (b"access-control-allow-origin", origin.encode("latin-1")),
+        (b"access-control-allow-credentials", b"true"),
+        (b"vary", b"Origin"),
+    ]
+
+
+async def send_json(send, status, payload, headers, extra_headers=()):
+    body = json.dumps(payload).encode("utf-8")
+    response_headers = [(b"content-type", b"application/json")] + list(extra_headers)
+    if len(body) >= GZIP_MIN_BYTES and "gzip" in headers.get("accept-encoding", ""):
+        body = gzip.compress(body, compresslevel=5)
+        response_headers += [(b"content-encoding", b"gzip"), (b"vary", b"Accept-Encoding")]
+    response_headers.append((b"content-length", str(len(body)).encode()))
+    await send({"type": "http.response.start", "status": status, "headers": response_headers})
+    await send({"type": "http.response.body", "body": body})
+
+
+def iterate_in_thread(events):
+    """
+    Drains the blocking events generator on a helper thread and hands the
+    items to the event loop. Yields ("end", None) once the generator is done.
+    """
+    loop = asyncio.get_running_loop()
+    items = asyncio.Queue()
+
+    def pump():
+        try:
+            for item in events:
+                loop.call_soon_threadsafe(items.put_nowait, item)
+        except Exception as e:
+            loop.call_soon_threadsafe(items.put_nowait, ("error", f"Error: {str(e)}"))
+        finally:
+            events.close()
+            loop.call_soon_threadsafe(items.put_nowait, ("end", None))
+
+    context = contextvars.copy_context()  # keeps the request trace
+    threading.Thread(target=context.run, args=(pump,), name="chat-events", daemon=True).start()
+
+    async def drain():
+        while True:
+            item = await items.get()
+            if item[0] == "end":
+                return
+            yield item
+
+    return drain()
+
+
+async def run_db_call(func, *args):
+    """
+    Runs a blocking database call on a worker thread and returns that
+    thread's pooled connection afterwards, as Flask's teardown does for
+    its own request threads.
+    """
+
+    def call():
+        try:
+            return func(*args)
+        finally:
+            release_connection()
+
+    return await asyncio.to_thread(call)
+
+
+async def run_until_disconnect(work, receive, cancel, timeout):
+    """
+    Runs the `work` coroutine, stopping it when the client disconnects or
+    `timeout` seconds pass. Either way `cancel` is set so the generation
+    behind it stops after the current token.
+    """
+    work_task = asyncio.ensure_future(work)
+    disconnect_task = asyncio.ensure_future(wait_for_disconnect(receive))
+    try:
+        done, _ = await asyncio.wait(
+            {work_task, disconnect_task}, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+        )
+        if work_task in done:
+            return work_task.result()
+        cancel.set()
+        work_task.cancel()
+        if disconnect_task in done:
+            raise ClientDisconnected()
+        raise DeadlineExceededError("Request timed out")
+    finally:
+        disconnect_task.cancel()
+
+
+async def handle_chat(scope, receive, send, rule, needs_login, streaming, priority, collection_id):
+    headers = request_headers(scope)
+    cors = cors_headers(scope["path"], headers)
+    metrics.start_trace(rule, scope["method"])
+    status = 500
+    cancel = threading.Event()
+    try:
+        body = await read_body(receive)
+        session = load_session(headers)
+        if needs_login and "user" not in session:
+            status = 401
+            await send_json(send, status, {"status": "error", "response": "Not authorized"}, headers, cors)
+            return
+        try:
+            data = json.loads(body or b"{}")
+            user_message = (data.get("message") or "").strip()
+        except (ValueError, AttributeError):
+            status = 400
+            await send_json(send, status, {"status": "error", "response": "Invalid request body"}, headers, cors)
+            return
+        filters = await asyncio.to_thread(retrieval_filters, data)
+
+        user_id = session["user"]["sub"] if collection_id is not None else None
+        history = []
+        if collection_id is not None:
+            history = await run_db_call(load_prompt_history, user_id, collection_id, user_message)
+        # Admission happens here, so a full queue is still a plain 503.
+        events = await asyncio.to_thread(
+            stream_llm_response, user_message, history, priority, CHAT_TIMEOUT, cancel, filters
+        )
+
+        async def save_exchange(result):
+            if collection_id is None:
+                return
+            with metrics.timed_stage("persist"):
+                await run_db_call(
+                    append_exchange, user_id, collection_id, user_message, result["answer"], result["sources"]
+                )
+
+        if streaming:
+            status = 200
+            await send(
+                {
+                    "type": "http.response.start",
+                    "status": status,
+                    "headers": [
+                        (b"content-type", b"text/event-stream"),
+                        (b"cache-control", b"no-cache"),
+                        (b"x-accel-buffering", b"no"),
+                    ]
+                    + cors,
+                }
+            )
+
+            async def stream_events():
+                async for event, data in iterate_in_thread(events):
+                    if event == "done":
+                        await save_exchange(data)
+                        message = sse_event("done", {"status": "success"})
+                    elif event == "error":
+                        message = sse_event("error", {"status": "error", "response": data})
+                    else:
+                        message = sse_event(event, data)
+                    await send({"type": "http.response.body", "body": message.encode("utf-8"), "more_body": True})
+
+            try:
+                await run_until_disconnect(stream_events(), receive, cancel, CHAT_TIMEOUT)
+            except DeadlineExceededError:
+                message = sse_event("error", {"status": "error", "response": "The assistant took too long to answer."})
+                await send({"type": "http.response.body", "body": message.encode("utf-8"), "more_body": True})
+            await send({"type": "http.response.body", "body": b""})
+            return
+
+        async def collect_answer():
+            async for event, data in iterate_in_thread(events):
+                if event == "done":
+                    return data
+                if event == "error":
+                    raise RuntimeError(data)
+            raise RuntimeError("The answer stream ended early")
+
+        try:
+            result = await run_until_disconnect(collect_answer(), receive, cancel, CHAT_TIMEOUT)
+        except RuntimeError as e:
+            await send_json(
+                send, status, {"response": f"Error processing your request: {str(e)}", "status": "error"}, headers, cors
+            )
+            return
+        await save_exchange(result)
+        status = 200
+        await send_json(
+            send, status, {"response": result["answer"], "sources": result["sources"], "status": "success"}, headers, cors
+        )
+    except ClientDisconnected:
+        cancel.set()
+        status = 499
+        print("Client disconnected, generation cancelled.", flush=True)
+    except QueueFullError as e:
+        status = 503
+        await send_json(
+            send,
+            status,
+            {"status": "error", "response": "The assistant is busy, please try again shortly."},
+            headers,
+            cors + [(b"retry-after", str(e.retry_after).encode())],
+        )
+    except NotReadyError:
+        status = 503
+        await send_json(
+            send,
+            status,
+            {"status": "error", "response": "The assistant is warming up, please try again in a few seconds."},
+            headers,
+            cors + [(b"retry-after", b"5")],
+        )
+    except DeadlineExceededError:
+        status = 504
+        await send_json(send, status, {"status": "error", "response": "The assistant took too long to answer."}, headers, cors)
+    except InvalidFilters as e:
+        status = 400
+        await send_json(send, status, {"status": "error", "response": str(e)}, headers, cors)
+    finally:
+        cancel.set()  # no-op once the stream has finished
+        metrics.finish_trace(status)
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+    if scope["type"] == "http":
+        route = match_chat_route(scope["method"], scope["path"])
+        if route is not None:
+            await handle_chat(scope, receive, send, *route)
+            return
+    await wsgi_app(scope, receive, send)
@@ -0,0 +1,412 @@
+import argparse
+import hashlib
+import json
+import math
+import os
+import random
+import re
+import resource
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+# Offline benchmark for the chat request path.
+#
+#   python benchmark.py                      # stub LLM + stub embeddings
+#   python benchmark.py --clients 8 --requests 20 --output bench.json
+#   python benchmark.py --mode real          # real TinyLlama / embeddings (must be cached locally)
+#
+# Everything runs inside a throwaway fixture directory with synthetic manuals
+# named like the real ones, so the normal ingestion code (page cache,
+# manifest, Chroma store) is exercised unchanged. Results are printed and,
+# with --output, written as JSON for comparing runs.
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+
+WORDS = (
+    "traffic simulation vehicle lane link node signal queue network origin destination "
+    "demand route speed density flow capacity incident ramp freeway arterial detector "
+    "calibration output file parameter input model INTEGRATION driver behaviour emission "
+    "fuel consumption travel time delay stop intersection phase cycle offset"
+).split()
+
+QUESTIONS = [
+    "How do I define a signalized intersection?",
+    "What does the link capacity parameter control?",
+    "How are origin destination demands specified?",
+    "Which output file reports travel time?",
+    "How is driver behaviour calibrated?",
+    "What units does the speed parameter use?",
+]
+
+
+# ---- stubs ----
+
+class HashEmbeddings:
+    """
+    Deterministic bag-of-words embeddings: every word is hashed into one of
+    `dim` buckets. Good enough to make retrieval return related chunks
+    without downloading a model.
+    """
+
+    def __init__(self, dim=384):
+        self.dim = dim
+
+    def _embed(self, text):
+        vector = [0.0] * self.dim
+        for word in re.findall(r"\w+", text.lower()):
+            bucket = int(hashlib.md5(word.encode("utf-8")).hexdigest()[:8], 16) % self.dim
+            vector[bucket] += 1.0
+        norm = math.sqrt(sum(x * x for x in vector)) or 1.0
+        return [x / norm for x in vector]
+
+    def embed_documents(self, texts):
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text):
+        return self._embed(text)
+
+
+class StubLlama:
+    """
+    Stands in for llama_cpp.Llama (what LlamaCpp.client points to): the
+    tokenizer and context-state calls the answer pipeline makes, with a
+    simulated cost per forward pass and per evaluated token.
+
+    eval() also fills `scores` like a logits_all=True model. The "model" is
+    a copy model: after a token it predicts whatever followed that token's
+    previous occurrence, which is roughly how extractive answers behave.
+    """
+
+    VOCAB = 4096
+    EOS = 2
+
+    def __init__(self, prefill_delay, pass_delay=0.0, n_ctx=2048):
+        self.prefill_delay = prefill_delay
+        self.pass_delay = pass_delay
+        self.input_ids = []
+        self.n_tokens = 0
+        self.words = {}
+        self.scores = np.zeros((n_ctx, self.VOCAB), dtype=np.float32)
+
+    def tokenize(self, text, add_bos=True):
+        tokens = []
+        for word in text.split():
+            token = 3 + int(hashlib.md5(word).hexdigest()[:6], 16) % (self.VOCAB - 3)
+            self.words[token] = word
+            tokens.append(token)
+        return ([1] if add_bos else []) + tokens
+
+    def detokenize(self, tokens):
+        return b"".join(b" " + self.words.get(t, b"?") for t in tokens)
+
+    def token_eos(self):
+        return self.EOS
+
+    def n_ctx(self):
+        return len(self.scores)
+
+    def reset(self):
+        self.n_tokens = 0
+
+    def eval(self, tokens):
+        time.sleep(self.pass_delay + self.prefill_delay * len(tokens))
+        first_new = self.n_tokens
+        self.input_ids = self.input_ids[: self.n_tokens] + list(tokens)
+        self.n_tokens = len(self.input_ids)
+        last_seen = {}
+        for position, token in enumerate(self.input_ids):
+            if position >= first_new:
+                previous = last_seen.get(token)
+                if previous is not None:
+                    predicted = self.input_ids[previous + 1]
+                else:
+                    predicted = 3 + (token * 31 + 7) % (self.VOCAB - 3)
+                self.scores[position].fill(0.0)
+                self.scores[position, predicted] = 1.0
+            last_seen[token] = position
+
+    def save_state(self):
+        return list(self.input_ids[: self.n_tokens])
+
+    def load_state(self, state):
+        self.input_ids = list(state)
+        self.n_tokens = len(state)
+
+    def prefill(self, tokens):
+        # Like llama.cpp: only the part after the longest common prefix with
+        # the current context is evaluated.
+        common = 0
+        for a, b in zip(self.input_ids[: self.n_tokens], tokens):
+            if a != b:
+                break
+            common += 1
+        self.n_tokens = common
+        self.eval(tokens[common:])
+
+
+class StubLlamaCpp:
+    """
+    Deterministic replacement for SafeLlamaCpp: "answers" by echoing words
+    from the retrieved context, max_tokens words long, with a fixed delay per
+    generated token.
+    """
+
+    # Sampling settings read by the speculative decoder: greedy, like stream().
+    temperature = 0.0
+    top_k = 40
+    top_p = 0.95
+    repeat_penalty = 1.0
+    last_n_tokens_size = 64
+
+    def __init__(self, max_tokens=64, token_delay=0.0, prefill_delay=0.0):
+        self.max_tokens = max_tokens
+        self.token_delay = token_delay
+        self.client = StubLlama(prefill_delay, pass_delay=token_delay)
+
+    def stream(self, prompt):
+        self.client.prefill(self.client.tokenize(prompt.encode("utf-8")))
+        words = prompt.split("Context:")[-1].split()
+        for i in range(self.max_tokens):
+            time.sleep(self.token_delay)
+            yield (words[i % len(words)] if words else "token") + " "
+
+
+# ---- fixture ----
+
+def write_synthetic_manual(path, pages, seed):
+    import fitz  # PyMuPDF
+
+    rng = random.Random(seed)
+    doc = fitz.open()
+    for page_num in range(pages):
+        paragraphs = []
+        for _ in range(6):
+            sentence_count = rng.randint(3, 6)
+            sentences = [
+                " ".join(rng.choice(WORDS) for _ in range(rng.randint(6, 14))).capitalize() + "."
+                for _ in range(sentence_count)
+            ]
+            paragraphs.append(" ".join(sentences))
+        page = doc.new_page()
+        page.insert_textbox(
+            fitz.Rect(50, 50, 550, 800),
+            f"Chapter page {page_num + 1}\n\n" + "\n\n".join(paragraphs),
+            fontsize=8,
+        )
+    # A chapter every 8 pages, in the outline so ingestion doesn't have to guess.
+    doc.set_toc([[1, f"Chapter {number + 1}", start + 1] for number, start in enumerate(range(0, pages, 8))])
+    doc.save(path)
+    doc.close()
+
+
+def make_fixture(directory, pages):
+    for number in (1, 2):
+        write_synthetic_manual(os.path.join(directory, f"INTEGRATION_Manual_{number}.pdf"), pages, number)
+
+
+# ---- measuring ----
+
+def summarize(latencies, wall_seconds=None):
+    if not latencies:
+        return {"count": 0}
+    ordered = sorted(latencies)
+
+    def pct(p):
+        return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+    result = {
+        "count": len(ordered),
+        "mean": statistics.fmean(ordered),
+        "p50": pct(50),
+        "p95": pct(95),
+        "p99": pct(99),
+        "max": ordered[-1],
+    }
+    if wall_seconds:
+        result["throughput_per_second"] = len(ordered) / wall_seconds
+    return {k: round(v, 6) if isinstance(v, float) else v for k, v in result.items()}
+
+
+def timed_calls(fn, args_list):
+    latencies = []
+    for args in args_list:
+        start = time.perf_counter()
+        fn(*args)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux. Children covers the PDF process pool.
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return {"self": round(own / 1024, 1), "children": round(children / 1024, 1)}
+
+
+def bench_ingestion(results, llm_module):
+    from LLM.chapterSplitting import MANUALS, get_manual_chapters
+
+    manual = MANUALS[0]
+    shutil.rmtree("./page_cache", ignore_errors=True)
+    cold = timed_calls(get_manual_chapters, [(manual,)])
+    warm = timed_calls(get_manual_chapters, [(manual,)] * 3)
+    split = timed_calls(llm_module.getTextSplitted, [()] * 3)
+    results["extract_chapters_cold"] = summarize(cold)
+    results["extract_chapters_cached"] = summarize(warm)
+    results["get_text_splitted"] = summarize(split)
+
+
+def bench_retrieval(results, llm_module, repeats):
+    pipeline = llm_module.pipeline.get()
+    calls = [(q,) for q in QUESTIONS] * repeats
+    start = time.perf_counter()
+    latencies = timed_calls(pipeline.retrieve, calls)
+    results["retrieval"] = summarize(latencies, time.perf_counter() - start)
+
+
+def bench_decoding(results, llm_module):
+    """
+    Plain greedy decoding against prompt-lookup speculative decoding on the
+    same prompts: checks both produce the same text and compares speed.
+    """
+    from LLM.speculativeDecoding import PromptLookupDecoder
+
+    pipeline = llm_module.pipeline.get()
+    llama = llm_module.llm.get().client
+    max_tokens = llm_module.llm.get().max_tokens
+    prompts = [pipeline.build_prompt(q, pipeline.retrieve(q))[0] for q in QUESTIONS]
+    decoders = {
+        "greedy": PromptLookupDecoder(llama, max_tokens, max_draft=0),
+        "prompt_lookup": PromptLookupDecoder(llama, max_tokens),
+    }
+    outputs = {}
+    with pipeline.lock:
+        for name, decoder in decoders.items():
+            outputs[name] = []
+            for prompt in prompts:
+                pipeline.prefix_cache.restore()
+                outputs[name].append("".join(decoder.generate(prompt)))
+    results["decoding"] = {name: decoder.stats() for name, decoder in decoders.items()}
+    results["decoding"]["identical_output"] = outputs["greedy"] == outputs["prompt_lookup"]
+
+
+def bench_chat(results, app, clients, requests_per_client):
+    chat_latencies = []
+    history_latencies = []
+    statuses = {}
+    lock = threading.Lock()
+
+    def client_loop(index):
+        client = app.test_client()
+        client.post("/api/register", json={"email": f"bench{index}@example.com", "password": "bench"})
+        collection_id = client.post("/api/collections", json={"name": "bench"}).get_json()["collectionId"]
+        own_chat, own_history = [], []
+        for i in range(requests_per_client):
+            question = QUESTIONS[(index + i) % len(QUESTIONS)]
+            start = time.perf_counter()
+            response = client.post(f"/api/collections/{collection_id}/chat", json={"message": question})
+            own_chat.append(time.perf_counter() - start)
+            with lock:
+                statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+            start = time.perf_counter()
+            client.get(f"/api/collections/{collection_id}/history")
+            own_history.append(time.perf_counter() - start)
+        with lock:
+            chat_latencies.extend(own_chat)
+            history_latencies.extend(own_history)
+
+    threads = [threading.Thread(target=client_loop, args=(i,)) for i in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - start
+
+    results["chat_in_collection"] = summarize(chat_latencies, wall)
+    results["chat_in_collection"]["status_codes"] = {str(k): v for k, v in sorted(statuses.items())}
+    results["fetch_chat_history"] = summarize(history_latencies, wall)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the chat request path offline.")
+    parser.add_argument("--mode", choices=["stub", "real"], default="stub")
+    parser.add_argument("--clients", type=int, default=4, help="concurrent chat clients")
+    parser.add_argument("--requests", type=int, default=10, help="chat requests per client")
+    parser.add_argument("--pages", type=int, default=80, help="pages per synthetic manual")
+    parser.add_argument("--max-tokens", type=int, default=64, help="stub answer length")
+    parser.add_argument("--token-delay", type=float, default=0.002, help="stub seconds per generated token (one forward pass)")
+    parser.add_argument("--prefill-delay", type=float, default=0.0002, help="stub seconds per prompt token")
+    parser.add_argument("--answer-cache", action="store_true", help="keep the semantic answer cache on")
+    parser.add_argument(
+        "--speculative", action="store_true", help="serve with prompt-lookup decoding and compare it to greedy"
+    )
+    parser.add_argument("--keep", action="store_true", help="keep the fixture directory")
+    parser.add_argument("--output", help="write results as JSON to this file")
+    args = parser.parse_args()
+
+    output = os.path.abspath(args.output) if args.output else None
+    fixture = tempfile.mkdtemp(prefix="capstone-bench-")
+    # Everything in the backend uses paths relative to the working directory.
+    os.chdir(fixture)
+    os.environ["SQLITE_DB"] = os.path.join(fixture, "bench.db")
+    os.environ.setdefault("INFERENCE_QUEUE_SIZE", str(max(8, args.clients * 2)))
+    if not args.answer_cache:
+        os.environ["ANSWER_CACHE"] = "0"
+    if args.speculative:
+        os.environ["SPECULATIVE_DECODING"] = "1"
+    if args.mode == "stub":
+        os.environ["HF_HUB_OFFLINE"] = "1"
+        os.environ["TRANSFORMERS_OFFLINE"] = "1"
+    sys.path.insert(0, BACKEND_DIR)
+
+    results = {}
+    try:
+        make_fixture(fixture, args.pages)
+
+        import LLM.LLM as llm_module
+        if args.mode == "stub":
+            llm_module.embeddings.set_loader(HashEmbeddings)
+            llm_module.llm.set_loader(
+                lambda: StubLlamaCpp(args.max_tokens, args.token_delay, args.prefill_delay)
+            )
+
+        bench_ingestion(results, llm_module)
+
+        start = time.perf_counter()
+        llm_module.warm_up()
+        results["warm_up_seconds"] = round(time.perf_counter() - start, 3)
+
+        bench_retrieval(results, llm_module, repeats=5)
+        if args.speculative:
+            bench_decoding(results, llm_module)
+
+        from main import app
+        bench_chat(results, app, args.clients, args.requests)
+        results["scheduler"] = llm_module.get_scheduler_stats()
+    finally:
+        os.chdir(BACKEND_DIR)
+        if not args.keep:
+            shutil.rmtree(fixture, ignore_errors=True)
+
+    report = {
+        "config": vars(args),
+        "results": results,
+        "peak_rss_mb": peak_rss_mb(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+    print(json.dumps(report, indent=2))
+    if output:
+        with open(output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+import argparse
+import json
+import os
+import urllib.request
+
+# Builds a new vector index snapshot offline, next to the one being served.
+#
+#   python buildIndex.py                 # build from the manuals, publish, delete old snapshots
+#   python buildIndex.py --no-publish    # build only
+#   python buildIndex.py --list          # show the snapshots
+#
+# A running server keeps serving the snapshot it has until it is told to
+# switch: kill -HUP the model host (or python main.py), or pass --reload-url
+# to call POST /api/admin/index/reload with ADMIN_TOKEN.
+
+
+def reload_server(url):
+    request = urllib.request.Request(
+        url.rstrip("/") + "/api/admin/index/reload",
+        method="POST",
+        headers={"X-Admin-Token": os.environ.get("ADMIN_TOKEN", "")},
+    )
+    with urllib.request.urlopen(request, timeout=300) as response:
+        return json.load(response)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build and publish a vector index snapshot.")
+    parser.add_argument("--no-publish", action="store_true", help="build the snapshot without publishing it")
+    parser.add_argument("--publish", metavar="NAME", help="publish an already built snapshot")
+    parser.add_argument("--list", action="store_true", help="list the snapshots and exit")
+    parser.add_argument("--keep-all", action="store_true", help="don't delete old snapshots")
+    parser.add_argument("--reload-url", help="server to switch to the new snapshot, e.g. http://localhost:5050")
+    args = parser.parse_args()
+
+    import LLM.LLM as llm_module
+
+    store = llm_module.snapshot_store
+    if args.list:
+        current = store.current()
+        for name in store.snapshots():
+            info = store.info(name)
+            marker = "*" if name == current else " "
+            print(f"{marker} {name}  version {info['version'][:12]}  built in {info['build_seconds']}s")
+        return
+
+    if args.publish:
+        store.publish(args.publish)
+        name = args.publish
+        print(f"Published index snapshot {name}.")
+    else:
+        name = llm_module.build_index_snapshot(publish=not args.no_publish)
+    if args.no_publish:
+        return
+
+    if args.reload_url:
+        print(reload_server(args.reload_url))
+    if not args.keep_all:
+        # Without --reload-url the server may still be on the previous
+        # snapshot, which is among the ones kept.
+        store.collect_garbage(in_use=(name,))
+
+
+if __name__ == "__main__":
+    main()
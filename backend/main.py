@@ -1,13 +1,49 @@
-import os, sys
+import os, sys, json, gzip, hmac
 from dotenv import load_dotenv
 
 load_dotenv()  # Load environment variables from .env
 
-from flask import Flask, redirect, url_for, session, request, jsonify
+from flask import Flask, redirect, url_for, session, request, jsonify, Response, stream_with_context
 from flask_cors import CORS
 
 # Import the helper from llm.py to generate responses from the LLM.
-from LLM.LLM import get_llm_response
+if os.environ.get("MODEL_HOST_ADDRESS"):
+    # Multi-worker mode: the models live in modelHost.py and every web
+    # worker forwards to it instead of loading its own copy.
+    import LLM.modelClient as llm_backend
+else:
+    import LLM.LLM as llm_backend
+
+get_llm_response = llm_backend.get_llm_response
+stream_llm_response = llm_backend.stream_llm_response
+get_cache_stats = llm_backend.get_cache_stats
+get_embedding_stats = llm_backend.get_embedding_stats
+get_chunk = llm_backend.get_chunk
+get_manuals = llm_backend.get_manuals
+reload_index = llm_backend.reload_index
+get_scheduler_stats = llm_backend.get_scheduler_stats
+count_tokens_batch = llm_backend.count_tokens_batch
+history_token_budget = llm_backend.history_token_budget
+start_warm_up = llm_backend.start_warm_up
+readiness = llm_backend.readiness
+from LLM.lazyComponents import NotReadyError
+from LLM.historyBudget import select_recent_history
+import metrics
+from LLM.inferenceScheduler import (
+    QueueFullError,
+    DeadlineExceededError,
+    PRIORITY_INTERACTIVE,
+    PRIORITY_ANONYMOUS,
+)
+
+
+
+class InvalidFilters(ValueError):
+    pass
+
+
+# Errors that get their own status code instead of a generic 500.
+BACKPRESSURE_ERRORS = (QueueFullError, DeadlineExceededError, NotReadyError, InvalidFilters)
 from CollectionManager import *
 
 # at the top, alongside your other imports from CollectionManager:
@@ -16,7 +52,10 @@ from CollectionManager import (
     get_collections,
     delete_collection,
     get_chat_history,
+    get_chat_history_page,
+    get_ownership_cache_stats,
     add_message,
+    append_exchange,
     rename_collection as db_rename_collection,   # <— our new helper
 )
 
@@ -33,11 +72,155 @@ app.config["SESSION_COOKIE_SECURE"] = False  # Set to True in production with HT
 CORS(app, resources={r"/api/*": {"origins": "*"}}, supports_credentials=True)
 
 
+@app.before_request
+def begin_request_trace():
+    metrics.start_trace(request.url_rule.rule if request.url_rule else "unmatched", request.method)
+
+
+@app.after_request
+def record_response_status(response):
+    metrics.annotate(status=response.status_code)
+    return response
+
+
+# JSON bodies smaller than this are not worth compressing.
+GZIP_MIN_BYTES = int(os.environ.get("GZIP_MIN_BYTES", "500"))
+
+
+@app.after_request
+def compress_json_response(response):
+    if (
+        response.direct_passthrough
+        or response.is_streamed
+        or response.mimetype != "application/json"
+        or "Content-Encoding" in response.headers
+        or not request.accept_encodings["gzip"]
+    ):
+        return response
+    body = response.get_data()
+    if len(body) < GZIP_MIN_BYTES:
+        return response
+    response.set_data(gzip.compress(body, compresslevel=5))
+    response.headers["Content-Encoding"] = "gzip"
+    response.vary.add("Accept-Encoding")
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        # The compressed bytes differ from the identity representation.
+        response.set_etag(etag, weak=True)
+    return response
+
+
+@app.teardown_request
+def release_db_connection(error=None):
+    # Hand the request thread's SQLite connection back to the pool.
+    release_connection()
+
+
+@app.teardown_request
+def end_request_trace(error=None):
+    # Runs after a streamed body has been fully sent, so streams are timed end to end.
+    trace = metrics.current_trace.get()
+    status = trace.get("status", 500) if trace else 500
+    metrics.finish_trace(status)
+
+
 @app.errorhandler(ConnectionResetError)
 def handle_client_disconnect(error):
     print("Client disconnected abruptly.", flush=True)
     return "", 499  # Custom status for aborted requests
 
+
+@app.errorhandler(QueueFullError)
+def handle_queue_full(error):
+    response = jsonify(
+        {"status": "error", "response": "The assistant is busy, please try again shortly."}
+    )
+    response.status_code = 503
+    response.headers["Retry-After"] = str(error.retry_after)
+    return response
+
+
+@app.errorhandler(NotReadyError)
+def handle_not_ready(error):
+    response = jsonify(
+        {"status": "error", "response": "The assistant is warming up, please try again in a few seconds."}
+    )
+    response.status_code = 503
+    response.headers["Retry-After"] = "5"
+    return response
+
+
+@app.errorhandler(DeadlineExceededError)
+def handle_deadline_exceeded(error):
+    return jsonify({"status": "error", "response": "The assistant took too long to answer."}), 504
+
+
+@app.errorhandler(InvalidFilters)
+def handle_invalid_filters(error):
+    return jsonify({"status": "error", "response": str(error)}), 400
+
+
+def retrieval_filters(data):
+    """
+    Optional "manual" (an id from /api/manuals) and "chapter" (a chapter
+    number of that manual) in a chat request, which restrict retrieval to
+    that manual or chapter. Returns None when the request has neither.
+    Raises InvalidFilters for filters that match nothing.
+    """
+    manual = data.get("manual")
+    chapter = data.get("chapter")
+    if manual is None and chapter is None:
+        return None
+    if manual is None:
+        raise InvalidFilters("A chapter filter needs a manual")
+    known = {entry["id"]: entry for entry in get_manuals()}
+    if manual not in known:
+        raise InvalidFilters(f"Unknown manual: {manual}")
+    filters = {"manual": manual}
+    if chapter is not None:
+        if not isinstance(chapter, int) or not 0 <= chapter < len(known[manual]["chapters"]):
+            raise InvalidFilters(f"Unknown chapter of {manual}: {chapter}")
+        filters["chapter"] = chapter
+    return filters
+
+
+def sse_event(event, data):
+    """
+    Formats one Server-Sent Events message. data is JSON encoded so tokens
+    containing newlines survive the trip.
+    """
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def sse_response(events):
+    """
+    Wraps a generator of SSE strings in a streaming response. Buffering is
+    disabled so tokens reach the browser as soon as they are yielded.
+    """
+    return Response(
+        stream_with_context(events),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+def stream_chat_events(events, on_complete=None):
+    """
+    Turns stream_llm_response events into SSE messages: one "token" event per
+    generated piece, a trailing "sources" event (chunk references, the text
+    is available from /api/chunks/<id>) and a final "done" event.
+    on_complete gets {"answer", "sources"} once generation has finished.
+    """
+    for event, data in events:
+        if event == "done":
+            if on_complete is not None:
+                on_complete(data)
+            yield sse_event("done", {"status": "success"})
+        elif event == "error":
+            yield sse_event("error", {"status": "error", "response": data})
+        else:
+            yield sse_event(event, data)
+
 ## Authentication Routes
 
 @app.route("/api/register", methods=["POST"])
@@ -125,9 +308,15 @@ def chat():
         user_message = data.get("message", "").strip()
 
         # Call the helper from llm.py to get the response from the LLM.
-        llm_response = get_llm_response(user_message)
+        llm_response = get_llm_response(
+            user_message, priority=PRIORITY_INTERACTIVE, filters=retrieval_filters(data)
+        )
 
-        return jsonify({"response": llm_response, "status": "success"})
+        return jsonify(
+            {"response": llm_response["answer"], "sources": llm_response["sources"], "status": "success"}
+        )
+    except BACKPRESSURE_ERRORS:
+        raise
     except Exception as e:
         print("Error in /api/chat:", str(e), flush=True)
         return (
@@ -141,6 +330,18 @@ def chat():
         )
 
 
+@app.route("/api/chat/stream", methods=["POST"])
+def chat_stream():
+    if "user" not in session:
+        return jsonify({"status": "error", "response": "Not authorized"}), 401
+    data = request.get_json()
+    user_message = data.get("message", "").strip()
+
+    # Submitted before the response starts so a full queue still gets a 503.
+    events = stream_llm_response(user_message, priority=PRIORITY_INTERACTIVE, filters=retrieval_filters(data))
+    return sse_response(stream_chat_events(events))
+
+
 @app.route("/api/user", methods=["GET"])
 def get_user():
     user = session.get("user")
@@ -161,9 +362,15 @@ def chatNoAuth():
         print("**************")
 
         # Call the helper from llm.py to get the response from the LLM.
-        llm_response = get_llm_response(user_message)
+        llm_response = get_llm_response(
+            user_message, priority=PRIORITY_ANONYMOUS, filters=retrieval_filters(data)
+        )
 
-        return jsonify({"response": llm_response, "status": "success"})
+        return jsonify(
+            {"response": llm_response["answer"], "sources": llm_response["sources"], "status": "success"}
+        )
+    except BACKPRESSURE_ERRORS:
+        raise
     except Exception as e:
         print("Error in /api/chat:", str(e), flush=True)
         return (
@@ -181,6 +388,70 @@ def chatNoAuth():
 def test():
     return jsonify({"status": "success", "message": "Backend is working!"})
 
+
+@app.route("/api/ready", methods=["GET"])
+def ready():
+    # Which models/stores are loaded and how long each took.
+    status = readiness()
+    return jsonify({"status": "success" if status["ready"] else "warming_up", **status}), (
+        200 if status["ready"] else 503
+    )
+
+
+@app.route("/api/metrics", methods=["GET"])
+def prometheus_metrics():
+    # In multi-worker mode the model stages are recorded in the model host;
+    # ?source=model_host returns its registry instead of this worker's.
+    if request.args.get("source") == "model_host" and hasattr(llm_backend, "render_metrics"):
+        body = llm_backend.render_metrics()
+    else:
+        body = metrics.render()
+    return Response(body, mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/api/cache/stats", methods=["GET"])
+def cache_stats():
+    return jsonify({
+        "status": "success",
+        "answerCache": get_cache_stats(),
+        "queryEmbeddings": get_embedding_stats(),
+        "collectionOwnership": get_ownership_cache_stats(),
+    })
+
+
+@app.route("/api/chunks/<chunk_id>", methods=["GET"])
+def fetch_chunk(chunk_id):
+    chunk = get_chunk(chunk_id)
+    if chunk is None:
+        return jsonify({"status": "error", "message": "Chunk not found"}), 404
+    response = jsonify({"status": "success", "chunk": chunk})
+    # Chunk ids are content hashes, so the id doubles as the ETag.
+    response.set_etag(chunk_id)
+    response.cache_control.public = True
+    response.cache_control.max_age = 86400
+    return response.make_conditional(request)
+
+
+@app.route("/api/manuals", methods=["GET"])
+def list_manuals():
+    # Manuals and chapters a chat request can be restricted to.
+    return jsonify({"status": "success", "manuals": get_manuals()})
+
+
+@app.route("/api/admin/index/reload", methods=["POST"])
+def reload_vector_index():
+    # Switches to the index snapshot published by buildIndex.py. Only
+    # enabled when ADMIN_TOKEN is set; send it in the X-Admin-Token header.
+    admin_token = os.environ.get("ADMIN_TOKEN")
+    if not admin_token or not hmac.compare_digest(request.headers.get("X-Admin-Token", "").encode(), admin_token.encode()):
+        return jsonify({"status": "error", "message": "Not authorized"}), 401
+    return jsonify({"status": "success", "index": reload_index()})
+
+
+@app.route("/api/scheduler/stats", methods=["GET"])
+def scheduler_stats():
+    return jsonify({"status": "success", "scheduler": get_scheduler_stats()})
+
 @app.route("/api/collections", methods=["POST"])
 def create_collection():
     if "user" not in session:
@@ -222,9 +493,68 @@ def fetch_chat_history(collection_id):
         return jsonify({"status": "error", "message": "Not authorized"}), 401
 
     user_id = session["user"]["sub"]
-    history = get_chat_history(user_id, collection_id)
 
-    return jsonify({"status": "success", "chatHistory": history})
+    # Without paging parameters the whole history is returned, as before.
+    if "limit" not in request.args and "cursor" not in request.args:
+        history = get_chat_history(user_id, collection_id)
+        return jsonify({"status": "success", "chatHistory": history})
+
+    try:
+        limit = min(max(int(request.args.get("limit", 50)), 1), 500)
+        cursor_id = request.args.get("cursor")
+        cursor_id = int(cursor_id) if cursor_id else None
+    except ValueError:
+        return jsonify({"status": "error", "message": "Invalid cursor or limit"}), 400
+    newest_first = request.args.get("order", "oldest") == "newest"
+
+    page = get_chat_history_page(user_id, collection_id, cursor_id, limit, newest_first)
+    return jsonify(
+        {
+            "status": "success",
+            "chatHistory": page["messages"],
+            "nextCursor": page["nextCursor"],
+        }
+    )
+
+
+@app.route("/api/search", methods=["GET"])
+def search_history():
+    if "user" not in session:
+        return jsonify({"status": "error", "message": "Not authorized"}), 401
+
+    user_id = session["user"]["sub"]
+    text = request.args.get("q", "").strip()
+    if not text:
+        return jsonify({"status": "error", "message": "Missing search query"}), 400
+    try:
+        limit = min(max(int(request.args.get("limit", 20)), 1), 100)
+        offset = max(int(request.args.get("cursor") or 0), 0)
+    except ValueError:
+        return jsonify({"status": "error", "message": "Invalid cursor or limit"}), 400
+
+    page = search_chat_history(user_id, text, offset, limit)
+    return jsonify(
+        {
+            "status": "success",
+            "results": page["results"],
+            "nextCursor": page["nextCursor"],
+        }
+    )
+
+
+def load_prompt_history(user_id, collection_id, user_message):
+    """
+    Most recent turns of the collection that fit in what is left of the
+    model's context window for this question.
+    """
+    with metrics.timed_stage("history"):
+        return select_recent_history(
+            lambda cursor_id, limit: get_chat_history_page(
+                user_id, collection_id, cursor_id, limit, newest_first=True
+            ),
+            count_tokens_batch,
+            history_token_budget(user_message),
+        )
 
 
 @app.route("/api/collections/<collection_id>/chat", methods=["POST"])
@@ -237,15 +567,20 @@ def chat_in_collection(collection_id):
         user_message = data.get("message", "").strip()
 
         user_id = session["user"]["sub"]
-        history = get_chat_history(user_id, collection_id)
+        history = load_prompt_history(user_id, collection_id, user_message)
 
         # Get response from the LLM
-        llm_response = get_llm_response(user_message, history)
+        llm_response = get_llm_response(
+            user_message, history, priority=PRIORITY_INTERACTIVE, filters=retrieval_filters(data)
+        )
 
-        # Save user message
-        add_message(user_id, collection_id, "user", user_message)
-        # Save assistant response
-        add_message(user_id, collection_id, "assistant", llm_response)
+        # Save the user message and the assistant response in one go
+        with metrics.timed_stage("persist"):
+            append_exchange(
+                user_id, collection_id, user_message, llm_response["answer"], llm_response["sources"]
+            )
+    except BACKPRESSURE_ERRORS:
+        raise
     except Exception as e:
         return (
             jsonify(
@@ -257,7 +592,32 @@ def chat_in_collection(collection_id):
             500,
         )
 
-    return jsonify({"response": llm_response, "status": "success"})
+    return jsonify(
+        {"response": llm_response["answer"], "sources": llm_response["sources"], "status": "success"}
+    )
+
+
+@app.route("/api/collections/<collection_id>/chat/stream", methods=["POST"])
+def chat_in_collection_stream(collection_id):
+    if "user" not in session:
+        return jsonify({"status": "error", "message": "Not authorized"}), 401
+    user_id = session["user"]["sub"]
+    data = request.get_json()
+    user_message = data.get("message", "").strip()
+
+    history = load_prompt_history(user_id, collection_id, user_message)
+
+    def save_exchange(llm_response):
+        # Only persisted once the stream finished, same as the blocking route.
+        with metrics.timed_stage("persist"):
+            append_exchange(
+                user_id, collection_id, user_message, llm_response["answer"], llm_response["sources"]
+            )
+
+    events = stream_llm_response(
+        user_message, history, priority=PRIORITY_INTERACTIVE, filters=retrieval_filters(data)
+    )
+    return sse_response(stream_chat_events(events, save_exchange))
 
 
 @app.route("/api/rename_collection", methods=["POST"])
@@ -282,6 +642,18 @@ def rename_collection():
         return jsonify({"status": "error", "message": str(e)}), 500
 
 
+# Load the models in the background so auth and collection routes are served
+# right away.
+if __name__ != "__main__":
+    start_warm_up()
+
 # run the app
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=5050, debug=True)
+    debug = True
+    # The debug reloader's parent process never serves requests, only the
+    # child (WERKZEUG_RUN_MAIN=true) needs the models.
+    if not debug or os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        if hasattr(llm_backend, "install_reload_signal"):
+            llm_backend.install_reload_signal()  # kill -HUP reloads the index
+        start_warm_up()
+    app.run(host="0.0.0.0", port=5050, debug=debug)
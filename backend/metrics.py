@@ -0,0 +1,215 @@
+import bisect
+import contextvars
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+# Small in-process metrics registry rendered in the Prometheus text format
+# by /api/metrics, plus optional per-request trace logs (TRACE_LOG=1).
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+_registry = []
+_registry_lock = threading.Lock()
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+class Counter:
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        with _registry_lock:
+            _registry.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(n, "") for n in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._series = {}  # label values -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+        with _registry_lock:
+            _registry.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(n, "") for n in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 2)
+            if index < len(self.buckets):
+                series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, series in sorted(self._series.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets, series):
+                    cumulative += count
+                    labels = _format_labels(self.labelnames, key, ("le", _format_value(bound)))
+                    lines.append(f"{self.name}_bucket{labels} {cumulative}")
+                labels = _format_labels(self.labelnames, key, ("le", "+Inf"))
+                lines.append(f"{self.name}_bucket{labels} {series[-1]}")
+                labels = _format_labels(self.labelnames, key)
+                lines.append(f"{self.name}_sum{labels} {_format_value(series[-2])}")
+                lines.append(f"{self.name}_count{labels} {series[-1]}")
+        return lines
+
+
+def render():
+    with _registry_lock:
+        metrics = list(_registry)
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# ---- the metrics themselves ----
+
+http_request_seconds = Histogram(
+    "http_request_duration_seconds", "Time spent serving a request.", ("route", "method", "status")
+)
+stage_seconds = Histogram(
+    "chat_stage_duration_seconds",
+    "Time spent in each stage of a chat request (history, cache, queue_wait, retrieval, prefill, generation, persist).",
+    ("stage",),
+)
+db_query_seconds = Histogram(
+    "db_query_duration_seconds",
+    "SQLite query time per CollectionManager function.",
+    ("query",),
+    buckets=(0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5, 1, 5),
+)
+tokens_in_total = Counter("llm_prompt_tokens_total", "Prompt tokens sent to the model.")
+tokens_out_total = Counter("llm_generated_tokens_total", "Tokens generated by the model.")
+tokens_per_second = Histogram(
+    "llm_generation_tokens_per_second",
+    "Generation speed per request.",
+    buckets=(1, 2, 5, 10, 15, 20, 30, 50, 75, 100, 200),
+)
+retrieved_documents = Histogram(
+    "retrieval_documents", "Documents returned per retrieval.", buckets=(0, 1, 2, 3, 4, 5, 8, 10, 20)
+)
+draft_tokens_total = Counter(
+    "llm_draft_tokens_total", "Prompt-lookup draft tokens by verification result.", ("result",)
+)
+ownership_cache_lookups = Counter(
+    "collection_ownership_cache_total", "Collection ownership checks by cache result.", ("result",)
+)
+shard_searches_total = Counter(
+    "retrieval_shard_searches_total", "Vector store shards searched, by manual.", ("manual",)
+)
+
+
+# ---- per-request traces ----
+
+TRACE_LOG = os.environ.get("TRACE_LOG") == "1"
+
+# The current request's trace. It is a plain dict, so work the scheduler runs
+# on its worker thread (in a copy of the request's context) writes into the
+# same trace.
+current_trace = contextvars.ContextVar("current_trace", default=None)
+
+
+def start_trace(route, method):
+    trace = {"route": route, "method": method, "start": time.perf_counter(), "stages": {}}
+    current_trace.set(trace)
+    return trace
+
+
+def annotate(**values):
+    trace = current_trace.get()
+    if trace is not None:
+        trace.update(values)
+
+
+def record_stage(stage, seconds):
+    stage_seconds.observe(seconds, stage=stage)
+    trace = current_trace.get()
+    if trace is not None:
+        trace["stages"][stage] = round(trace["stages"].get(stage, 0.0) + seconds, 6)
+
+
+@contextmanager
+def timed_stage(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - start)
+
+
+def timed_query(name):
+    """
+    Decorator recording how long a CollectionManager function spent in SQLite.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                db_query_seconds.observe(elapsed, query=name)
+                trace = current_trace.get()
+                if trace is not None:
+                    trace.setdefault("db", {})[name] = round(elapsed, 6)
+        return wrapper
+    return decorator
+
+
+def finish_trace(status):
+    trace = current_trace.get()
+    if trace is None:
+        return
+    current_trace.set(None)
+    elapsed = time.perf_counter() - trace.pop("start")
+    http_request_seconds.observe(elapsed, route=trace["route"], method=trace["method"], status=status)
+    if TRACE_LOG:
+        trace["status"] = status
+        trace["seconds"] = round(elapsed, 6)
+        print(json.dumps(trace), flush=True)
@@ -0,0 +1,95 @@
+import os
+import threading
+from multiprocessing.connection import Listener
+
+from dotenv import load_dotenv
+
+load_dotenv()  # Load environment variables from .env
+
+import LLM.LLM as llm_backend
+import metrics
+from LLM.modelClient import MODEL_HOST_ADDRESS, MODEL_HOST_AUTHKEY
+
+# Production serving: this process is the only one that loads TinyLlama,
+# the embedding model and the vector store. Web workers started with
+# MODEL_HOST_ADDRESS set (see LLM/modelClient.py) forward their calls here,
+# so running N workers does not mean N copies of the weights in memory.
+#
+#   python modelHost.py &
+#   MODEL_HOST_ADDRESS=./model_host.sock gunicorn -w 4 -b 0.0.0.0:5050 main:app
+
+# Calls a worker is allowed to make.
+METHODS = {
+    "readiness": llm_backend.readiness,
+    "count_tokens": llm_backend.count_tokens,
+    "count_tokens_batch": llm_backend.count_tokens_batch,
+    "history_token_budget": llm_backend.history_token_budget,
+    "get_cache_stats": llm_backend.get_cache_stats,
+    "get_embedding_stats": llm_backend.get_embedding_stats,
+    "get_chunk": llm_backend.get_chunk,
+    "get_manuals": llm_backend.get_manuals,
+    "reload_index": llm_backend.reload_index,
+    "get_scheduler_stats": llm_backend.get_scheduler_stats,
+    "get_llm_response": llm_backend.get_llm_response,
+    "render_metrics": metrics.render,
+}
+
+
+def error_reply(e):
+    return ("error", type(e).__name__, str(e), getattr(e, "retry_after", None))
+
+
+def serve_stream(conn, args):
+    try:
+        events = llm_backend.stream_llm_response(*args)
+    except Exception as e:
+        conn.send(error_reply(e))
+        return
+    conn.send(("ok", None))
+    try:
+        for event, data in events:
+            conn.send(("event", event, data))
+        conn.send(("end",))
+    finally:
+        # Worker hung up (client went away): stop generating.
+        events.close()
+
+
+def handle_connection(conn):
+    with conn:
+        while True:
+            try:
+                method, args = conn.recv()
+            except (EOFError, OSError):
+                return
+            try:
+                if method == "stream_llm_response":
+                    serve_stream(conn, args)
+                    return  # stream connections are single use
+                if method not in METHODS:
+                    raise ValueError(f"Unknown method {method}")
+                conn.send(("ok", METHODS[method](*args)))
+            except (EOFError, OSError):
+                return
+            except Exception as e:
+                conn.send(error_reply(e))
+
+
+def main():
+    if os.path.exists(MODEL_HOST_ADDRESS):
+        os.remove(MODEL_HOST_ADDRESS)  # stale socket from a previous run
+    llm_backend.install_reload_signal()
+    llm_backend.start_warm_up()
+    with Listener(MODEL_HOST_ADDRESS, family="AF_UNIX", authkey=MODEL_HOST_AUTHKEY) as listener:
+        print(f"Model host listening on {MODEL_HOST_ADDRESS}", flush=True)
+        while True:
+            try:
+                conn = listener.accept()
+            except Exception as e:  # bad authkey, half-open connection, ...
+                print("Rejected model host connection:", e, flush=True)
+                continue
+            threading.Thread(target=handle_connection, args=(conn,), daemon=True).start()
+
+
+if __name__ == "__main__":
+    main()
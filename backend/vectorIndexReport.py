@@ -0,0 +1,48 @@
+import argparse
+import json
+
+# Recall-vs-memory report for the mmap vector index storage options.
+#
+#   python vectorIndexReport.py              # uses the vectors of the published index snapshot
+#   python vectorIndexReport.py --k 5 --sample 500
+#
+# Each option (float32, float16, int8, with and without full-precision
+# rescoring) is built from the same vectors and compared against exact
+# float32 search. Pick VECTOR_INDEX_DTYPE / VECTOR_INDEX_RESCORE from this.
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare vector index storage precisions.")
+    parser.add_argument("--k", type=int, default=3, help="neighbours compared per query")
+    parser.add_argument("--sample", type=int, default=200, help="stored vectors used as queries")
+    parser.add_argument("--output", help="write the report as JSON to this file")
+    args = parser.parse_args()
+
+    import LLM.LLM as llm_module
+    from LLM.vectorIndex import recall_report
+
+    ids, vectors = [], []
+    for shard in llm_module.index.get().shards.values():
+        data = shard.db.get(include=["embeddings"])
+        ids += data["ids"]
+        vectors += list(data["embeddings"])
+    if not ids:
+        print("The vector store is empty, nothing to report.")
+        return
+
+    report = recall_report(ids, vectors, k=args.k, sample=args.sample)
+    baseline = report[0]["resident_bytes"]
+    print(f"{len(ids)} vectors, recall@{args.k} against exact float32:")
+    for row in report:
+        label = row["dtype"] + (" + rescore" if row["rescore"] else "")
+        print(
+            f"  {label:<18} recall {row['recall_at_k']:.4f}  "
+            f"{row['resident_bytes'] / 1024 / 1024:8.2f} MiB  ({row['resident_bytes'] / baseline:.0%})"
+        )
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -8,5 +8,18 @@ sleep 5
 
 # Start backend (adjust as needed)
 cd backend
-python main.py
+if [ "$SERVING_MODE" = "production" ]; then
+    # One model host process holds the models, the web workers forward to it.
+    export MODEL_HOST_ADDRESS=./model_host.sock
+    python modelHost.py &
+    gunicorn -w "${WEB_WORKERS:-4}" --threads 8 -b 0.0.0.0:5050 main:app
+elif [ "$SERVING_MODE" = "async" ]; then
+    # Same model host, but the web workers serve the chat endpoints on an
+    # event loop and cancel generations whose client went away.
+    export MODEL_HOST_ADDRESS=./model_host.sock
+    python modelHost.py &
+    uvicorn asgi:app --workers "${WEB_WORKERS:-4}" --host 0.0.0.0 --port 5050
+else
+    python main.py
+fi
 